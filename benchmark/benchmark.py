@@ -1,3 +1,4 @@
+import argparse
 import logging
 import os
 import platform
@@ -34,12 +35,20 @@ def markdown_table(data: dict, headers: tuple[str, str]) -> str:
     return table
 
 
-def build_report(project_path: str, animation_path: str, command: str, output: str):
+def build_report(
+    project_path: str,
+    animation_path: str,
+    command: str,
+    output: str,
+    render_device: str = '',
+):
     # hardware
     queue = opencl.command_queue()
     device = queue.device
 
     hardware = {'processor': platform.processor(), 'OpenCL Device': device.name}
+    if render_device:
+        hardware['Render Device'] = render_device
 
     for name in (
         'MAX_COMPUTE_UNITS',
@@ -124,13 +133,15 @@ def build_report(project_path: str, animation_path: str, command: str, output: s
         report = report.replace(placeholder, value)
 
     report_name = f'report_v{realflare_version}.md'
+    if render_device:
+        report_name = f'report_v{realflare_version}_{render_device.lower()}.md'
     project_dir = os.path.dirname(project_path)
     report_path = os.path.join(project_dir, report_name)
     with open(report_path, 'w') as f:
         f.write(report)
 
 
-def run(name: str = 'nikon_ai_50_135mm') -> None:
+def run(name: str = 'nikon_ai_50_135mm', device: str = '') -> None:
     # set environment variables
     env = os.environ.copy()
     if 'REALFLARE_DEV' in env:
@@ -147,12 +158,25 @@ def run(name: str = 'nikon_ai_50_135mm') -> None:
         f'--project "{project_path}" --animation "{animation_path}" '
         f'--frame-start 1 --frame-end 2 --log {logging.INFO}'
     )
+    if device:
+        command += f' --device "{device}"'
     output = subprocess.check_output(
         command, env=env, shell=True, stderr=subprocess.STDOUT
     )
 
-    build_report(project_path, animation_path, command, output.decode('utf-8'))
+    build_report(project_path, animation_path, command, output.decode('utf-8'), device)
 
 
 if __name__ == '__main__':
-    run()
+    parser = argparse.ArgumentParser(description='Benchmark the renderer.')
+    parser.add_argument('--name', default='nikon_ai_50_135mm')
+    parser.add_argument(
+        '--numpy',
+        action='store_true',
+        help='also benchmark the NumPy device, this takes a lot longer',
+    )
+    args = parser.parse_args()
+
+    run(args.name)
+    if args.numpy:
+        run(args.name, device=opencl.CPU_DEVICE)
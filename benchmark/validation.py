@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+from PySide2 import QtCore
+
+from qt_extensions.typeutils import cast
+from realflare.api.data import Project, RegionOfInterest, RenderElement, RenderImage
+from realflare.api.engine import Engine
+from realflare.api.tasks import opencl
+from realflare.storage import Storage
+
+storage = Storage()
+
+
+def render(
+    project: Project,
+    device: str,
+    element: RenderElement = RenderElement.FLARE,
+    engine: Engine | None = None,
+) -> np.ndarray:
+    project.render.device = device
+    if engine is None:
+        engine = Engine()
+    # clears the emit cache so that every render emits its image
+    engine.set_elements([element])
+
+    images = []
+
+    def image_rendered(image: RenderImage) -> None:
+        images.append(image.image.array.copy())
+
+    engine.image_rendered.connect(image_rendered)
+    try:
+        if not engine.render(project) or not images:
+            raise RuntimeError(f'failed to render on device: {device}')
+    finally:
+        engine.image_rendered.disconnect(image_rendered)
+    return images[-1]
+
+
+def timed_render(
+    engine: Engine, project: Project, device: str
+) -> tuple[np.ndarray, float]:
+    # renders with cleared task caches so that all stages of the render are
+    # timed, only engine.render is timed
+    project.render.device = device
+    engine.set_elements([RenderElement.FLARE])
+    engine.clear_task_caches()
+
+    images = []
+
+    def image_rendered(image: RenderImage) -> None:
+        images.append(image.image.array.copy())
+
+    engine.image_rendered.connect(image_rendered)
+    try:
+        start = time.perf_counter()
+        success = engine.render(project)
+        elapsed = time.perf_counter() - start
+    finally:
+        engine.image_rendered.disconnect(image_rendered)
+    if not success or not images:
+        raise RuntimeError(f'failed to render on device: {device}')
+    return images[-1], elapsed
+
+
+def compare(reference: np.ndarray, array: np.ndarray) -> dict[str, float]:
+    diff = np.abs(array[..., :3] - reference[..., :3])
+    total = max(float(np.sum(np.abs(reference[..., :3]))), 1e-9)
+    return {
+        'max_error': float(np.max(diff)),
+        'mean_error': float(np.mean(diff)),
+        'relative_error': float(np.sum(diff)) / total,
+        'energy_ratio': float(np.sum(array[..., :3])) / total,
+    }
+
+
+def load_project(name: str) -> Project:
+    project_dir = os.path.join(os.path.dirname(__file__), name)
+    project_path = os.path.join(project_dir, 'project.json')
+    return cast(Project, storage.read_data(project_path))
+
+
+def log_result(result: dict[str, float]) -> None:
+    for key, value in result.items():
+        logging.info(f'{key}: {value:.6f}')
+
+
+def run(name: str = 'nikon_ai_50_135mm', device: str = '') -> dict[str, float]:
+    # renders the flare of the benchmark project with an OpenCL device and
+    # the numpy backend and compares the results
+    project = load_project(name)
+
+    # lower the settings, the numpy backend is slow
+    project.render.resolution = QtCore.QSize(512, 288)
+    project.render.grid_count = min(project.render.grid_count, 33)
+
+    reference = render(project, device)
+    array = render(project, opencl.CPU_DEVICE)
+    result = compare(reference, array)
+    log_result(result)
+    return result
+
+
+def run_packed_vertexes(
+    name: str = 'nikon_ai_50_135mm', device: str = ''
+) -> dict[str, float]:
+    # renders the flare of the benchmark project with full precision and packed
+    # vertexes and compares the results
+    project = load_project(name)
+
+    project.render.packed_vertexes = False
+    reference = render(project, device)
+    project.render.packed_vertexes = True
+    array = render(project, device)
+    result = compare(reference, array)
+    log_result(result)
+    return result
+
+
+def run_analytic_coverage(
+    name: str = 'nikon_ai_50_135mm', device: str = ''
+) -> dict[str, float]:
+    # compares analytic coverage and sampled anti-aliasing against a render with
+    # the highest anti-aliasing and logs the render times
+    project = load_project(name)
+    engine = Engine()
+
+    # the reference render also builds the kernels, it is not timed
+    project.render.analytic_coverage = False
+    project.render.anti_aliasing = 8
+    reference = render(project, device, engine=engine)
+
+    results = {}
+    for anti_aliasing in (1, 2, 4):
+        project.render.anti_aliasing = anti_aliasing
+        for analytic_coverage in (False, True):
+            project.render.analytic_coverage = analytic_coverage
+            array, elapsed = timed_render(engine, project, device)
+
+            mode = 'analytic' if analytic_coverage else 'sampled'
+            result = compare(reference, array)
+            result['time'] = elapsed
+            logging.info(f'{mode} anti_aliasing {anti_aliasing}:')
+            log_result(result)
+            results[f'{mode}_{anti_aliasing}'] = result
+    return results
+
+
+def run_roi_box(name: str = 'nikon_ai_50_135mm', device: str = '') -> dict[str, float]:
+    # renders the flare and starburst with the default box region of interest,
+    # which is empty and needs to render the full frame
+    project = load_project(name)
+
+    project.render.roi = RegionOfInterest.FULL
+    reference = render(project, device, RenderElement.FLARE_STARBURST)
+    project.render.roi = RegionOfInterest.BOX
+    project.render.roi_position = QtCore.QPoint(0, 0)
+    project.render.roi_size = QtCore.QSize(0, 0)
+    array = render(project, device, RenderElement.FLARE_STARBURST)
+    result = compare(reference, array)
+    log_result(result)
+    if result['max_error'] > 0:
+        raise AssertionError('an empty box does not render the full frame')
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Validate the renderer.')
+    parser.add_argument('--name', default='nikon_ai_50_135mm')
+    parser.add_argument('--device', default='')
+    parser.add_argument(
+        '--packed-vertexes',
+        action='store_true',
+        help='compare packed against full precision vertexes',
+    )
+    parser.add_argument(
+        '--analytic-coverage',
+        action='store_true',
+        help='compare analytic coverage against sampled anti-aliasing',
+    )
+    parser.add_argument(
+        '--roi-box',
+        action='store_true',
+        help='compare the default box region of interest against the full frame',
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    QtCore.QCoreApplication()
+    if args.packed_vertexes:
+        run_packed_vertexes(args.name, args.device)
+    elif args.analytic_coverage:
+        run_analytic_coverage(args.name, args.device)
+    elif args.roi_box:
+        run_roi_box(args.name, args.device)
+    else:
+        run(args.name, args.device)
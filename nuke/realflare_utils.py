@@ -48,6 +48,16 @@ def export_animation(
     height = node.height()
     project['render'] = {'resolution': [(width, height)]}
 
+    # region of interest
+    input_node = node.input(0)
+    if node.knob('use_bbox').value() and input_node is not None:
+        # nuke boxes start at the bottom left, realflare at the top left
+        bbox = input_node.bbox()
+        y = height - (bbox.y() + bbox.h())
+        project['render']['roi'] = ['BOX']
+        project['render']['roi_position'] = [(bbox.x(), y)]
+        project['render']['roi_size'] = [(bbox.w(), bbox.h())]
+
     # flare
     project['flare'] = {}
 
@@ -3,6 +3,7 @@ import logging
 import sys
 
 from realflare import sentry
+from realflare.cli import analyze as cli_analyze
 from realflare.cli import app as cli_app
 from realflare.gui import app as gui_app
 
@@ -45,6 +46,12 @@ def argument_parser() -> argparse.ArgumentParser:
         default='ACES - ACEScg',
         help='output colorspace',
     )
+    parser.add_argument(
+        '--device',
+        type=str,
+        help='device to render on, overrides the device of the project. '
+        'Use NumPy to render on the CPU',
+    )
     parser.add_argument(
         '--frame-start',
         type=int,
@@ -57,6 +64,32 @@ def argument_parser() -> argparse.ArgumentParser:
         default=1,
         help='end frame number',
     )
+    parser.add_argument(
+        '--analyze',
+        action='store_true',
+        help='measure the render time and error of lower settings for the project '
+        'and write a report with recommended settings',
+    )
+    parser.add_argument(
+        '--report',
+        type=str,
+        default='',
+        help='path of the analysis report without extension, a .json and .md file '
+        'are written. Defaults to the project path with an _analysis suffix',
+    )
+    parser.add_argument(
+        '--error-threshold',
+        type=float,
+        default=0.01,
+        help='the relative error of the recommended settings for the analysis',
+    )
+    parser.add_argument(
+        '--time-budget',
+        type=float,
+        default=0,
+        help='the render time in seconds of the recommended settings for the '
+        'analysis, 0 disables the budget',
+    )
     parser.add_argument(
         '--log',
         type=int,
@@ -74,6 +107,11 @@ def main() -> None:
 
     if args.gui:
         gui_app.exec_()
+    elif args.analyze:
+        try:
+            cli_analyze.exec_(args)
+        except Exception as e:
+            parser.error(str(e))
     else:
         try:
             cli_app.exec_(args)
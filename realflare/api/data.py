@@ -29,6 +29,34 @@ class AntiAliasing(enum.Enum):
             return '8x'
 
 
+@enum.unique
+class Binning(enum.Enum):
+    BITMASK = enum.auto()
+    COMPACT = enum.auto()
+    TILE = enum.auto()
+
+
+@enum.unique
+class RegionOfInterest(enum.Enum):
+    FULL = enum.auto()
+    AUTO = enum.auto()
+    BOX = enum.auto()
+
+
+@enum.unique
+class SpectralSampling(enum.Enum):
+    UNIFORM = enum.auto()
+    IMPORTANCE = enum.auto()
+
+
+@enum.unique
+class GhostLayers(enum.Enum):
+    NONE = enum.auto()
+    GHOST = enum.auto()
+    SET = enum.auto()
+    RANK = enum.auto()
+
+
 @enum.unique
 class RenderElement(enum.Enum):
     STARBURST_APERTURE = enum.auto()
@@ -142,6 +170,9 @@ class Flare:
         image_file: str = ''
         image_sample_resolution: int = 256
         image_samples: int = 8
+        image_clustering: bool = False
+        image_convolution: bool = False
+        image_psf_count: int = 5
         show_image: bool = False
 
     @hashable_dataclass
@@ -191,6 +222,9 @@ class Output:
     split_files: bool = True
     write: bool = False
     frame: int = 0
+    ghost_layers: GhostLayers = GhostLayers.NONE
+    ghost_layer_sets: str = ''
+    ghost_layer_count: int = 4
 
 
 @hashable_dataclass
@@ -220,14 +254,32 @@ class Render:
     # renderer
     resolution: QtCore.QSize = deep_field(QtCore.QSize(512, 512))
     bin_size: int = 64
+    binning: Binning = Binning.BITMASK
+    hierarchical_binning: bool = False
+    sort_primitives: bool = False
+    splat_area: float = 0
+    downsample_area: float = 0
+    packed_vertexes: bool = False
+    strip_height: int = 0
+    roi: RegionOfInterest = RegionOfInterest.FULL
+    roi_position: QtCore.QPoint = deep_field(QtCore.QPoint(0, 0))
+    roi_size: QtCore.QSize = deep_field(QtCore.QSize(0, 0))
     anti_aliasing: int = 1
+    analytic_coverage: bool = False
 
     # rays
     wavelength_count: int = 1
     wavelength_sub_count: int = 1
+    spectral_sampling: SpectralSampling = SpectralSampling.UNIFORM
     grid_count: int = 33
     grid_length: float = 50
     cull_percentage: float = 0
+    cull_energy: float = 0
+    cull_per_frame: bool = False
+    fused_raytracing: bool = False
+    temporal_tolerance_enabled: bool = False
+    temporal_tolerance: float = 0.5
+    temporal_keyframe_interval: int = 8
     debug_ghost_enabled: bool = False
     debug_ghost: int = 0
 
@@ -241,6 +293,16 @@ class Render:
     device: str = ''
 
 
+def roi_box(render: Render) -> QtCore.QRect:
+    # returns the box region of interest in image coordinates, an empty box is
+    # the full frame
+    frame = QtCore.QRect(QtCore.QPoint(0, 0), render.resolution)
+    box = QtCore.QRect(render.roi_position, render.roi_size)
+    if box.isEmpty():
+        return frame
+    return box.intersected(frame)
+
+
 @hashable_dataclass
 class Project:
     output: Output = field(default_factory=Output)
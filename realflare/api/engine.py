@@ -11,18 +11,38 @@ import pyopencl as cl
 from PySide2 import QtCore
 from pyopencl import tools
 
-from realflare.api.data import Project, RenderElement, RenderImage, RealflareError
+from realflare.api.data import (
+    GhostLayers,
+    Project,
+    RealflareError,
+    RenderElement,
+    RenderImage,
+)
+from realflare.api.path import File
 from realflare.api.tasks import opencl
 from realflare.api.tasks.aperture import GhostApertureTask, StarburstApertureTask
+from realflare.api.tasks.cpu import (
+    CPURaytracingTask,
+    CPURasterizingTask,
+    CPUPreprocessTask,
+)
 from realflare.api.tasks.diagram import DiagramTask
 from realflare.api.tasks.ghost import GhostTask
-from realflare.api.tasks.opencl import Image
-from realflare.api.tasks.preprocessing import PreprocessTask, ImageSamplingTask
+from realflare.api.tasks.opencl import Image, Buffer
+from realflare.api.tasks.preprocessing import (
+    ImageSamplingTask,
+    PreprocessTask,
+    ghost_layers,
+)
 from realflare.api.tasks.rasterizing import RasterizingTask
-from realflare.api.tasks.raytracing import RaytracingTask, IntersectionsTask
+from realflare.api.tasks.raytracing import (
+    RaytracingTask,
+    IntersectionsTask,
+    VertexesTask,
+)
 from realflare.api.tasks.starburst import StarburstTask
 from realflare.storage import Storage
-from realflare.utils import ocio
+from realflare.utils import exr, ocio
 from realflare.utils.timing import timer
 
 logger = logging.getLogger(__name__)
@@ -40,40 +60,71 @@ class Engine(QtCore.QObject):
         self._elements = []
 
         self.queue = None
+        self.cpu = False
+        self.renderers: dict[RenderElement, Callable] = OrderedDict()
 
     def _init(self, device: str = '') -> None:
         """Initializes the engine. This needs to happen in a different function to
         create all objects in the right thread."""
 
+        # the numpy backend still uses an OpenCL device for the apertures if
+        # there is one available
+        self.cpu = device == opencl.CPU_DEVICE
         try:
-            self.queue = opencl.command_queue(device)
+            self.queue = opencl.command_queue('' if self.cpu else device)
         except (cl.Error, ValueError) as e:
-            logger.error(e)
-            logger.error('failed to start the engine')
-            return
-
-        logger.debug(f'Engine initialized on device: {self.queue.device.name}')
-
-        self.renderers: dict[RenderElement, Callable] = OrderedDict()
-        self.renderers[RenderElement.STARBURST_APERTURE] = self.starburst_aperture
-        self.renderers[RenderElement.GHOST_APERTURE] = self.ghost_aperture
-        self.renderers[RenderElement.STARBURST] = self.starburst
-        self.renderers[RenderElement.GHOST] = self.ghost
+            self.queue = None
+            if not self.cpu:
+                logger.error(e)
+                logger.error('failed to start the engine')
+                return
+            logger.warning(f'{e}, only the flare can be rendered without ghosts')
+
+        if self.queue is not None:
+            logger.debug(f'Engine initialized on device: {self.queue.device.name}')
+        if self.cpu:
+            logger.debug(f'Engine initialized on device: {opencl.CPU_DEVICE}')
+
+        self.renderers = OrderedDict()
+        if self.queue is not None:
+            self.renderers[RenderElement.STARBURST_APERTURE] = self.starburst_aperture
+            self.renderers[RenderElement.GHOST_APERTURE] = self.ghost_aperture
+            self.renderers[RenderElement.STARBURST] = self.starburst
+            self.renderers[RenderElement.GHOST] = self.ghost
         self.renderers[RenderElement.FLARE] = self.flare
-        self.renderers[RenderElement.FLARE_STARBURST] = self.flare_starburst
-        self.renderers[RenderElement.DIAGRAM] = self.diagram
-
-        self.ghost_aperture_task = GhostApertureTask(self.queue)
-        self.starburst_aperture_task = StarburstApertureTask(self.queue)
-        self.ghost_task = GhostTask(self.queue)
-        self.starburst_task = StarburstTask(self.queue)
-        self.intersection_task = IntersectionsTask(self.queue)
-        self.raytracing_task = RaytracingTask(self.queue)
-        self.rasterizing_task = RasterizingTask(self.queue)
-        self.diagram_task = DiagramTask(self.queue)
-        self.preprocess_task = PreprocessTask(self.queue)
+        if self.queue is not None:
+            self.renderers[RenderElement.FLARE_STARBURST] = self.flare_starburst
+            self.renderers[RenderElement.DIAGRAM] = self.diagram
+
+            self.ghost_aperture_task = GhostApertureTask(self.queue)
+            self.starburst_aperture_task = StarburstApertureTask(self.queue)
+            self.ghost_task = GhostTask(self.queue)
+            self.starburst_task = StarburstTask(self.queue)
+            self.intersection_task = IntersectionsTask(self.queue)
+            self.diagram_task = DiagramTask(self.queue)
+
+        if self.cpu:
+            self.raytracing_task = CPURaytracingTask()
+            self.rasterizing_task = CPURasterizingTask()
+            self.preprocess_task = CPUPreprocessTask()
+        else:
+            self.raytracing_task = RaytracingTask(self.queue)
+            self.vertexes_task = VertexesTask(self.queue)
+            self.rasterizing_task = RasterizingTask(self.queue)
+            self.preprocess_task = PreprocessTask(self.queue)
         self.image_sampling_task = ImageSamplingTask(self.queue)
 
+    def clear_task_caches(self) -> None:
+        # clears the cached results of all tasks, so that the next render runs
+        # every stage again
+        for name, task in vars(self).items():
+            if name.endswith('_task'):
+                clear_lru_caches(task)
+
+    @property
+    def context(self) -> cl.Context | None:
+        return self.queue.context if self.queue is not None else None
+
     def elements(self) -> list[RenderElement]:
         return self._elements
 
@@ -95,18 +146,52 @@ class Engine(QtCore.QObject):
         image = self.ghost_task.run(project, aperture)
         return image
 
+    def flare_ghost(self, project: Project) -> Image | None:
+        # without an OpenCL device the flare is rendered without ghost texture
+        if self.queue is None:
+            return None
+        return self.ghost(project)
+
+    def trace(self, project: Project, path_indexes: tuple[int]) -> Buffer | None:
+        # the fused pipeline skips the rays buffer and traces vertexes directly
+        if project.render.fused_raytracing and not self.cpu:
+            return self.vertexes_task.run(project, path_indexes)
+        return self.raytracing_task.run(project, path_indexes)
+
+    def ghost_layers(
+        self, project: Project, path_indexes: tuple[int]
+    ) -> tuple[tuple[str, ...], tuple[int, ...]]:
+        # the layers are only rasterized when the image is written
+        output = project.output
+        if not output.write or output.ghost_layers == GhostLayers.NONE:
+            return (), ()
+        energies = np.zeros(0, np.float32)
+        if output.ghost_layers == GhostLayers.RANK:
+            energies = self.preprocess_task.stats(project)['energy']
+        return ghost_layers(output, path_indexes, energies)
+
+    def ghost_stats(self, project: Project) -> np.ndarray:
+        # returns a structured array with the statistics of all ghosts,
+        # see ghost_report_dtype
+        if not self.renderers:
+            self._init(project.render.device)
+        return self.preprocess_task.report(project)
+
     def image_flare(self, project: Project, path_indexes: tuple[int]) -> Image:
-        ghost = self.ghost(project)
-        sample_data = self.image_sampling_task.run(project)
+        ghost = self.flare_ghost(project)
+        if project.flare.light.image_convolution:
+            return self.image_flare_convolution(project, path_indexes, ghost)
 
         if project.flare.light.show_image:
-            image = Image(self.queue.context, array=sample_data)
+            sample_data = self.image_sampling_task.run(project)
+            image = Image(self.context, array=sample_data)
             image.args = (project.flare.light, project.render.resolution)
             return image
 
-        height, width, channels = sample_data.shape
-        half_width = int(width / 2)
-        half_height = int(height / 2)
+        # the lights are sampled at the sample resolution, clustering does not need
+        # the percentile samples
+        sample_resolution = self.image_sampling_task.sample_resolution(project)
+        width, height = sample_resolution.width(), sample_resolution.height()
 
         image_shape = (
             project.render.resolution.height(),
@@ -117,41 +202,87 @@ class Engine(QtCore.QObject):
 
         args = []
 
-        for y in range(half_height):
-            for x in range(half_width):
-                values = np.float32(
-                    [
-                        sample_data[y, x],
-                        sample_data[height - y - 1, x],
-                        sample_data[height - y - 1, width - x - 1],
-                        sample_data[y, width - x - 1],
-                    ]
-                )
-                if np.sum(values) == 0:
+        positions, lights = self.image_sampling_task.lights(project)
+        for position, values in zip(positions, lights):
+            values = np.float32(values)
+            project.flare.light.position.setX(float(position[0]))
+            project.flare.light.position.setY(float(position[1]))
+
+            rays = self.trace(project, path_indexes)
+            flare = self.rasterizing_task.run(project, rays, ghost)
+
+            args = flare.args
+            flare_array = flare.array.copy()
+            image_array += values[0] * flare_array
+            flare_array = np.flip(flare_array, 0)
+            image_array += values[1] * flare_array
+            flare_array = np.flip(flare_array, 1)
+            image_array += values[2] * flare_array
+            flare_array = np.flip(flare_array, 0)
+            image_array += values[3] * flare_array
+
+        # normalize
+        image_array /= width * height
+
+        image = Image(self.context, array=image_array)
+        image.args = (*args, project.flare.light)
+        return image
+
+    def image_flare_convolution(
+        self, project: Project, path_indexes: tuple[int], ghost: Image | None
+    ) -> Image:
+        # the image is convolved with flares that are rendered at a grid of light
+        # positions. the flares are interpolated bilinearly between the nodes of
+        # the grid, so every node only convolves the part of the image it covers.
+        light = project.flare.light
+        file = File(storage.decode_path(light.image_file))
+        resolution = project.render.resolution
+        light_array = self.image_sampling_task.update_light_image(file, resolution)
+        height, width = light_array.shape[:2]
+
+        if light.show_image:
+            array = np.dstack((light_array, np.zeros((height, width), np.float32)))
+            image = Image(self.context, array=array)
+            image.args = (light, resolution)
+            return image
+
+        image_array = np.zeros((height, width, 4), np.float32)
+        count = max(light.image_psf_count, 1)
+        args = []
+
+        for y, y_weights in psf_nodes(height, count):
+            rows = np.flatnonzero(y_weights)
+            top, bottom = rows[0], rows[-1] + 1
+            for x, x_weights in psf_nodes(width, count):
+                columns = np.flatnonzero(x_weights)
+                left, right = columns[0], columns[-1] + 1
+
+                weights = np.outer(y_weights[top:bottom], x_weights[left:right])
+                tile = light_array[top:bottom, left:right] * weights[..., np.newaxis]
+                if not np.any(tile):
                     continue
 
-                # get position of center of sample
-                project.flare.light.position.setX((x + 0.5) / half_width - 1)
-                project.flare.light.position.setY(1 - (y + 0.5) / half_height)
+                # get position of center of node
+                light.position.setX((x + 0.5) / (width / 2) - 1)
+                light.position.setY(1 - (y + 0.5) / (height / 2))
 
-                rays = self.raytracing_task.run(project, path_indexes)
+                rays = self.trace(project, path_indexes)
                 flare = self.rasterizing_task.run(project, rays, ghost)
-
                 args = flare.args
-                flare_array = flare.array.copy()
-                image_array += values[0] * flare_array
-                flare_array = np.flip(flare_array, 0)
-                image_array += values[1] * flare_array
-                flare_array = np.flip(flare_array, 1)
-                image_array += values[2] * flare_array
-                flare_array = np.flip(flare_array, 0)
-                image_array += values[3] * flare_array
+
+                # the light of the flare lies on the node, which is the pixel
+                # (y - top, x - left) of the tile
+                array = convolve_fft(tile, flare.array[..., :3])
+                y_offset, x_offset = y - top, x - left
+                image_array[..., :3] += array[
+                    y_offset : y_offset + height, x_offset : x_offset + width
+                ]
 
         # normalize
         image_array /= width * height
 
-        image = Image(self.queue.context, array=image_array)
-        image.args = (*args, project.flare.light)
+        image = Image(self.context, array=image_array)
+        image.args = (*args, light)
         return image
 
     def flare(self, project: Project) -> Image:
@@ -163,9 +294,10 @@ class Engine(QtCore.QObject):
 
         # flare
         if not project.flare.light.image_file_enabled:
-            ghost = self.ghost(project)
-            rays = self.raytracing_task.run(project, path_indexes)
-            image = self.rasterizing_task.run(project, rays, ghost)
+            ghost = self.flare_ghost(project)
+            rays = self.trace(project, path_indexes)
+            layers, path_layers = self.ghost_layers(project, path_indexes)
+            image = self.rasterizing_task.run(project, rays, ghost, layers, path_layers)
         else:
             image = self.image_flare(project, path_indexes)
 
@@ -176,14 +308,24 @@ class Engine(QtCore.QObject):
         array = flare.array.copy()
         args = flare.args
 
+        data_window = None
         if project.flare.light.image_file_enabled:
             logger.warning('Starburst is not yet supported for image based flares.')
         else:
             starburst = self.starburst(project)
             array += flare.array + starburst.array
             args += starburst.args
-
-        image = Image(self.queue.context, array=array, args=args)
+            if flare.data_window is not None and starburst.data_window is not None:
+                data_window = flare.data_window.united(starburst.data_window)
+
+        image = Image(self.context, array=array, args=args)
+        image.data_window = data_window
+        image.layers = flare.layers
+        if flare.layers and data_window != flare.data_window:
+            # the layers only cover the data window of the flare
+            frame = QtCore.QRect(QtCore.QPoint(0, 0), project.render.resolution)
+            window = data_window or frame
+            image.layers = expand_layers(flare.layers, flare.data_window, window)
         return image
 
     def diagram(self, project: Project) -> Image:
@@ -194,7 +336,7 @@ class Engine(QtCore.QObject):
 
     @timer
     def render(self, project: Project) -> bool:
-        if self.queue is None:
+        if not self.renderers:
             self._init(project.render.device)
         self.progress_changed.emit(0)
         try:
@@ -210,7 +352,8 @@ class Engine(QtCore.QObject):
             logger.exception(e)
             logger.error(
                 'Render failed. This is most likely because the GPU ran out of memory. '
-                'Consider lowering the settings and restarting the engine.'
+                'Consider lowering the settings or the strip height and restarting the '
+                'engine.'
             )
         except InterruptedError:
             logger.warning('Render interrupted by user')
@@ -253,7 +396,13 @@ class Engine(QtCore.QObject):
             basename = '.'.join(flare_words)
             path = os.path.join(os.path.dirname(filename), basename)
             image = self.flare(project)
-            write_array(image.array, path, project.output.colorspace)
+            write_array(
+                image.array,
+                path,
+                project.output.colorspace,
+                image.data_window,
+                image.layers,
+            )
 
             # starburst
             starburst_words = list(words)
@@ -261,29 +410,115 @@ class Engine(QtCore.QObject):
             basename = '.'.join(starburst_words)
             path = os.path.join(os.path.dirname(filename), basename)
             image = self.starburst(project)
-            write_array(image.array, path, project.output.colorspace)
+            write_array(image.array, path, project.output.colorspace, image.data_window)
 
         else:
-            write_array(image.array, filename, project.output.colorspace)
+            write_array(
+                image.array,
+                filename,
+                project.output.colorspace,
+                image.data_window,
+                image.layers,
+            )
+
+
+def expand_layers(
+    layers: dict[str, np.ndarray], window: QtCore.QRect, data_window: QtCore.QRect
+) -> dict[str, np.ndarray]:
+    # returns the layers of window placed into the larger data_window
+    x, y = window.x() - data_window.x(), window.y() - data_window.y()
+    w, h = window.width(), window.height()
+    expanded = {}
+    for name, layer in layers.items():
+        array = np.zeros((data_window.height(), data_window.width(), 3), np.float32)
+        array[y : y + h, x : x + w] = layer
+        expanded[name] = array
+    return expanded
+
+
+def clear_lru_caches(obj: object) -> None:
+    # clears the lru caches of all methods of obj, also below other decorators
+    for cls in type(obj).__mro__:
+        for attr in vars(cls).values():
+            func = attr
+            while func is not None:
+                if hasattr(func, 'cache_clear'):
+                    func.cache_clear()
+                    break
+                func = getattr(func, '__wrapped__', None)
 
 
 def clear_cache() -> None:
     cl.tools.clear_first_arg_caches()
 
 
-def write_array(array: np.ndarray, filename: str, colorspace: str) -> None:
+def psf_nodes(length: int, count: int) -> list[tuple[int, np.ndarray]]:
+    # returns the pixel of each node of a grid along one axis and the weights of
+    # all pixels for the node. the weights of all nodes sum up to one.
+    if count < 2 or length < 2:
+        return [(length // 2, np.ones(length, np.float32))]
+
+    pixels = [round(i * (length - 1) / (count - 1)) for i in range(count)]
+    coordinates = np.arange(length)
+    nodes = []
+    for i, pixel in enumerate(pixels):
+        weights = np.interp(coordinates, pixels, np.eye(count)[i])
+        nodes.append((pixel, np.float32(weights)))
+    return nodes
+
+
+def convolve_fft(array: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+    # full linear convolution of two images with the same amount of channels
+    shape = (
+        array.shape[0] + kernel.shape[0] - 1,
+        array.shape[1] + kernel.shape[1] - 1,
+    )
+    fft_shape = tuple(cv2.getOptimalDFTSize(size) for size in shape)
+    array_fft = np.fft.rfft2(array, fft_shape, axes=(0, 1))
+    kernel_fft = np.fft.rfft2(kernel, fft_shape, axes=(0, 1))
+    result = np.fft.irfft2(array_fft * kernel_fft, fft_shape, axes=(0, 1))
+    return np.float32(result[: shape[0], : shape[1]])
+
+
+def write_array(
+    array: np.ndarray,
+    filename: str,
+    colorspace: str,
+    data_window: QtCore.QRect | None = None,
+    layers: dict[str, np.ndarray] | None = None,
+) -> None:
+    # layers are rgb arrays of the data window
     array = array.copy()
+    layers = layers or {}
 
     # colorspace
     processor = ocio.colorspace_processor(colorspace)
     if processor:
         processor.applyRGBA(array)
+        layers = {name: layer.copy() for name, layer in layers.items()}
+        for layer in layers.values():
+            processor.applyRGB(layer)
+
+    height, width = array.shape[:2]
+    if data_window == QtCore.QRect(0, 0, width, height):
+        data_window = None
+
+    is_exr = filename.lower().endswith('.exr')
+    if layers and not is_exr:
+        logger.warning('ghost layers are only written to exr files')
 
     try:
         if not os.path.isdir(os.path.dirname(filename)):
             os.makedirs(os.path.dirname(filename))
-        image_bgr = cv2.cvtColor(array, cv2.COLOR_RGBA2BGR)
-        cv2.imwrite(filename, image_bgr)
+        if is_exr and (data_window is not None or layers):
+            # only the data window is stored in the file
+            x, y, w, h = (data_window or QtCore.QRect(0, 0, width, height)).getRect()
+            exr.write(
+                filename, array[y : y + h, x : x + w, :3], width, height, x, y, layers
+            )
+        else:
+            image_bgr = cv2.cvtColor(array, cv2.COLOR_RGBA2BGR)
+            cv2.imwrite(filename, image_bgr)
         logger.info('image written: {}'.format(filename))
     except (OSError, ValueError, cv2.error) as e:
         logger.debug(e)
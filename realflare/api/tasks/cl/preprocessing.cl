@@ -0,0 +1,183 @@
+float covered_bins(
+	const float4 bounds,
+	const float screen_transform,
+	const int2 resolution,
+	const int bin_size,
+	const float subdivisions
+	)
+{
+	// estimated amount of bins overlapped by the primitives of the render grid in a quad.
+	// a quad of size (w, h) in bins holds subdivisions² primitives of the render grid,
+	// each overlaps (w / subdivisions + 1) * (h / subdivisions + 1) bins on average,
+	// which sums up to (w + subdivisions) * (h + subdivisions).
+
+	int4 screen_bounds = bounds_to_screen(bounds, screen_transform, resolution);
+	int4 frame = (int4) (0, 0, resolution - 1);
+	if (!overlaps_rect(screen_bounds, frame)) {
+		return 0;
+	}
+	int2 clipped_min = max(screen_bounds.xy, 0);
+	int2 clipped_max = min(screen_bounds.zw, resolution - 1);
+	float2 size = convert_float2(clipped_max - clipped_min) / bin_size;
+	return (size.x + subdivisions) * (size.y + subdivisions);
+}
+
+__kernel void ghost_stats(
+	__global GhostStats *stats,
+	__global Ray *rays,
+	const int grid_count,
+	const int wavelength_count,
+	const float area_orig,
+	const float min_area,
+	const float aperture_radius,
+	const float2 frame,
+	const float screen_transform,
+	const int2 resolution,
+	const int bin_size,
+	const float subdivisions
+	)
+{
+	// reduces the rays of a ghost to the statistics used for culling and reports.
+	// the energy of a quad is its reflectance times the area it covers on the entrance grid,
+	// the rasterizer spreads this energy over the area of the quad on the sensor.
+	// like in the fragment shader, the rays are interpolated over the quad before
+	// the falloff at the lens housing and the aperture are applied.
+	// the bounds, area and bins are measured in screen space.
+	// one work-group reduces a ghost, its work-items share the rays and quads of all
+	// wavelengths and their partial results are summed in local memory.
+
+	int path_id = get_group_id(0);
+	int local_id = get_local_id(0);
+	int ray_count = grid_count * grid_count;
+	int quad_count = (grid_count - 1) * (grid_count - 1);
+	int path_offset = path_id * wavelength_count * ray_count;
+
+	float energy = 0;
+	float peak = 0;
+	float area_sum = 0;
+	float bins = 0;
+	int valid_count = 0;
+	float4 bounds = (float4) (INFINITY, INFINITY, -INFINITY, -INFINITY);
+
+	for (int index = local_id; index < wavelength_count * ray_count; index += PREPROCESS_GROUP_SIZE) {
+		Ray r = rays[path_offset + index];
+		if (!isnan(r.reflectance)) {
+			bounds.xy = min(bounds.xy, r.pos.xy);
+			bounds.zw = max(bounds.zw, r.pos.xy);
+			valid_count++;
+		}
+	}
+
+	for (int index = local_id; index < wavelength_count * quad_count; index += PREPROCESS_GROUP_SIZE) {
+		int wavelength_id = index / quad_count;
+		int quad_id = index % quad_count;
+		int ray_offset = path_offset + wavelength_id * ray_count;
+		int row = quad_id / (grid_count - 1);
+		int column = quad_id % (grid_count - 1);
+		int corners[4];
+		corners[0] = row * grid_count + column;
+		corners[1] = corners[0] + 1;
+		corners[2] = corners[1] + grid_count;
+		corners[3] = corners[0] + grid_count;
+
+		Ray r[4];
+		float2 pos[4];
+		float corner_reflectance[4];
+		for (int i = 0; i < 4; i++) {
+			r[i] = rays[ray_offset + corners[i]];
+			pos[i] = r[i].pos.xy;
+			corner_reflectance[i] = r[i].reflectance;
+		}
+
+		float2 valid_pos[4];
+		int valid_rays = valid_corners(pos, corner_reflectance, valid_pos);
+		float area = primitive_area(valid_pos, valid_rays);
+		if (area < 0) {
+			continue;
+		}
+		area_sum += area;
+		float4 quad_bounds = primitive_bounds(valid_pos, valid_rays);
+		bins += covered_bins(quad_bounds, screen_transform, resolution, bin_size, subdivisions);
+
+		// an invalid corner of a triangle takes the average of the other corners
+		if (valid_rays == 3) {
+			int invalid = isnan(r[0].reflectance) ? 0 : isnan(r[1].reflectance) ? 1 : isnan(r[2].reflectance) ? 2 : 3;
+			Ray average = r[(invalid + 1) % 4];
+			Ray b = r[(invalid + 2) % 4];
+			Ray c = r[(invalid + 3) % 4];
+			average.pos = (average.pos + b.pos + c.pos) / 3;
+			average.pos_apt = (average.pos_apt + b.pos_apt + c.pos_apt) / 3;
+			average.rrel = (average.rrel + b.rrel + c.rrel) / 3;
+			average.reflectance = (average.reflectance + b.reflectance + c.reflectance) / 3;
+			r[invalid] = average;
+		}
+
+		float reflectance = (r[0].reflectance + r[1].reflectance + r[2].reflectance + r[3].reflectance) / 4;
+		peak = max(peak, reflectance * area_orig / max(area, min_area));
+
+		float transmission = 0;
+		for (int j = 0; j < PREPROCESS_SUB_COUNT; j++) {
+			for (int i = 0; i < PREPROCESS_SUB_COUNT; i++) {
+				float u = (i + 0.5f) / PREPROCESS_SUB_COUNT;
+				float v = (j + 0.5f) / PREPROCESS_SUB_COUNT;
+				float4 weights = (float4) ((1 - u) * (1 - v), u * (1 - v), u * v, (1 - u) * v);
+
+				float2 p = weights.x * r[0].pos.xy + weights.y * r[1].pos.xy + weights.z * r[2].pos.xy + weights.w * r[3].pos.xy;
+				if (fabs(p.x) > frame.x || fabs(p.y) > frame.y) {
+					continue;
+				}
+				float2 uv = weights.x * r[0].pos_apt + weights.y * r[1].pos_apt + weights.z * r[2].pos_apt + weights.w * r[3].pos_apt;
+				if (length(uv) > aperture_radius) {
+					continue;
+				}
+				float rrel = weights.x * r[0].rrel + weights.y * r[1].rrel + weights.z * r[2].rrel + weights.w * r[3].rrel;
+				float coating = weights.x * r[0].reflectance + weights.y * r[1].reflectance + weights.z * r[2].reflectance + weights.w * r[3].reflectance;
+				transmission += smoothstep(1.0f, 0.95f, rrel) * coating;
+			}
+		}
+		energy += transmission / (PREPROCESS_SUB_COUNT * PREPROCESS_SUB_COUNT) * area_orig;
+	}
+
+	local float4 local_sums[PREPROCESS_GROUP_SIZE];
+	local float4 local_bounds[PREPROCESS_GROUP_SIZE];
+	local int local_valid[PREPROCESS_GROUP_SIZE];
+	local_sums[local_id] = (float4) (energy, area_sum, bins, peak);
+	local_bounds[local_id] = bounds;
+	local_valid[local_id] = valid_count;
+	barrier(CLK_LOCAL_MEM_FENCE);
+
+	for (int stride = PREPROCESS_GROUP_SIZE / 2; stride > 0; stride /= 2) {
+		if (local_id < stride) {
+			float4 sums = local_sums[local_id + stride];
+			local_sums[local_id].xyz += sums.xyz;
+			local_sums[local_id].w = max(local_sums[local_id].w, sums.w);
+			float4 other = local_bounds[local_id + stride];
+			local_bounds[local_id].xy = min(local_bounds[local_id].xy, other.xy);
+			local_bounds[local_id].zw = max(local_bounds[local_id].zw, other.zw);
+			local_valid[local_id] += local_valid[local_id + stride];
+		}
+		barrier(CLK_LOCAL_MEM_FENCE);
+	}
+
+	if (local_id != 0) {
+		return;
+	}
+	energy = local_sums[0].x;
+	area_sum = local_sums[0].y;
+	bins = local_sums[0].z;
+	peak = local_sums[0].w;
+	valid_count = local_valid[0];
+
+	float2 half_resolution = convert_float2(resolution) / 2;
+	bounds = local_bounds[0] * screen_transform + (float4) (half_resolution, half_resolution);
+	if (valid_count == 0) {
+		bounds = 0;
+	}
+
+	stats[path_id].energy = energy / wavelength_count;
+	stats[path_id].peak = peak;
+	stats[path_id].bounds = bounds;
+	stats[path_id].area = area_sum / wavelength_count * screen_transform * screen_transform;
+	stats[path_id].valid = (float) valid_count / (wavelength_count * ray_count);
+	stats[path_id].bins = bins / wavelength_count;
+}
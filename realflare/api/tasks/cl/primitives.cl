@@ -0,0 +1,80 @@
+// helpers for the quads of the ray grid, shared by the rasterizer and the preprocessing
+
+float edge_function_float(
+	const float2 a,
+	const float2 b,
+	const float2 c
+	)
+{
+	return (a.x - b.x) * (c.y - a.y) - (a.y - b.y) * (c.x - a.x);
+}
+
+int valid_corners(
+	const float2 *pos,
+	const float *reflectance,
+	float2 *valid_pos
+	)
+{
+	// writes the positions of the corners that are not culled to valid_pos and
+	// returns their amount
+	int valid_rays = 0;
+	for (int i = 0; i < 4; i++) {
+		if (!isnan(reflectance[i])) {
+			valid_pos[valid_rays] = pos[i];
+			valid_rays++;
+		}
+	}
+	return valid_rays;
+}
+
+float primitive_area(
+	const float2 *valid_pos,
+	const int valid_rays
+	)
+{
+	// area of a quad given its valid corners, quads with three valid corners are extrapolated.
+	// returns a negative area for degenerate primitives.
+	if (valid_rays == 4) {
+		// http://www.math.brown.edu/tbanchof/midpoint/selfquad.html
+		float area0 = edge_function_float(valid_pos[0], valid_pos[1], valid_pos[2]);
+		float area1 = edge_function_float(valid_pos[0], valid_pos[2], valid_pos[3]);
+		return fabs(area0 + area1) / 2;
+	} else if (valid_rays == 3) {
+		// extrapolate area to quad
+		return fabs(edge_function_float(valid_pos[0], valid_pos[1], valid_pos[2]));
+	}
+	return -1;
+}
+
+float4 primitive_bounds(
+	const float2 *valid_pos,
+	const int valid_rays
+	)
+{
+	// bounds (x0, y0, x1, y1) of the valid corners of a quad
+	float4 bounds = (float4) (INFINITY, INFINITY, -INFINITY, -INFINITY);
+	for (int i = 0; i < valid_rays; i++) {
+		bounds.xy = min(bounds.xy, valid_pos[i]);
+		bounds.zw = max(bounds.zw, valid_pos[i]);
+	}
+	return bounds;
+}
+
+int4 bounds_to_screen(
+	const float4 bounds,
+	const float screen_transform,
+	const int2 resolution
+	)
+{
+	// converts bounds in sensor space to pixels of the full frame
+	return convert_int4(bounds * screen_transform) + (int4) (resolution, resolution) / 2;
+}
+
+bool overlaps_rect(
+	const int4 a,
+	const int4 b
+	)
+{
+	// https://stackoverflow.com/questions/306316/determine-if-two-rectangles-overlap-each-other
+	return a.x <= b.z && a.z >= b.x && a.y <= b.w && a.w >= b.y;
+}
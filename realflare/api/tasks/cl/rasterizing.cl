@@ -10,15 +10,6 @@ int edge_function_int(
 	return (a.x - b.x) * (c.y - a.y) - (a.y - b.y) * (c.x - a.x);
 }
 
-float edge_function_float(
-	const float2 a,
-	const float2 b,
-	const float2 c
-	)
-{
-	return (a.x - b.x) * (c.y - a.y) - (a.y - b.y) * (c.x - a.x);
-}
-
 bool is_top_left(
 	const int2 a,
 	const int2 b
@@ -230,6 +221,37 @@ int4 quad_vertexes(
 }
 
 
+float shade_primitive(
+	float2 *pos,
+	float *rrel,
+	const float *reflectance,
+	float4 *prim_bounds,
+	bool *outside
+	)
+{
+	// computes the area and bounds of a quad given the positions of its four corners.
+	// returns a negative area for degenerate primitives.
+
+	float2 valid_pos[4];
+	int valid_rays = valid_corners(pos, reflectance, valid_pos);
+	float area = primitive_area(valid_pos, valid_rays);
+	if (area < 0) {
+		// cull degenerate prims
+		return -1;
+	}
+	if (valid_rays == 3) {
+		// simulate quad to keep code simple
+		rrel[3] = rrel[2];
+	}
+
+	// check rrel
+	*outside = rrel[0] > 1 && rrel[1] > 1 && rrel[2] > 1 && rrel[3] > 1;
+
+	*prim_bounds = primitive_bounds(valid_pos, valid_rays);
+
+	return area;
+}
+
 __kernel void prim_shader(
 	__global float4 *bounds,
 	__global float *intensities,
@@ -269,34 +291,23 @@ __kernel void prim_shader(
 		r[3] = rays[ray_offset + quads.w];
 
 		float2 pos[4];
-		int valid_rays = 0;
+		float rrel[4];
+		float reflectance[4];
 		for(int i=0; i < 4; i++) {
-			if (!isnan(r[i].reflectance)) {
-				pos[valid_rays] = r[i].pos.xy;
-				valid_rays++;
-			}
+			pos[i] = r[i].pos.xy;
+			rrel[i] = r[i].rrel;
+			reflectance[i] = r[i].reflectance;
 		}
 
-		float area = 0;
-		if (valid_rays == 4) {
-			// http://www.math.brown.edu/tbanchof/midpoint/selfquad.html
-			float area0 = edge_function_float(pos[0], pos[1], pos[2]);
-			float area1 = edge_function_float(pos[0], pos[2], pos[3]);
-			area = fabs(area0 + area1) / 2;
-		} else if (valid_rays == 3) {
-			// extrapolate area to quad
-			area = fabs(edge_function_float(pos[0], pos[1], pos[2]));
-			// simulate quad to keep code simple
-			pos[3] = pos[2];
-			r[3] = r[2];
-		} else {
+		float4 prim_bounds;
+		bool outside;
+		float area = shade_primitive(pos, rrel, reflectance, &prim_bounds, &outside);
+		if (area < 0) {
 			// cull degenerate prims and don't store area
 			prim_group_bounds.x = NAN;
 			continue;
 		}
-
-		// check rrel
-		if (r[0].rrel > 1 && r[1].rrel > 1 && r[2].rrel > 1 && r[3].rrel > 1) {
+		if (outside) {
 			invalid_rrel++;
 		}
 
@@ -306,9 +317,6 @@ __kernel void prim_shader(
 		intensities[prim_index] = area_actual > 0 ? area_orig / area_actual : 0;
 
 		// store bounds
-		float4 prim_bounds;
-		prim_bounds.xy = min(min(pos[0], pos[1]), min(pos[2], pos[3]));
-		prim_bounds.zw = max(max(pos[0], pos[1]), max(pos[2], pos[3]));
 		prim_group_bounds.xy = min(prim_group_bounds.xy, prim_bounds.xy);
 		prim_group_bounds.zw = max(prim_group_bounds.zw, prim_bounds.zw);
 	}
@@ -319,6 +327,111 @@ __kernel void prim_shader(
 	bounds[bounds_index] = prim_group_bounds;
 }
 
+__kernel void prim_shader_vertexes(
+	__global float4 *bounds,
+	__global float *intensities,
+	__global Vertex *vertexes,
+	const int grid_count,
+	const int ray_count,
+	const int wavelength_count,
+	const float area_orig,
+	const float min_area,
+	const float screen_transform,
+	const int2 resolution
+	)
+{
+	// same as prim_shader but reads the screen space vertexes written by the fused raytracer.
+	// bounds and areas are converted back to sensor space so that the binner stays the same.
+
+	int path_id = get_global_id(0);
+	int path_count = get_global_size(0);
+	int quad_id = get_global_id(1);
+	int quad_count = get_global_size(1);
+
+	int bounds_index = path_id * quad_count + quad_id;
+	float4 prim_group_bounds = (float4) (INFINITY, INFINITY, -INFINITY, -INFINITY);
+	char invalid_rrel = 0;
+	int4 quads = quad_vertexes(grid_count, quad_id);
+	float2 offset = convert_float2(resolution) / 2;
+
+	for (int wavelength_id = 0; wavelength_id < wavelength_count; wavelength_id++) {
+		if (isnan(prim_group_bounds.x)) {
+			continue;
+		}
+
+		int prim_index = (path_id * quad_count + quad_id) * wavelength_count + wavelength_id;
+		int4 vertex_index = (path_id * ray_count + quads) * wavelength_count + wavelength_id;
+
+		Vertex v[4];
+		v[0] = vertexes[vertex_index.x];
+		v[1] = vertexes[vertex_index.y];
+		v[2] = vertexes[vertex_index.z];
+		v[3] = vertexes[vertex_index.w];
+
+		float2 pos[4];
+		float rrel[4];
+		float reflectance[4];
+		for(int i=0; i < 4; i++) {
+			pos[i] = (v[i].pos - offset) / screen_transform;
+			rrel[i] = v[i].rrel;
+			reflectance[i] = v[i].reflectance;
+		}
+
+		float4 prim_bounds;
+		bool outside;
+		float area = shade_primitive(pos, rrel, reflectance, &prim_bounds, &outside);
+		if (area < 0) {
+			prim_group_bounds.x = NAN;
+			continue;
+		}
+		if (outside) {
+			invalid_rrel++;
+		}
+
+		float area_actual = max(area, min_area);
+		intensities[prim_index] = area_actual > 0 ? area_orig / area_actual : 0;
+
+		prim_group_bounds.xy = min(prim_group_bounds.xy, prim_bounds.xy);
+		prim_group_bounds.zw = max(prim_group_bounds.zw, prim_bounds.zw);
+	}
+	if (invalid_rrel == wavelength_count) {
+		prim_group_bounds.x = NAN;
+	}
+	bounds[bounds_index] = prim_group_bounds;
+}
+
+float vertex_intensity(
+	__global float *intensities,
+	const int grid_count,
+	const int path_id,
+	const int ray_id,
+	const int wavelength_id,
+	const int wavelength_count
+	)
+{
+	// averages the intensities of the quads neighboring a vertex
+	int quad_count = (grid_count - 1) * (grid_count - 1);
+	int x = ray_id % grid_count;
+	int y = ray_id / grid_count;
+	// The reason an array is used is to loop through it, a vector can't be looped through
+	int neighbors[4];
+	vstore4(quad_neighbors(grid_count, x, y), 0, &neighbors[0]);
+
+	float intensity = 0;
+	int neighbor_count = 0;
+	for(int i = 0; i < 4; ++i) {
+		if(neighbors[i] < 0 || neighbors[i] >= quad_count) continue;
+
+		int prim_index = (path_id * quad_count + neighbors[i]) * wavelength_count + wavelength_id;
+		if (intensities[prim_index] > 0) {
+			intensity += intensities[prim_index];
+			++neighbor_count;
+		}
+	}
+	intensity /= max(neighbor_count, 1);
+	return intensity;
+}
+
 __kernel void vertex_shader(
 	__global Vertex *vertexes,
 	__global float *intensities,
@@ -335,8 +448,6 @@ __kernel void vertex_shader(
 	int wavelength_id = get_global_id(2);
 	int wavelength_count = get_global_size(2);
 
-	int quad_count = (grid_count - 1) * (grid_count - 1);
-
 	int vertex_index = (path_id * ray_count + ray_id) * wavelength_count + wavelength_id;
 	int ray_index = (path_id * wavelength_count + wavelength_id) * ray_count + ray_id;
 
@@ -350,25 +461,7 @@ __kernel void vertex_shader(
 	// ignore rays that didn't make it to the sensor
 	if (!isnan(r.reflectance)) {
 		// intensity
-		int x = ray_id % grid_count;
-		int y = ray_id / grid_count;
-		// The reason an array is used is to loop through it, a vector can't be looped through
-		int neighbors[4];
-		vstore4(quad_neighbors(grid_count, x, y), 0, &neighbors[0]);
-
-		float intensity = 0;
-		int neighbor_count = 0;
-		for(int i = 0; i < 4; ++i) {
-			if(neighbors[i] < 0 || neighbors[i] >= quad_count) continue;
-
-			int prim_index = (path_id * quad_count + neighbors[i]) * wavelength_count + wavelength_id;
-			if (intensities[prim_index] > 0) {
-				intensity += intensities[prim_index];
-				++neighbor_count;
-			}
-		}
-		intensity /= max(neighbor_count, 1);
-		v.intensity = intensity;
+		v.intensity = vertex_intensity(intensities, grid_count, path_id, ray_id, wavelength_id, wavelength_count);
 
 		// position
 		float2 pos = r.pos.xy * screen_transform + convert_float2(resolution) / 2;
@@ -385,6 +478,134 @@ __kernel void vertex_shader(
 	vertexes[vertex_index] = v;
 }
 
+__kernel void vertex_intensities(
+	__global Vertex *vertexes,
+	__global float *intensities,
+	const int grid_count
+	)
+{
+	// updates the intensities of vertexes written by the fused raytracer in place
+	int path_id = get_global_id(0);
+	int ray_id = get_global_id(1);
+	int ray_count = get_global_size(1);
+	int wavelength_id = get_global_id(2);
+	int wavelength_count = get_global_size(2);
+
+	int vertex_index = (path_id * ray_count + ray_id) * wavelength_count + wavelength_id;
+	if (isnan(vertexes[vertex_index].reflectance)) return;
+
+	vertexes[vertex_index].intensity = vertex_intensity(intensities, grid_count, path_id, ray_id, wavelength_id, wavelength_count);
+}
+
+__kernel void compact_primitives(
+	__global int* chunk_counts,
+	__global int* primitive_ids,
+	__global float4* compact_bounds,
+	__global const int* chunk_offsets,
+	__global const float4* bounds,
+	const int primitive_count,
+	const int scatter
+	)
+{
+	// writes the ids and bounds of the primitives that are not degenerate or culled into
+	// dense lists, so that the binners and the rasterizer only iterate over visible primitives.
+	// each work-item handles a chunk of BATCH_PRIMITIVE_COUNT primitives. like binner_compact,
+	// the kernel runs once to count and once to scatter the primitives, which keeps their order.
+	int chunk_id = get_global_id(0);
+	int start = chunk_id * BATCH_PRIMITIVE_COUNT;
+	int end = min(start + BATCH_PRIMITIVE_COUNT, primitive_count);
+
+	int count = 0;
+	int offset = scatter ? chunk_offsets[chunk_id] : 0;
+	for (int primitive_id = start; primitive_id < end; primitive_id++) {
+		float4 primitive_bounds = bounds[primitive_id];
+		// prim is degenerate
+		if (isnan(primitive_bounds.x)) continue;
+
+		if (scatter) {
+			primitive_ids[offset + count] = primitive_id;
+			compact_bounds[offset + count] = primitive_bounds;
+		}
+		count++;
+	}
+
+	if (!scatter) {
+		chunk_counts[chunk_id] = count;
+	}
+}
+
+uint spread_bits(uint x)
+{
+	// inserts a zero bit between the lower 16 bits of x
+	x &= 0x0000ffff;
+	x = (x | (x << 8)) & 0x00ff00ff;
+	x = (x | (x << 4)) & 0x0f0f0f0f;
+	x = (x | (x << 2)) & 0x33333333;
+	x = (x | (x << 1)) & 0x55555555;
+	return x;
+}
+
+__kernel void morton_keys(
+	__global ulong* keys,
+	__global const float4* bounds,
+	const int primitive_count,
+	const float screen_transform,
+	const int2 resolution
+	)
+{
+	// sort keys of the compacted primitives. the upper 32 bits are the morton code of the center
+	// of the bounds in screen space, the lower 32 bits are the index of the primitive which makes
+	// the keys unique. the keys after primitive_count pad the keys to a power of two.
+	int index = get_global_id(0);
+	if (index >= primitive_count) {
+		keys[index] = ULONG_MAX;
+		return;
+	}
+
+	float4 primitive_bounds = bounds[index];
+	float2 frame = convert_float2(resolution);
+	float2 center = (primitive_bounds.xy + primitive_bounds.zw) / 2 * screen_transform + frame / 2;
+	uint2 cell = convert_uint2(clamp(center / frame, 0.0f, 1.0f) * 0xffff);
+	ulong code = spread_bits(cell.x) | (spread_bits(cell.y) << 1);
+	keys[index] = (code << 32) | (uint) index;
+}
+
+__kernel void bitonic_sort(
+	__global ulong* keys,
+	const int size,
+	const int stride
+	)
+{
+	// one pass of a bitonic sort over a power of two amount of keys.
+	// size is the length of the sequences that are merged, stride the distance of the compared keys.
+	int i = get_global_id(0);
+	int j = i ^ stride;
+	if (j <= i) return;
+
+	ulong a = keys[i];
+	ulong b = keys[j];
+	bool ascending = (i & size) == 0;
+	if ((a > b) == ascending) {
+		keys[i] = b;
+		keys[j] = a;
+	}
+}
+
+__kernel void gather_primitives(
+	__global int* sorted_ids,
+	__global float4* sorted_bounds,
+	__global const ulong* keys,
+	__global const int* primitive_ids,
+	__global const float4* bounds
+	)
+{
+	// reorders the compacted primitives by their sorted keys
+	int i = get_global_id(0);
+	uint index = (uint) keys[i];
+	sorted_ids[i] = primitive_ids[index];
+	sorted_bounds[i] = bounds[index];
+}
+
 __kernel void binner(
 	__global long* bin_queues,
 	const uint2 bin_dims,
@@ -392,7 +613,8 @@ __kernel void binner(
 	__global float4* bounds_buffer,
 	const unsigned int primitive_count,
 	const float screen_transform,
-	const int2 resolution
+	const int2 resolution,
+	const int2 origin
 	)
 {
 	const unsigned int local_id = get_local_id(0);
@@ -446,11 +668,11 @@ __kernel void binner(
 			// prim is degenerate
 			if(isnan(bounds[primitive_counter].x)) continue;
 
-			int4 screen_bounds = convert_int4(bounds[primitive_counter] * screen_transform) + (int4) (resolution, resolution) / 2;
+			int4 screen_bounds = bounds_to_screen(bounds[primitive_counter], screen_transform, resolution);
+			screen_bounds -= (int4) (origin, origin);
 
 			// check if bounds are overlapping bin
-			// https://stackoverflow.com/questions/306316/determine-if-two-rectangles-overlap-each-other
-			if(screen_bounds.x <= bin.z && screen_bounds.z >= bin.x && screen_bounds.y <= bin.w && screen_bounds.w >= bin.y) {
+			if(overlaps_rect(screen_bounds, bin)) {
 				const unsigned int queue_bit = (primitive_counter + 1u) % 8u;
 				const unsigned int queue_byte = (primitive_counter + 1u) / 8u;
 				queue_pointer[queue_byte] |= (1u << queue_bit);
@@ -468,6 +690,143 @@ __kernel void binner(
 	}
 }
 
+int4 bin_rect(
+	const int2 bin_pos,
+	const int bin_size
+	)
+{
+	// screen space rectangle of a bin (x0, y0, x1, y1)
+	int4 bin;
+	bin.xy = bin_pos * bin_size;
+	bin.zw = bin.xy + bin_size;
+	return bin;
+}
+
+bool overlaps_bin(
+	const float4 bounds,
+	const int4 bin,
+	const float screen_transform,
+	const int2 resolution,
+	const int2 origin
+	)
+{
+	// prim is degenerate
+	if (isnan(bounds.x)) return false;
+
+	int4 screen_bounds = bounds_to_screen(bounds, screen_transform, resolution);
+	// bins are relative to the origin of the rendered window
+	screen_bounds -= (int4) (origin, origin);
+
+	// check if bounds are overlapping bin
+	return overlaps_rect(screen_bounds, bin);
+}
+
+__kernel void binner_compact(
+	__global int* bin_counts,
+	__global int* bin_primitives,
+	__global const int* batch_offsets,
+	const uint2 bin_dims,
+	const unsigned int bin_count,
+	__global float4* bounds_buffer,
+	const unsigned int primitive_count,
+	const float screen_transform,
+	const int2 resolution,
+	const int scatter,
+	const int bin_size,
+	const int2 origin,
+	__global const int* primitive_ids
+	)
+{
+	// same batches as the binner, but instead of a bit mask the primitives are counted per bin
+	// and batch. After a prefix sum over the counts on the host, the kernel runs a second time
+	// to scatter the primitive indexes into compacted lists at the batch offsets.
+	// the bounds are compacted, primitive_ids maps them back to the primitives of the vertexes.
+	const unsigned int local_id = get_local_id(0);
+	const unsigned int local_size = get_local_size(0);
+
+	const unsigned int batch_index = get_group_id(0);
+	const unsigned int batch_count = get_num_groups(0);
+
+	local float4 bounds[BATCH_PRIMITIVE_COUNT] __attribute__((aligned(16)));
+
+	const unsigned int primitive_id_offset = batch_index * BATCH_PRIMITIVE_COUNT;
+	const unsigned int batch_primitive_count = min((unsigned int) BATCH_PRIMITIVE_COUNT, primitive_count - primitive_id_offset);
+	event_t event = async_work_group_copy(
+		&bounds[0],
+		(global const float4*)&bounds_buffer[primitive_id_offset],
+		batch_primitive_count, 0);
+	wait_group_events(1, &event);
+
+	const unsigned int max_bin_offset = ceil((float) bin_count / local_size);
+
+	for(unsigned int bin_index_offset = 0; bin_index_offset < max_bin_offset; bin_index_offset++) {
+		const unsigned int bin_index = local_id + (bin_index_offset * local_size);
+		if(bin_index >= bin_count) break;
+
+		int2 bin_pos = (int2)(bin_index % bin_dims.x, bin_index / bin_dims.x);
+		int4 bin = bin_rect(bin_pos, bin_size);
+
+		const size_t batch_offset = bin_index * batch_count + batch_index;
+		int count = 0;
+		int offset = scatter ? batch_offsets[batch_offset] : 0;
+
+		for(unsigned int primitive_counter = 0u; primitive_counter < batch_primitive_count; primitive_counter++) {
+			if (overlaps_bin(bounds[primitive_counter], bin, screen_transform, resolution, origin)) {
+				if (scatter) {
+					bin_primitives[offset + count] = primitive_ids[primitive_id_offset + primitive_counter];
+				}
+				count++;
+			}
+		}
+
+		if (!scatter) {
+			bin_counts[batch_offset] = count;
+		}
+	}
+}
+
+__kernel void binner_fine(
+	__global int* bin_counts,
+	__global int* bin_primitives,
+	__global const int* bin_offsets,
+	__global const int* super_primitives,
+	__global const int* super_offsets,
+	const int super_dims_x,
+	__global float4* bounds,
+	const float screen_transform,
+	const int2 resolution,
+	const int scatter,
+	const int2 origin
+	)
+{
+	// second level of the hierarchical binner. each work-item is a bin and only tests the
+	// primitives of the super bin that contains it. the order of the super bin list is kept.
+	// like binner_compact, the kernel runs once to count and once to scatter the primitives.
+	int2 bin_pos = (int2) (get_global_id(0), get_global_id(1));
+	int bin_index = bin_pos.y * get_global_size(0) + bin_pos.x;
+	int2 super_pos = bin_pos / SUPER_BIN_FACTOR;
+	int super_index = super_pos.y * super_dims_x + super_pos.x;
+	int4 bin = bin_rect(bin_pos, BIN_SIZE);
+
+	int count = 0;
+	int offset = scatter ? bin_offsets[bin_index] : 0;
+
+	int end = super_offsets[super_index + 1];
+	for (int i = super_offsets[super_index]; i < end; i++) {
+		int primitive_id = super_primitives[i];
+		if (overlaps_bin(bounds[primitive_id], bin, screen_transform, resolution, origin)) {
+			if (scatter) {
+				bin_primitives[offset + count] = primitive_id;
+			}
+			count++;
+		}
+	}
+
+	if (!scatter) {
+		bin_counts[bin_index] = count;
+	}
+}
+
 float fragment_shader(
 	const float4 weights,
 	const Vertex v0,
@@ -506,6 +865,28 @@ float fragment_shader(
 }
 
 
+Vertex unpack_vertex(
+	const PackedVertex packed
+	)
+{
+	// the intensity is premultiplied into the reflectance of a packed vertex
+	Vertex v;
+	v.pos = convert_float2(packed.pos) / FIXED_POINT_SCALE;
+	v.uv = vload_half2(0, (const half *) &packed.uv);
+	v.rrel = vload_half(0, (const half *) &packed.rrel);
+	v.reflectance = vload_half(0, (const half *) &packed.reflectance);
+	v.intensity = 1;
+	return v;
+}
+
+#ifdef PACKED_VERTEXES
+#define RasterVertex PackedVertex
+#define load_vertex(vertexes, index) unpack_vertex(vertexes[index])
+#else
+#define RasterVertex Vertex
+#define load_vertex(vertexes, index) vertexes[index]
+#endif
+
 Vertex mix_vertex(
 	const Vertex v1,
 	const Vertex v2,
@@ -521,20 +902,289 @@ Vertex mix_vertex(
 	return v;
 }
 
+int clip_polygon(
+	const float2 *input,
+	const int count,
+	float2 *output,
+	const bool vertical,
+	const float bound,
+	const bool keep_greater
+	)
+{
+	// clips a convex polygon against an axis aligned line (Sutherland-Hodgman)
+	int output_count = 0;
+	for (int i = 0; i < count; i++) {
+		float2 a = input[i];
+		float2 b = input[(i + 1) % count];
+		float da = (vertical ? a.x : a.y) - bound;
+		float db = (vertical ? b.x : b.y) - bound;
+		if (!keep_greater) {
+			da = -da;
+			db = -db;
+		}
+		if (da >= 0) {
+			output[output_count++] = a;
+		}
+		if ((da >= 0) != (db >= 0)) {
+			output[output_count++] = a + (b - a) * (da / (da - db));
+		}
+	}
+	return output_count;
+}
+
+float triangle_coverage(
+	const float2 pixel,
+	const float2 p0,
+	const float2 p1,
+	const float2 p2
+	)
+{
+	// returns the signed area of the triangle inside the pixel square.
+	// a triangle clipped by four lines has at most seven vertexes.
+	float2 a[8];
+	float2 b[8];
+	a[0] = p0;
+	a[1] = p1;
+	a[2] = p2;
+	int count = 3;
+	count = clip_polygon(a, count, b, true, pixel.x, true);
+	count = clip_polygon(b, count, a, true, pixel.x + 1, false);
+	count = clip_polygon(a, count, b, false, pixel.y, true);
+	count = clip_polygon(b, count, a, false, pixel.y + 1, false);
+
+	float area = 0;
+	for (int i = 0; i < count; i++) {
+		float2 c = a[i];
+		float2 d = a[(i + 1) % count];
+		area += c.x * d.y - d.x * c.y;
+	}
+	return area / 2;
+}
+
+float quad_coverage(
+	const float2 pixel,
+	const float2 p0,
+	const float2 p1,
+	const float2 p2,
+	const float2 p3
+	)
+{
+	// returns the area of the quad inside the pixel square at pixel.
+	// the signed areas of the two triangles also add up for concave quads.
+	float2 bounds_min = min(min(p0, p1), min(p2, p3));
+	float2 bounds_max = max(max(p0, p1), max(p2, p3));
+	if (any(bounds_max <= pixel) || any(bounds_min >= pixel + 1)) {
+		return 0;
+	}
+	float area = triangle_coverage(pixel, p0, p1, p2) + triangle_coverage(pixel, p0, p2, p3);
+	return min(fabs(area), 1.0f);
+}
+
+void rasterize_wavelength(
+	float4 *rgba,
+	const Vertex *v_source,
+	const int wavelength_id,
+	const int2 p,
+	const int2 p_center,
+	__read_only image2d_t ghost,
+	__read_only image2d_t light_spectrum,
+	const int wavelength_count,
+	const int wavelength_sub_count,
+	const int sub_steps,
+	const float ghost_scale,
+	const int analytic_coverage
+	)
+{
+	// accumulates the fragments between two wavelengths of a primitive at pixel p
+	// v_source holds the four vertexes of both wavelengths
+	// with analytic_coverage the area of the quad inside the pixel replaces the sub_steps
+	// samples, it is scaled by sub_steps to keep the normalization in write_pixel.
+	float wavelength_sub_step = 1.0f / wavelength_sub_count;
+	float wavelength_step = wavelength_sub_step / wavelength_count;
+
+	sampler_t sampler = CLK_FILTER_LINEAR | CLK_NORMALIZED_COORDS_TRUE | CLK_ADDRESS_CLAMP_TO_EDGE;
+
+	float wavelength_sub_pos = 0;
+	float wavelength_pos = ((float) wavelength_id + 0.5f) / wavelength_count;
+	for (int i = 0; i < wavelength_sub_count; i++) {
+		int2 v_pos[4];
+		Vertex v[4];
+
+		for (int j = 0; j < 4; j++) {
+			v[j] = mix_vertex(v_source[j], v_source[j + 4], wavelength_sub_pos);
+			v_pos[j] = convert_int2(v[j].pos * sub_steps);
+		}
+
+		float hits = 0;
+		if (analytic_coverage) {
+			float2 pixel = convert_float2(p / sub_steps);
+			hits = quad_coverage(pixel, v[0].pos, v[1].pos, v[2].pos, v[3].pos) * sub_steps;
+		} else {
+			for(char s = 0; s < sub_steps; s++) {
+				// offset sample position based on n-rook pattern
+				int2 sample_pos = p + (int2) (s, sub_offsets[sub_steps - 1 + s]);
+				if (intersect_quad(sample_pos, v_pos[0], v_pos[1], v_pos[2], v_pos[3])) {
+					hits++;
+				}
+			}
+		}
+		float fragment = 0;
+		if (hits > 0) {
+			float4 weights = compute_barycentric_quad(p_center, v_pos[0], v_pos[1], v_pos[2], v_pos[3]);
+			fragment += fragment_shader(weights, v[0], v[1], v[2], v[3], ghost, ghost_scale) * hits;
+		}
+
+		if(wavelength_count > 1) {
+			// before optimization:
+			// float wavelength_pos = ((float) wavelength_id + 0.5f + wavelength_sub_pos) / wavelength_count;
+			float3 xyz = read_imagef(light_spectrum, sampler, (float2) (wavelength_pos, 0)).xyz;
+			rgba->xyz += xyz * fragment;
+		} else {
+			rgba->xyz += fragment;
+		}
+
+		wavelength_sub_pos += wavelength_sub_step;
+		wavelength_pos += wavelength_step;
+	}
+}
+
+void rasterize_primitive(
+	float4 *rgba,
+	const int prim_id,
+	const int2 p,
+	const int2 p_center,
+	__read_only image2d_t ghost,
+	__read_only image2d_t light_spectrum,
+	__global RasterVertex *vertexes,
+	const int wavelength_count,
+	const int wavelength_sub_count,
+	const int grid_count,
+	const int sub_steps,
+	const float ghost_scale,
+	const int analytic_coverage
+	)
+{
+	// accumulates the fragments of all wavelengths of a primitive at pixel p
+	int quad_count = (grid_count - 1) * (grid_count - 1);
+	int vertex_count = grid_count * grid_count;
+	int max_wavelength_count = max(wavelength_count - 1, 1);
+
+	int path_id = prim_id / quad_count;
+	int quad_id = prim_id % quad_count;
+
+	int4 quads = quad_vertexes(grid_count, quad_id);
+	// if (quad_id != 1244) continue;
+
+	int4 vertex_index = (path_id * vertex_count + quads) * wavelength_count;
+
+	Vertex v_source[8];
+
+	v_source[4] = load_vertex(vertexes, vertex_index.x);
+	v_source[5] = load_vertex(vertexes, vertex_index.y);
+	v_source[6] = load_vertex(vertexes, vertex_index.z);
+	v_source[7] = load_vertex(vertexes, vertex_index.w);
+	// with a single wavelength both vertex sets are the same
+	if (wavelength_count > 1) {
+		vertex_index++;
+	}
+
+	for (int wavelength_id = 0; wavelength_id < max_wavelength_count; wavelength_id++, vertex_index++) {
+		v_source[0] = v_source[4];
+		v_source[1] = v_source[5];
+		v_source[2] = v_source[6];
+		v_source[3] = v_source[7];
+		v_source[4] = load_vertex(vertexes, vertex_index.x);
+		v_source[5] = load_vertex(vertexes, vertex_index.y);
+		v_source[6] = load_vertex(vertexes, vertex_index.z);
+		v_source[7] = load_vertex(vertexes, vertex_index.w);
+
+		rasterize_wavelength(
+			rgba, v_source, wavelength_id, p, p_center, ghost, light_spectrum,
+			wavelength_count, wavelength_sub_count, sub_steps, ghost_scale, analytic_coverage);
+	}
+}
+
+void write_pixel(
+	__write_only image2d_t image,
+	float4 rgba,
+	const int x,
+	const int y,
+	const int total_samples,
+	const float intensity
+	)
+{
+	if(rgba.x > 0 || rgba.y > 0 || rgba.z > 0) {
+		int2 dims = get_image_dim(image);
+		rgba *= intensity / total_samples;
+		float4 output = xyz_to_ap1(rgba);
+		write_imagef(image, (int2)(x, dims.y - (y + 1)), output);
+	}
+}
+
+void write_layer(
+	__global float *layers,
+	const float4 rgba,
+	const int layer,
+	const int2 pixel,
+	const int2 dims,
+	const int total_samples,
+	const float intensity
+	)
+{
+	// adds the fragments of a layer at pixel to the rgb layers buffer (layer, y, x).
+	// like the image, the layers are flipped in y.
+	if (layer < 0) return;
+	if(rgba.x > 0 || rgba.y > 0 || rgba.z > 0) {
+		float4 output = xyz_to_ap1(rgba * (intensity / total_samples));
+		int index = (layer * dims.y + dims.y - (pixel.y + 1)) * dims.x + pixel.x;
+		vstore3(vload3(index, layers) + output.xyz, index, layers);
+	}
+}
+
+void add_layer_fragment(
+	__global float *layers,
+	float4 *layer_rgba,
+	int *layer,
+	const float4 fragment,
+	const int fragment_layer,
+	const int2 pixel,
+	const int2 dims,
+	const int total_samples,
+	const float intensity
+	)
+{
+	// accumulates the fragment of a primitive into the current layer of a pixel.
+	// each pixel is owned by one work-item so no atomics are needed. the primitives of a
+	// layer are mostly contiguous, the layer is only written when the next primitive
+	// belongs to another layer.
+	if (fragment_layer != *layer) {
+		write_layer(layers, *layer_rgba, *layer, pixel, dims, total_samples, intensity);
+		*layer = fragment_layer;
+		*layer_rgba = (float4) (0, 0, 0, 0);
+	}
+	*layer_rgba += fragment;
+}
+
 __kernel void rasterizer(
 	__write_only image2d_t image,
 	__read_only image2d_t ghost,
 	__read_only image2d_t light_spectrum,
-	__global Vertex *vertexes,
+	__global RasterVertex *vertexes,
 	__global long4* bin_queues,
+	__global const int* primitive_ids,
 	const int batch_count,
-	const int path_count,
+	const int primitive_count,
 	const int wavelength_count,
 	const int wavelength_sub_count,
 	const int grid_count,
 	const int sub_steps,
 	const float intensity,
-	const float ghost_scale
+	const float ghost_scale,
+	const int2 origin,
+	const int analytic_coverage,
+	__global float *layers,
+	__global const int *path_layers,
+	const int layer_count
 )
 {
 	int x = get_global_id(0);
@@ -543,19 +1193,15 @@ __kernel void rasterizer(
 	int2 dims = get_image_dim(image);
 
 	if (x >= dims.x || y >= dims.y) return;
-	int2 p = (int2) (x, y) * sub_steps;
+	// x and y are relative to the origin of the rendered window
+	int2 p = ((int2) (x, y) + origin) * sub_steps;
 	int2 p_center = p + sub_steps / 2;
 
 	int2 bin_dims = (dims + BIN_SIZE - (int2) (1, 1)) / BIN_SIZE;
 	int bin_index = (y / BIN_SIZE) * bin_dims.x + (x / BIN_SIZE);
 	int quad_count = (grid_count - 1) * (grid_count - 1);
-	int vertex_count = grid_count * grid_count;
-	int max_wavelength_count = max(wavelength_count - 1, 1);
 	int total_samples = wavelength_count * sub_steps * wavelength_sub_count;
 
-	float wavelength_sub_step = 1.0f / wavelength_sub_count;
-	float wavelength_step = wavelength_sub_step / wavelength_count;
-
 	// localize bin queues
 	// 1 long4 = 256 bytes
 	// 256 bytes = 1024 prims (quad_count)
@@ -568,7 +1214,8 @@ __kernel void rasterizer(
 	// wait_group_events(1, &event);
 
 	float4 rgba = (float4) (0, 0, 0, 0);
-	sampler_t sampler = CLK_FILTER_LINEAR | CLK_NORMALIZED_COORDS_TRUE | CLK_ADDRESS_CLAMP_TO_EDGE;
+	float4 layer_rgba = (float4) (0, 0, 0, 0);
+	int layer = -1;
 
 	for (int batch_id = 0; batch_id < batch_count; batch_id++) {
 		int offset = bin_index * batch_count + batch_id;
@@ -579,85 +1226,404 @@ __kernel void rasterizer(
 		if ((queue_pointer[0] & 1u) == 0u) continue;
 
 		for (int batch_prim_id = 0; batch_prim_id < BATCH_PRIMITIVE_COUNT; batch_prim_id++) {
-			int prim_id = batch_id * BATCH_PRIMITIVE_COUNT + batch_prim_id;
-			if (prim_id >= quad_count * path_count) continue;
+			int primitive_id = batch_id * BATCH_PRIMITIVE_COUNT + batch_prim_id;
+			if (primitive_id >= primitive_count) continue;
 
 			const unsigned int queue_bit = (batch_prim_id + 1) % 8u;
 			const unsigned int queue_byte = (batch_prim_id + 1) / 8u;
 			const bool is_visible = ((queue_pointer[queue_byte] & (1u << queue_bit)) != 0u);
 			if (!is_visible) continue;
 
+			// the bin queues index the compacted primitives
+			int prim_id = primitive_ids[primitive_id];
+			if (layer_count > 0) {
+				float4 fragment = (float4) (0, 0, 0, 0);
+				rasterize_primitive(
+					&fragment, prim_id, p, p_center, ghost, light_spectrum, vertexes,
+					wavelength_count, wavelength_sub_count, grid_count, sub_steps, ghost_scale, analytic_coverage);
+				rgba += fragment;
+				add_layer_fragment(
+					layers, &layer_rgba, &layer, fragment, path_layers[prim_id / quad_count],
+					(int2) (x, y), dims, total_samples, intensity);
+			} else {
+				rasterize_primitive(
+					&rgba, prim_id, p, p_center, ghost, light_spectrum, vertexes,
+					wavelength_count, wavelength_sub_count, grid_count, sub_steps, ghost_scale, analytic_coverage);
+			}
+		}
+	}
+
+	write_pixel(image, rgba, x, y, total_samples, intensity);
+	write_layer(layers, layer_rgba, layer, (int2) (x, y), dims, total_samples, intensity);
+}
+
+__kernel void rasterizer_compact(
+	__write_only image2d_t image,
+	__read_only image2d_t ghost,
+	__read_only image2d_t light_spectrum,
+	__global RasterVertex *vertexes,
+	__global int *bin_primitives,
+	__global int *bin_offsets,
+	const int wavelength_count,
+	const int wavelength_sub_count,
+	const int grid_count,
+	const int sub_steps,
+	const float intensity,
+	const float ghost_scale,
+	const int2 origin,
+	const int analytic_coverage,
+	__global float *layers,
+	__global const int *path_layers,
+	const int layer_count
+)
+{
+	// same as rasterizer but only iterates over the compacted primitive list of the bin
+	int x = get_global_id(0);
+	int y = get_global_id(1);
+
+	int2 dims = get_image_dim(image);
+
+	if (x >= dims.x || y >= dims.y) return;
+	// x and y are relative to the origin of the rendered window
+	int2 p = ((int2) (x, y) + origin) * sub_steps;
+	int2 p_center = p + sub_steps / 2;
+
+	int2 bin_dims = (dims + BIN_SIZE - (int2) (1, 1)) / BIN_SIZE;
+	int bin_index = (y / BIN_SIZE) * bin_dims.x + (x / BIN_SIZE);
+	int total_samples = wavelength_count * sub_steps * wavelength_sub_count;
+
+	int quad_count = (grid_count - 1) * (grid_count - 1);
+
+	float4 rgba = (float4) (0, 0, 0, 0);
+	float4 layer_rgba = (float4) (0, 0, 0, 0);
+	int layer = -1;
+
+	int end = bin_offsets[bin_index + 1];
+	for (int i = bin_offsets[bin_index]; i < end; i++) {
+		int prim_id = bin_primitives[i];
+		if (layer_count > 0) {
+			float4 fragment = (float4) (0, 0, 0, 0);
+			rasterize_primitive(
+				&fragment, prim_id, p, p_center, ghost, light_spectrum, vertexes,
+				wavelength_count, wavelength_sub_count, grid_count, sub_steps, ghost_scale, analytic_coverage);
+			rgba += fragment;
+			add_layer_fragment(
+				layers, &layer_rgba, &layer, fragment, path_layers[prim_id / quad_count],
+				(int2) (x, y), dims, total_samples, intensity);
+		} else {
+			rasterize_primitive(
+				&rgba, prim_id, p, p_center, ghost, light_spectrum, vertexes,
+				wavelength_count, wavelength_sub_count, grid_count, sub_steps, ghost_scale, analytic_coverage);
+		}
+	}
+
+	write_pixel(image, rgba, x, y, total_samples, intensity);
+	write_layer(layers, layer_rgba, layer, (int2) (x, y), dims, total_samples, intensity);
+}
+
+__kernel void rasterizer_tile(
+	__write_only image2d_t image,
+	__read_only image2d_t ghost,
+	__read_only image2d_t light_spectrum,
+	__global RasterVertex *vertexes,
+	__global int *bin_primitives,
+	__global int *bin_offsets,
+	__local Vertex *local_vertexes,
+	const int local_primitive_count,
+	const int wavelength_count,
+	const int wavelength_sub_count,
+	const int grid_count,
+	const int sub_steps,
+	const float intensity,
+	const float ghost_scale,
+	const int2 origin,
+	const int analytic_coverage,
+	__global float *layers,
+	__global const int *path_layers,
+	const int layer_count
+)
+{
+	// same as rasterizer_compact but one work-group covers one bin.
+	// the vertexes of the primitives in the bin are loaded into local memory in chunks of
+	// local_primitive_count primitives, each work-item then shades TILE_PIXEL_COUNT pixels.
+	// local_vertexes = (primitive, corner, wavelength)
+
+	int2 local_pos = (int2) (get_local_id(0), get_local_id(1));
+	int local_id = local_pos.y * TILE_SIZE + local_pos.x;
+	int local_size = TILE_SIZE * TILE_SIZE;
+
+	int2 dims = get_image_dim(image);
+	int2 bin_pos = (int2) (get_group_id(0), get_group_id(1));
+	int bin_index = bin_pos.y * get_num_groups(0) + bin_pos.x;
+
+	int quad_count = (grid_count - 1) * (grid_count - 1);
+	int vertex_count = grid_count * grid_count;
+	int max_wavelength_count = max(wavelength_count - 1, 1);
+	int total_samples = wavelength_count * sub_steps * wavelength_sub_count;
+	int prim_vertex_count = 4 * wavelength_count;
+
+	float4 rgba[TILE_PIXEL_COUNT];
+	float4 layer_rgba[TILE_PIXEL_COUNT];
+	int layer[TILE_PIXEL_COUNT];
+	for (int j = 0; j < TILE_PIXEL_COUNT; j++) {
+		rgba[j] = (float4) (0, 0, 0, 0);
+		layer_rgba[j] = (float4) (0, 0, 0, 0);
+		layer[j] = -1;
+	}
+
+	int start = bin_offsets[bin_index];
+	int end = bin_offsets[bin_index + 1];
+	for (int offset = start; offset < end; offset += local_primitive_count) {
+		int chunk_count = min(local_primitive_count, end - offset);
+
+		// load the vertexes of the chunk cooperatively
+		barrier(CLK_LOCAL_MEM_FENCE);
+		for (int i = local_id; i < chunk_count * prim_vertex_count; i += local_size) {
+			int prim_id = bin_primitives[offset + i / prim_vertex_count];
+			int corner = (i / wavelength_count) % 4;
+			int wavelength_id = i % wavelength_count;
+
 			int path_id = prim_id / quad_count;
-			int quad_id = prim_id % quad_count;
-
-			int4 quads = quad_vertexes(grid_count, quad_id);
-			// if (quad_id != 1244) continue;
-
-			int4 vertex_index = (path_id * vertex_count + quads) * wavelength_count;
-
-			Vertex v_source[8];
-
-			v_source[4] = vertexes[vertex_index.x];
-			v_source[5] = vertexes[vertex_index.y];
-			v_source[6] = vertexes[vertex_index.z];
-			v_source[7] = vertexes[vertex_index.w];
-			vertex_index++;
-
-			for (int wavelength_id = 0; wavelength_id < max_wavelength_count; wavelength_id++, vertex_index++) {
-				v_source[0] = v_source[4];
-				v_source[1] = v_source[5];
-				v_source[2] = v_source[6];
-				v_source[3] = v_source[7];
-				v_source[4] = vertexes[vertex_index.x];
-				v_source[5] = vertexes[vertex_index.y];
-				v_source[6] = vertexes[vertex_index.z];
-				v_source[7] = vertexes[vertex_index.w];
-
-				float wavelength_sub_pos = 0;
-				float wavelength_pos = ((float) wavelength_id + 0.5f) / wavelength_count;
-				for (int i = 0; i < wavelength_sub_count; i++) {
-					int2 v_pos[4];
-					Vertex v[4];
-
-					for (int j = 0; j < 4; j++) {
-						v[j] = mix_vertex(v_source[j], v_source[j + 4], wavelength_sub_pos);
-						v_pos[j] = convert_int2(v[j].pos * sub_steps);
-					}
+			int quads[4];
+			vstore4(quad_vertexes(grid_count, prim_id % quad_count), 0, &quads[0]);
 
-					size_t hits = 0;
-					for(char s = 0; s < sub_steps; s++) {
-						// offset sample position based on n-rook pattern
-						int2 sample_pos = p + (int2) (s, sub_offsets[sub_steps - 1 + s]);
-						if (intersect_quad(sample_pos, v_pos[0], v_pos[1], v_pos[2], v_pos[3])) {
-							hits++;
-						}
-					}
-					float fragment = 0;
-					if (hits > 0) {
-						float4 weights = compute_barycentric_quad(p_center, v_pos[0], v_pos[1], v_pos[2], v_pos[3]);
-						fragment += fragment_shader(weights, v[0], v[1], v[2], v[3], ghost, ghost_scale) * hits;
+			int vertex_index = (path_id * vertex_count + quads[corner]) * wavelength_count + wavelength_id;
+			local_vertexes[i] = load_vertex(vertexes, vertex_index);
+		}
+		barrier(CLK_LOCAL_MEM_FENCE);
+
+		for (int k = 0; k < chunk_count; k++) {
+			__local Vertex *v = &local_vertexes[k * prim_vertex_count];
+			int prim_layer = layer_count > 0 ? path_layers[bin_primitives[offset + k] / quad_count] : -1;
+
+			for (int j = 0; j < TILE_PIXEL_COUNT; j++) {
+				int2 tile_offset = (int2) (j % TILE_STEPS, j / TILE_STEPS) * TILE_SIZE;
+				int2 pixel = bin_pos * BIN_SIZE + tile_offset + local_pos;
+				if (pixel.x >= dims.x || pixel.y >= dims.y) continue;
+
+				int2 p = (pixel + origin) * sub_steps;
+				int2 p_center = p + sub_steps / 2;
+
+				// with layers the fragments of the primitive are accumulated on their own
+				float4 fragment = (float4) (0, 0, 0, 0);
+				float4 *target = layer_count > 0 ? &fragment : &rgba[j];
+
+				Vertex v_source[8];
+				for (int wavelength_id = 0; wavelength_id < max_wavelength_count; wavelength_id++) {
+					int next_id = min(wavelength_id + 1, wavelength_count - 1);
+					for (int c = 0; c < 4; c++) {
+						v_source[c] = v[c * wavelength_count + wavelength_id];
+						v_source[c + 4] = v[c * wavelength_count + next_id];
 					}
+					rasterize_wavelength(
+						target, v_source, wavelength_id, p, p_center, ghost, light_spectrum,
+						wavelength_count, wavelength_sub_count, sub_steps, ghost_scale, analytic_coverage);
+				}
 
-					if(wavelength_count > 1) {
-						// before optimization:
-						// float wavelength_pos = ((float) wavelength_id + 0.5f + wavelength_sub_pos) / wavelength_count;
-						float3 xyz = read_imagef(light_spectrum, sampler, (float2) (wavelength_pos, 0)).xyz;
-						rgba.xyz += xyz * fragment;
-					} else {
-						rgba.xyz += fragment;
-					}
+				if (layer_count > 0) {
+					rgba[j] += fragment;
+					add_layer_fragment(
+						layers, &layer_rgba[j], &layer[j], fragment, prim_layer, pixel, dims,
+						total_samples, intensity);
+				}
+			}
+		}
+	}
+
+	for (int j = 0; j < TILE_PIXEL_COUNT; j++) {
+		int2 tile_offset = (int2) (j % TILE_STEPS, j / TILE_STEPS) * TILE_SIZE;
+		int2 pixel = bin_pos * BIN_SIZE + tile_offset + local_pos;
+		if (pixel.x >= dims.x || pixel.y >= dims.y) continue;
+
+		write_pixel(image, rgba[j], pixel.x, pixel.y, total_samples, intensity);
+		write_layer(layers, layer_rgba[j], layer[j], pixel, dims, total_samples, intensity);
+	}
+}
+
+void atomic_add_float(
+	volatile __global float *address,
+	const float value
+	)
+{
+	// opencl 1.2 has no atomic add for floats, emulate it with compare and exchange
+	union {unsigned int u; float f;} old_value, new_value;
+	do {
+		old_value.f = *address;
+		new_value.f = old_value.f + value;
+	} while (atomic_cmpxchg((volatile __global unsigned int *) address, old_value.u, new_value.u) != old_value.u);
+}
+
+void splat_point(
+	__global float4 *accumulation,
+	const float2 pos,
+	const float3 xyz,
+	const int2 dims
+	)
+{
+	// distributes the energy bilinearly to the four pixels around pos
+	float2 f = pos - 0.5f;
+	float2 p0 = floor(f);
+	float2 t = f - p0;
+	int2 base = convert_int2(p0);
+
+	for (int i = 0; i < 4; i++) {
+		int2 offset = (int2) (i % 2, i / 2);
+		int2 pixel = base + offset;
+		if (pixel.x < 0 || pixel.y < 0 || pixel.x >= dims.x || pixel.y >= dims.y) continue;
+
+		float2 w2 = select(1.0f - t, t, offset == 1);
+		float weight = w2.x * w2.y;
+		if (weight == 0) continue;
+
+		// the image is flipped in y
+		int index = (dims.y - (pixel.y + 1)) * dims.x + pixel.x;
+		volatile __global float *rgba = (volatile __global float *) &accumulation[index];
+		atomic_add_float(&rgba[0], xyz.x * weight);
+		atomic_add_float(&rgba[1], xyz.y * weight);
+		atomic_add_float(&rgba[2], xyz.z * weight);
+	}
+}
+
+__kernel void splatter(
+	__global float4 *accumulation,
+	__read_only image2d_t ghost,
+	__read_only image2d_t light_spectrum,
+	__global RasterVertex *vertexes,
+	__global int *splat_paths,
+	const int wavelength_count,
+	const int wavelength_sub_count,
+	const int grid_count,
+	const int sub_steps,
+	const float ghost_scale,
+	const int2 origin,
+	const int2 dims
+	)
+{
+	// scatters the energy of a primitive to its centroid instead of testing its coverage per pixel.
+	// for primitives smaller than a pixel this gives the same energy at a fraction of the cost.
+	// the energy of a sub wavelength is the shaded center of the quad times the amount of samples
+	// that the rasterizer would have counted, which is its area in pixels times sub_steps.
+	// quads with rays that didn't make it to the sensor have a nan fragment and are skipped.
+	int path_id = splat_paths[get_global_id(0)];
+	int quad_id = get_global_id(1);
+	int quad_count = get_global_size(1);
+	int vertex_count = grid_count * grid_count;
+	int max_wavelength_count = max(wavelength_count - 1, 1);
+
+	int4 quads = quad_vertexes(grid_count, quad_id);
+	int4 vertex_index = (path_id * vertex_count + quads) * wavelength_count;
+
+	float wavelength_sub_step = 1.0f / wavelength_sub_count;
+	float wavelength_step = wavelength_sub_step / wavelength_count;
+	float4 weights = (float4) (0.25f, 0.25f, 0.25f, 0.25f);
+	float2 offset = convert_float2(origin);
+	sampler_t sampler = CLK_FILTER_LINEAR | CLK_NORMALIZED_COORDS_TRUE | CLK_ADDRESS_CLAMP_TO_EDGE;
+
+	for (int wavelength_id = 0; wavelength_id < max_wavelength_count; wavelength_id++) {
+		int next_id = min(wavelength_id + 1, wavelength_count - 1);
+		Vertex v_source[8];
+		v_source[0] = load_vertex(vertexes, vertex_index.x + wavelength_id);
+		v_source[1] = load_vertex(vertexes, vertex_index.y + wavelength_id);
+		v_source[2] = load_vertex(vertexes, vertex_index.z + wavelength_id);
+		v_source[3] = load_vertex(vertexes, vertex_index.w + wavelength_id);
+		v_source[4] = load_vertex(vertexes, vertex_index.x + next_id);
+		v_source[5] = load_vertex(vertexes, vertex_index.y + next_id);
+		v_source[6] = load_vertex(vertexes, vertex_index.z + next_id);
+		v_source[7] = load_vertex(vertexes, vertex_index.w + next_id);
+
+		float wavelength_sub_pos = 0;
+		float wavelength_pos = ((float) wavelength_id + 0.5f) / wavelength_count;
+		for (int i = 0; i < wavelength_sub_count; i++) {
+			Vertex v[4];
+			for (int j = 0; j < 4; j++) {
+				v[j] = mix_vertex(v_source[j], v_source[j + 4], wavelength_sub_pos);
+			}
+
+			float area0 = edge_function_float(v[0].pos, v[1].pos, v[2].pos);
+			float area1 = edge_function_float(v[0].pos, v[2].pos, v[3].pos);
+			float area = fabs(area0 + area1) / 2;
+			float fragment = fragment_shader(weights, v[0], v[1], v[2], v[3], ghost, ghost_scale);
+			fragment *= area * sub_steps;
 
-					wavelength_sub_pos += wavelength_sub_step;
-					wavelength_pos += wavelength_step;
+			if (!isnan(fragment) && fragment > 0) {
+				float3 xyz = (float3) (fragment, fragment, fragment);
+				if (wavelength_count > 1) {
+					xyz *= read_imagef(light_spectrum, sampler, (float2) (wavelength_pos, 0)).xyz;
 				}
+				float2 center = (v[0].pos + v[1].pos + v[2].pos + v[3].pos) / 4;
+				splat_point(accumulation, center - offset, xyz, dims);
 			}
+
+			wavelength_sub_pos += wavelength_sub_step;
+			wavelength_pos += wavelength_step;
 		}
 	}
+}
 
+__kernel void splat_resolve(
+	__global float4 *output,
+	__global const float4 *accumulation,
+	const int total_samples,
+	const float intensity
+	)
+{
+	// converts the accumulated energy the same way as write_pixel and adds it to output
+	int index = get_global_id(0);
+	float4 rgba = accumulation[index];
 	if(rgba.x > 0 || rgba.y > 0 || rgba.z > 0) {
 		rgba *= intensity / total_samples;
-		y = dims.y - (y + 1);
-		float4 output = xyz_to_ap1(rgba);
-		write_imagef(image, (int2)(x, y), output);
+		output[index] += xyz_to_ap1(rgba);
 	}
 }
+
+__kernel void scale_vertexes(
+	__global Vertex *output,
+	__global Vertex *vertexes,
+	const float scale
+	)
+{
+	// copies the vertexes for an image that is scale times smaller
+	int index = get_global_id(0);
+	Vertex v = vertexes[index];
+	v.pos /= scale;
+	output[index] = v;
+}
+
+__kernel void pack_vertexes(
+	__global PackedVertex *output,
+	__global Vertex *vertexes
+	)
+{
+	// packs the vertexes for the rasterizer into fixed point screen positions and half
+	// precision attributes. rays that didn't make it to the sensor keep a nan reflectance.
+	int index = get_global_id(0);
+	Vertex v = vertexes[index];
+
+	PackedVertex packed;
+	packed.pos = convert_int2_sat_rte(v.pos * FIXED_POINT_SCALE);
+	vstore_half2_rte(v.uv, 0, (half *) &packed.uv);
+	vstore_half_rte(v.rrel, 0, (half *) &packed.rrel);
+	vstore_half_rte(v.reflectance * v.intensity, 0, (half *) &packed.reflectance);
+	output[index] = packed;
+}
+
+__kernel void upsample_level(
+	__global float4 *output,
+	__read_only image2d_t source,
+	const int2 resolution,
+	const int2 origin
+	)
+{
+	// bilinearly upsamples a lower resolution level of the full frame and adds it to the window
+	// at origin. resolution is the full frame resolution, output is stored in image order.
+	int x = get_global_id(0);
+	int y = get_global_id(1);
+	int2 dims = (int2) (get_global_size(0), get_global_size(1));
+
+	// the images are flipped in y, origin is in screen space
+	int screen_y = dims.y - (y + 1) + origin.y;
+	float2 pos = (float2) (x + origin.x, resolution.y - (screen_y + 1)) + 0.5f;
+
+	sampler_t sampler = CLK_FILTER_LINEAR | CLK_NORMALIZED_COORDS_TRUE | CLK_ADDRESS_CLAMP_TO_EDGE;
+	output[y * dims.x + x] += read_imagef(source, sampler, pos / convert_float2(resolution));
+}
@@ -120,6 +120,41 @@ float dispersion(
 }
 
 
+float surface_reflectance(
+	const float theta,
+	const float wavelength,
+	const float n1,
+	const float n2,
+	const int coating,
+	const float coating_min_ior
+	)
+{
+	if (coating > 0) {
+		// coating
+		// lowest achievable refractive index (MgF2): 1.38
+		// https://en.wikipedia.org/wiki/Anti-reflective_coating#Single-layer_interference
+		// However there are better coatings available with refractive indexes as low as 1.12
+		// refractive index of the coating
+
+		// the wavelength that the coating is optimized for in vacuum
+		float lambda = coating;
+
+		// the optimal coating ior is sqrt(n), with two mediums sqrt(n1 * n2)
+		float nc = max(sqrt(n1 * n2), coating_min_ior);
+
+		// the optimal effective thickness of the coating
+		// https://en.wikipedia.org/wiki/Anti-reflective_coating#Interference_coatings
+		float d1 = lambda / (4.0f * nc);
+
+		// anti reflective coating
+		// Supplemental Material — Physically-Based Real-Time Lens Flare Rendering
+		return fresnel_ar(theta, wavelength, d1, n1, nc, n2);
+	} else {
+		return fresnel(theta, n1, n2);
+	}
+}
+
+
 Intersection intersect(
 	const Ray ray,
 	const LensElement lens
@@ -179,11 +214,10 @@ Ray init_ray(
 	const LensElement lens,
 	const int grid_count,
 	const float grid_length,
-	const float4 initial_direction
+	const float4 initial_direction,
+	const int ray_id
 )
 {
-	int ray_id = get_global_id(2);
-
 	// get grid point position
 	int y = trunc((float) ray_id / grid_count);
 	int x = ray_id - (y * grid_count);
@@ -216,11 +250,16 @@ Ray init_ray(
 
 
 __kernel void raytrace(
+#if defined(EMIT_VERTEXES)
+	__global Vertex *vertexes,
+#else
 	__global Ray *rays,
+#endif
 	__constant LensElement *lens_elements,
 	const int lenses_count,
 	__constant int2 *paths,
 	__constant int *wavelengths,
+	const int wavelength_count,
 	const int aperture_index,
 	const float coating_min_ior,
 	const int grid_count,
@@ -228,14 +267,18 @@ __kernel void raytrace(
 	const float4 direction
 #if defined(STORE_INTERSECTIONS)
 	, __global Intersection *intersections,
-	const int intersections_count
+	const int intersections_count,
+	const int column
+#endif
+#if defined(EMIT_VERTEXES)
+	, const float screen_transform,
+	const int2 resolution
 #endif
 	)
 {
 	int path_id = get_global_id(0);
 	int path_count = get_global_size(0);
 	int wavelength_id = get_global_id(1);
-	int wavelength_count = get_global_size(1);
 	int ray_id = get_global_id(2);
 	int ray_count = get_global_size(2);
 
@@ -244,8 +287,16 @@ __kernel void raytrace(
 	int2 path = paths[path_id];
 	float wavelength = (float) wavelengths[wavelength_id];
 
+	// index of the ray on the grid
+#if defined(STORE_INTERSECTIONS)
+	// only the rays of one column are traced for intersections
+	int grid_ray_id = ray_id * grid_count + column;
+#else
+	int grid_ray_id = ray_id;
+#endif
+
 	// initialize ray
-	Ray ray = init_ray(lens_elements[0], grid_count, grid_length, direction);
+	Ray ray = init_ray(lens_elements[0], grid_count, grid_length, direction, grid_ray_id);
 
 	// step increases everytime a ray bounces, there are always 3 steps
 	int step = 0;
@@ -254,6 +305,15 @@ __kernel void raytrace(
 
 	bool disperse = !isnan(lens_elements[0].coefficients.x);
 
+	// without dispersion the geometry is the same for all wavelengths. The kernel
+	// is then enqueued for one wavelength and only the reflectance of the bounces
+	// is evaluated for each wavelength.
+	bool broadcast = get_global_size(1) < wavelength_count;
+	float bounce_theta[2];
+	float bounce_n1[2];
+	float bounce_n2[2];
+	int bounce_coating[2];
+
 	size_t lens_id;
 	for (lens_id = 0; lens_id < lenses_count; inter_id++, lens_id += delta)
 	{
@@ -311,33 +371,15 @@ __kernel void raytrace(
 			// prevent divide by 0 errors
 			float theta = inter.incident + 1e-9;
 
-			float reflectance;
-
-			if (lens_element.coating > 0) {
-				// coating
-				// lowest achievable refractive index (MgF2): 1.38
-				// https://en.wikipedia.org/wiki/Anti-reflective_coating#Single-layer_interference
-				// However there are better coatings available with refractive indexes as low as 1.12
-				// refractive index of the coating
-
-				// the wavelength that the coating is optimized for in vacuum
-				float lambda = lens_element.coating;
-
-				// the optimal coating ior is sqrt(n), with two mediums sqrt(n1 * n2)
-				float nc = max(sqrt(n1 * n2), coating_min_ior);
-
-				// the optimal effective thickness of the coating
-				// https://en.wikipedia.org/wiki/Anti-reflective_coating#Interference_coatings
-				float d1 = lambda / (4.0f * nc);
-
-				// anti reflective coating
-				// Supplemental Material — Physically-Based Real-Time Lens Flare Rendering
-				reflectance = fresnel_ar(theta, wavelength, d1, n1, nc, n2);
-			} else {
-				reflectance = fresnel(theta, n1, n2);
+			if (broadcast) {
+				bounce_theta[step - 1] = theta;
+				bounce_n1[step - 1] = n1;
+				bounce_n2[step - 1] = n2;
+				bounce_coating[step - 1] = lens_element.coating;
 			}
 
-
+			float reflectance = surface_reflectance(
+				theta, wavelength, n1, n2, lens_element.coating, coating_min_ior);
 			if (reflectance > 0) {
 				ray.reflectance *= reflectance;
 			}
@@ -355,5 +397,51 @@ __kernel void raytrace(
 	if (lens_id < lenses_count) {
 		ray.reflectance = NAN;
 	}
-	rays[ray_index] = ray;
+
+	int write_count = broadcast ? wavelength_count : 1;
+	for (int i = 0; i < write_count; i++) {
+		int write_id = broadcast ? i : wavelength_id;
+
+		Ray r = ray;
+		if (broadcast && !isnan(ray.reflectance)) {
+			r.reflectance = 1.0f;
+			for (int b = 0; b < step; b++) {
+				float reflectance = surface_reflectance(
+					bounce_theta[b], (float) wavelengths[write_id], bounce_n1[b],
+					bounce_n2[b], bounce_coating[b], coating_min_ior);
+				if (reflectance > 0) {
+					r.reflectance *= reflectance;
+				}
+			}
+		}
+
+#if defined(EMIT_VERTEXES)
+		// write screen space vertexes directly, vertexes = (path, ray, wavelength)
+		// intensities are added in a separate pass once the primitive areas are known
+		int vertex_index = (path_id * ray_count + ray_id) * wavelength_count + write_id;
+		Vertex v;
+		v.pos = r.pos.xy * screen_transform + convert_float2(resolution) / 2;
+		v.uv = r.pos_apt;
+		v.rrel = r.rrel;
+		v.reflectance = r.reflectance;
+		v.intensity = 0;
+		vertexes[vertex_index] = v;
+#else
+		rays[(path_id * wavelength_count + write_id) * ray_count + ray_id] = r;
+#endif
+	}
+}
+
+
+__kernel void extrapolate(
+	__global float *output,
+	__global float *previous,
+	__global float *current,
+	const float t
+	)
+{
+	// linear extrapolation of traced data for temporal reuse
+	// invalid rays (NAN) in either frame stay invalid
+	int i = get_global_id(0);
+	output[i] = current[i] + (current[i] - previous[i]) * t;
 }
@@ -9,14 +9,16 @@ __kernel void starburst(
     const float2 vignetting,
     const float intensity,
     const float2 offset,
-    const float2 size
+    const float2 size,
+    const int2 origin,
+    const int2 dims
 )
 {
-
-    int2 dims = get_image_dim(image);
-    int2 p;
-    p.x = get_global_id(0);
-    p.y = get_global_id(1);
+    // the image only holds the window of the frame at origin
+    int2 p_image;
+    p_image.x = get_global_id(0);
+    p_image.y = get_global_id(1);
+    int2 p = p_image + origin;
 
 	// dx, dy are coordinates in uv space with a randomized blur offset
 	float2 ndc = convert_ndc(p, dims);
@@ -83,5 +85,5 @@ __kernel void starburst(
 	rgba *= intensity;
 
 	float4 output = xyz_to_ap1(rgba);
-    write_imagef(image, p, output);
+    write_imagef(image, p_image, output);
 }
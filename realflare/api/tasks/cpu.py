@@ -0,0 +1,1075 @@
+from __future__ import annotations
+
+import logging
+from functools import lru_cache
+
+import numpy as np
+from PySide2 import QtCore
+
+from realflare.api.data import (
+    Binning,
+    LensModel,
+    RegionOfInterest,
+    Render,
+    SpectralSampling,
+)
+from realflare.api.tasks.opencl import (
+    OpenCL,
+    ray_dtype,
+    vertex_dtype,
+    lens_element_dtype,
+    ghost_stats_dtype,
+    Buffer,
+    Image,
+)
+from realflare.api.tasks.preprocessing import PreprocessTask, SUB_COUNT
+from realflare.api.tasks.rasterizing import RasterizingTask, SUB_OFFSETS, quad_vertexes
+from realflare.api.tasks.raytracing import RaytracingTask, trace_shape
+from realflare.utils.timing import timer
+
+logger = logging.getLogger(__name__)
+
+# maximum amount of pixel samples evaluated at once by the rasterizer
+CHUNK_SIZE = 2**22
+
+# https://github.com/ampas/aces-dev/blob/master/transforms/ctl/README-MATRIX.md
+XYZ_TO_AP1 = np.array(
+    [
+        [1.6410233797, -0.3248032942, -0.2364246952],
+        [-0.6636628587, 1.6153315917, 0.0167563477],
+        [0.0117218943, -0.0082844420, 0.9883948585],
+    ],
+    np.float32,
+)
+
+
+def unsupported_options(render: Render) -> tuple[str, ...]:
+    # returns the render options that are enabled but ignored by the NumPy device,
+    # it always rasterizes the full frame at once with sampled coverage
+    options = {
+        'binning': render.binning != Binning.BITMASK,
+        'hierarchical_binning': render.hierarchical_binning,
+        'sort_primitives': render.sort_primitives,
+        'splat_area': render.splat_area > 0,
+        'downsample_area': render.downsample_area > 0,
+        'packed_vertexes': render.packed_vertexes,
+        'strip_height': render.strip_height > 0,
+        'roi': render.roi != RegionOfInterest.FULL,
+        'analytic_coverage': render.analytic_coverage,
+        'fused_raytracing': render.fused_raytracing,
+    }
+    return tuple(name for name, enabled in options.items() if enabled)
+
+
+# The functions below mirror the functions in raytracing.cl and rasterizing.cl.
+# They operate on arrays where the last axis holds the vector components.
+
+
+def dot(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return np.sum(a * b, axis=-1)
+
+
+def length(a: np.ndarray) -> np.ndarray:
+    return np.sqrt(dot(a, a))
+
+
+def normalize(a: np.ndarray) -> np.ndarray:
+    return a / length(a)[..., np.newaxis]
+
+
+def fresnel(theta0: np.ndarray, n1: np.ndarray, n2: np.ndarray) -> np.ndarray:
+    theta1 = np.arcsin(np.sin(theta0) * n1 / n2)
+    cosi = np.cos(theta0)
+    cost = np.cos(theta1)
+    rs = ((n1 * cosi) - (n2 * cost)) / ((n1 * cosi) + (n2 * cost))
+    rp = ((n1 * cost) - (n2 * cosi)) / ((n1 * cost) + (n2 * cosi))
+    return (rs * rs + rp * rp) / 2
+
+
+def fresnel_ar(
+    theta0: np.ndarray,
+    lambda_: np.ndarray,
+    d1: np.ndarray,
+    n0: np.ndarray,
+    n1: np.ndarray,
+    n2: np.ndarray,
+) -> np.ndarray:
+    # [Ritschel et al. 2009] Supplemental Material - Anti-reflective Coating
+    theta1 = np.arcsin(np.sin(theta0) * n0 / n1)
+    theta2 = np.arcsin(np.sin(theta0) * n0 / n2)
+
+    rs01 = -np.sin(theta0 - theta1) / np.sin(theta0 + theta1)
+    rp01 = np.tan(theta0 - theta1) / np.tan(theta0 + theta1)
+    ts01 = 2 * np.sin(theta1) * np.cos(theta0) / np.sin(theta0 + theta1)
+    tp01 = ts01 * np.cos(theta0 - theta1)
+
+    rs12 = -np.sin(theta1 - theta2) / np.sin(theta1 + theta2)
+    rp12 = np.tan(theta1 - theta2) / np.tan(theta1 + theta2)
+
+    ris = ts01 * ts01 * rs12
+    rip = tp01 * tp01 * rp12
+
+    dy = d1 * n1
+    dx = np.tan(theta1) * dy
+    delay = np.sqrt(dx * dx + dy * dy)
+    rel_phase = np.float32(4 * np.pi) / lambda_ * (delay - dx * np.sin(theta0))
+
+    out_s2 = rs01 * rs01 + ris * ris + 2 * rs01 * ris * np.cos(rel_phase)
+    out_p2 = rp01 * rp01 + rip * rip + 2 * rp01 * rip * np.cos(rel_phase)
+    return (out_s2 + out_p2) / 2
+
+
+def refract(i: np.ndarray, n: np.ndarray, o: np.ndarray) -> np.ndarray:
+    cost = dot(-i, n)
+    sint2 = (o * o) * (1 - cost * cost)
+    t = (o[:, np.newaxis] * i) + (o * cost - np.sqrt(np.abs(1 - sint2)))[
+        :, np.newaxis
+    ] * n
+    return t * (sint2 < 1)[:, np.newaxis]
+
+
+def reflect(i: np.ndarray, n: np.ndarray) -> np.ndarray:
+    return i + 2 * dot(n, -i)[:, np.newaxis] * n
+
+
+def dispersion(lambda_: np.ndarray, coefficients: np.ndarray) -> np.ndarray:
+    # https://en.wikipedia.org/wiki/Sellmeier_equation
+    l2 = (lambda_ * np.float32(1e-3)) ** 2
+    d0 = (coefficients[:, 0] * l2) / (l2 - coefficients[:, 1])
+    d1 = (coefficients[:, 2] * l2) / (l2 - coefficients[:, 3])
+    d2 = (coefficients[:, 4] * l2) / (l2 - coefficients[:, 5])
+    return np.sqrt(1 + d0 + d1 + d2)
+
+
+def surface_reflectance(
+    theta: np.ndarray,
+    wavelength: np.ndarray,
+    n1: np.ndarray,
+    n2: np.ndarray,
+    coating: np.ndarray,
+    coating_min_ior: float,
+) -> np.ndarray:
+    lambda_ = np.float32(coating)
+    nc = np.maximum(np.sqrt(n1 * n2), np.float32(coating_min_ior))
+    d1 = lambda_ / (4 * nc)
+    return np.where(
+        coating > 0,
+        fresnel_ar(theta, wavelength, d1, n1, nc, n2),
+        fresnel(theta, n1, n2),
+    )
+
+
+def intersect(
+    pos: np.ndarray, direction: np.ndarray, radius: np.ndarray, center: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # returns position, normal, incident angle and hit mask of ray intersections
+    count = len(pos)
+    hit = direction[:, 2] != 0
+
+    # flat intersection
+    dz = -center - pos[:, 2]
+    flat_pos = pos + direction * (dz / direction[:, 2])[:, np.newaxis]
+    flat_normal = np.zeros((count, 3), np.float32)
+    flat_normal[:, 2] = np.where(direction[:, 2] < 0, 1, -1)
+
+    # spherical intersection
+    r = np.abs(radius)
+    c = np.zeros((count, 3), np.float32)
+    c[:, 2] = -center
+    u = c - pos
+    u1 = dot(u, direction)[:, np.newaxis] * direction
+    d = length(u - u1)
+    sgn = np.where(radius * direction[:, 2] > 0, -1, 1).astype(np.float32)
+    m = np.sqrt(r * r - d * d)
+    sphere_pos = pos + u1 - (m * sgn)[:, np.newaxis] * direction
+    sphere_normal = normalize(sphere_pos - c) * sgn[:, np.newaxis]
+    incident = np.arccos(np.clip(dot(-direction, sphere_normal), -1, 1))
+
+    flat = (radius == 0)[:, np.newaxis]
+    hit &= (radius == 0) | ~(d > r)
+    inter_pos = np.where(flat, flat_pos, sphere_pos)
+    inter_normal = np.where(flat, flat_normal, sphere_normal)
+    incident = np.where(radius == 0, 0, incident).astype(np.float32)
+    return inter_pos, inter_normal, incident, hit
+
+
+def smoothstep(edge0: float, edge1: float, x: np.ndarray) -> np.ndarray:
+    t = np.clip((x - edge0) / (edge1 - edge0), 0, 1)
+    return t * t * (3 - 2 * t)
+
+
+def edge_function(a: np.ndarray, b: np.ndarray, c: np.ndarray) -> np.ndarray:
+    return (a[..., 0] - b[..., 0]) * (c[..., 1] - a[..., 1]) - (
+        a[..., 1] - b[..., 1]
+    ) * (c[..., 0] - a[..., 0])
+
+
+def is_top_left(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    edge = b - a
+    return ((edge[..., 1] == 0) & (edge[..., 0] > 0)) | (edge[..., 1] > 0)
+
+
+def edge_equations(quad: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # returns the coefficients of the edge functions (01, 12, 23, 30, 20) of
+    # integer quads (..., 4, 2), so that edge_function(a, b, p) + bias equals
+    # x * p.x + y * p.y + z, and a mask of quads with all points in one line.
+    a = quad[..., (0, 1, 2, 3, 2), :]
+    b = quad[..., (1, 2, 3, 0, 0), :]
+    dx = a[..., 0] - b[..., 0]
+    dy = a[..., 1] - b[..., 1]
+    # don't render common edges twice, top-left rule
+    bias = np.where(is_top_left(a, b), 0, -1)
+    constant = -dx * a[..., 1] + dy * a[..., 0] + bias
+    equations = np.stack((-dy, dx, constant), axis=-1)
+
+    p0, p1, p2, p3 = (quad[..., i, :] for i in range(4))
+    collinear = (edge_function(p0, p1, p2) == 0) & (edge_function(p0, p2, p3) == 0)
+    return equations, collinear
+
+
+def intersect_quad(p: np.ndarray, equations: np.ndarray) -> np.ndarray:
+    # p: (..., 2) integer positions, equations: (..., 5, 3), see edge_equations
+    w = (
+        equations[..., 0] * p[..., np.newaxis, 0]
+        + equations[..., 1] * p[..., np.newaxis, 1]
+        + equations[..., 2]
+    ) >= 0
+    w01, w12, w23, w30, w20 = (w[..., i] for i in range(5))
+
+    # [Hormann Tarini, 2004] 4.1
+    front = (w20 & w01 & w12 & (w23 | w30)) | (~w20 & w23 & w30 & (w01 | w12))
+    back = (~w20 & ~w01 & ~w12 & (~w23 | ~w30)) | (w20 & ~w23 & ~w30 & (~w01 | ~w12))
+    return front | back
+
+
+def compute_barycentric_quad(p: np.ndarray, quad: np.ndarray) -> np.ndarray:
+    # https://core.ac.uk/download/pdf/53544051.pdf
+    s = (quad - p[..., np.newaxis, :]).astype(np.float32)
+    s_next = np.roll(s, -1, axis=-2)
+
+    a = s[..., 0] * s_next[..., 1] - s_next[..., 0] * s[..., 1]
+    d = dot(s, s_next)
+    r = length(s)
+    r_next = np.roll(r, -1, axis=-1)
+
+    a = np.where(a == 0, np.float32(1e-3), a)
+    t = (r * r_next - d) / a
+    t_previous = np.roll(t, 1, axis=-1)
+    weights = (t_previous + t) / r
+    weights /= np.sum(weights, axis=-1, keepdims=True)
+
+    # vertexes that lie on p get the full weight
+    on_vertex = r == 0
+    first = np.argmax(on_vertex, axis=-1)
+    snapped = np.eye(4, dtype=np.float32)[first]
+    weights = np.where(np.any(on_vertex, axis=-1, keepdims=True), snapped, weights)
+    return weights
+
+
+def sample_linear(array: np.ndarray, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    # bilinear sampling with normalized coordinates and a border color of 0,
+    # like CLK_FILTER_LINEAR | CLK_NORMALIZED_COORDS_TRUE | CLK_ADDRESS_CLAMP
+    height, width = array.shape[:2]
+    u = x * width - 0.5
+    v = y * height - 0.5
+    i0 = np.floor(u)
+    j0 = np.floor(v)
+    a = u - i0
+    b = v - j0
+    i0 = i0.astype(np.int64)
+    j0 = j0.astype(np.int64)
+
+    def texel(i: np.ndarray, j: np.ndarray) -> np.ndarray:
+        inside = (i >= 0) & (i < width) & (j >= 0) & (j < height)
+        values = array[np.clip(j, 0, height - 1), np.clip(i, 0, width - 1)]
+        return np.where(inside, values, 0)
+
+    return (
+        (1 - a) * (1 - b) * texel(i0, j0)
+        + a * (1 - b) * texel(i0 + 1, j0)
+        + (1 - a) * b * texel(i0, j0 + 1)
+        + a * b * texel(i0 + 1, j0 + 1)
+    )
+
+
+class CPURaytracingTask(RaytracingTask):
+    # mirrors the raytrace kernel with vectorized numpy operations over
+    # paths x wavelengths x rays.
+
+    def __init__(self) -> None:
+        super().__init__(None)
+
+    def build(self, *args, **kwargs) -> None:
+        self.dtypes['Ray'] = ray_dtype
+        self.dtypes['LensElement'] = lens_element_dtype
+
+    def update_rays(self, rays_shape: tuple[int, ...]) -> Buffer:
+        rays = np.zeros(rays_shape, self.dtypes['Ray'])
+        return Buffer(self.context, array=rays)
+
+    def trace(
+        self,
+        rays: Buffer,
+        lens_elements: np.ndarray,
+        paths: np.ndarray,
+        wavelengths: np.ndarray,
+        aperture_index: int,
+        coating_min_ior: float,
+        grid_count: int,
+        grid_length: float,
+        direction: np.ndarray,
+    ) -> None:
+        ray_count = rays.array.shape[-1]
+        lenses_count = len(lens_elements)
+
+        radius = lens_elements['radius']
+        ior = lens_elements['ior']
+        height = lens_elements['height']
+        center = lens_elements['center']
+        coating = lens_elements['coating']
+        coefficients = np.float32(lens_elements['coefficients'].tolist())
+        disperse = not np.isnan(coefficients[0, 0])
+
+        # init_ray
+        ray_id = np.arange(ray_count)
+        y = ray_id // grid_count
+        x = ray_id - y * grid_count
+        pos = np.ones((ray_count, 3), np.float32)
+        pos[:, 0] = grid_length * (x / (grid_count - 1) - 0.5)
+        pos[:, 1] = grid_length * (0.5 - y / (grid_count - 1))
+        dir_ = np.zeros((ray_count, 3), np.float32)
+        dir_[:, 2] = -1
+        lens_id = np.zeros(ray_count, np.int64)
+        inter_pos = intersect(pos, dir_, radius[lens_id], center[lens_id])[0]
+
+        direction = normalize(-np.float32([direction[k] for k in 'xyz']))
+
+        # without dispersion only one wavelength is traced, see trace_shape
+        shape = trace_shape(lens_elements, *rays.array.shape)
+        broadcast = shape != rays.array.shape
+        all_wavelengths = wavelengths
+        wavelengths = wavelengths[: shape[1]]
+
+        # broadcast to rays = (path, wavelength, ray)
+        count = int(np.prod(shape))
+        pos = np.broadcast_to(inter_pos - direction, (*shape, 3)).reshape(count, 3)
+        dir_ = np.broadcast_to(direction, (count, 3))
+        pos_apt = np.zeros((count, 2), np.float32)
+        rrel = np.zeros(count, np.float32)
+        reflectance = np.ones(count, np.float32)
+
+        path = np.broadcast_to(paths[:, np.newaxis, np.newaxis], (*shape, 2))
+        path = path.reshape(count, 2)
+        wavelength = np.broadcast_to(
+            np.float32(wavelengths)[:, np.newaxis], shape
+        ).ravel()
+
+        lens_id = np.zeros(count, np.int64)
+        step = np.zeros(count, np.int64)
+        delta = np.ones(count, np.int64)
+        # rays that exit the loop early are invalid
+        invalid = np.zeros(count, bool)
+        # theta, n1, n2 and coating of the two bounces
+        bounces = np.zeros((4, count, 2), np.float32)
+
+        pos = pos.copy()
+        dir_ = dir_.copy()
+
+        # lens_id is unsigned in the kernel, so rays that move past the first
+        # element end the loop the same way as rays that reach the sensor
+        active = np.arange(count)
+        while active.size:
+            i = active
+            lid = lens_id[i]
+
+            p, n, incident, hit = intersect(pos[i], dir_[i], radius[lid], center[lid])
+            invalid[i[~hit]] = True
+            i, lid, p, n, incident = i[hit], lid[hit], p[hit], n[hit], incident[hit]
+            pos[i] = p
+
+            # skip refract/reflection for aperture
+            aperture = lid == aperture_index
+            pos_apt[i[aperture]] = p[aperture, :2] / height[lid[aperture], np.newaxis]
+            lens = ~aperture
+            rrel[i[lens]] = np.maximum(
+                rrel[i[lens]], length(p[lens, :2]) / height[lid[lens]]
+            )
+
+            # no reflection / refraction on sensor plane
+            mask = lens & (lid != lenses_count - 1)
+            i, lid, n, incident = i[mask], lid[mask], n[mask], incident[mask]
+
+            # reverse direction of the ray
+            do_reflect = ((step[i] == 0) & (lid == path[i, 0])) | (
+                (step[i] == 1) & (lid == path[i, 1])
+            )
+            step[i] += do_reflect
+            delta[i] = np.where(do_reflect, -delta[i], delta[i])
+
+            # if previous medium is outside lens system, set n1 = 1 (air)
+            n_index = np.where(dir_[i, 2] < 0, lid - 1, lid + 1)
+            outside = (n_index < 0) | (n_index >= lenses_count)
+            n_index = np.clip(n_index, 0, lenses_count - 1)
+            n1 = np.where(outside, 1, ior[n_index]).astype(np.float32)
+            n2 = ior[lid]
+
+            # calculate dispersion on glass mediums (n>1)
+            if disperse:
+                w = wavelength[i]
+                n1 = np.where(n1 > 1, dispersion(w, coefficients[n_index]), n1)
+                n2 = np.where(n2 > 1, dispersion(w, coefficients[lid]), n2)
+
+            # reflection
+            r = do_reflect
+            dir_[i[r]] = reflect(dir_[i[r]], n[r])
+            theta = incident[r] + np.float32(1e-9)
+            if broadcast:
+                bounce = (theta, n1[r], n2[r], coating[lid[r]])
+                bounces[:, i[r], step[i[r]] - 1] = bounce
+            fresnel_reflectance = surface_reflectance(
+                theta,
+                wavelength[i[r]],
+                n1[r],
+                n2[r],
+                coating[lid[r]],
+                coating_min_ior,
+            )
+            reflectance[i[r]] *= np.where(
+                fresnel_reflectance > 0, fresnel_reflectance, 1
+            )
+
+            # refraction
+            t = ~do_reflect
+            dir_[i[t]] = refract(dir_[i[t]], n[t], n1[t] / n2[t])
+            # total reflection
+            invalid[i[t][dir_[i[t], 2] == 0]] = True
+
+            # next lens element
+            active = np.flatnonzero(~invalid)
+            active = active[(lens_id[active] >= 0) & (lens_id[active] < lenses_count)]
+            lens_id[active] += delta[active]
+            active = active[(lens_id[active] >= 0) & (lens_id[active] < lenses_count)]
+
+        reflectance[invalid] = np.nan
+
+        array = rays.array
+        for k, key in enumerate('xyz'):
+            array['pos'][key] = pos[:, k].reshape(shape)
+            array['dir'][key] = dir_[:, k].reshape(shape)
+        array['pos_apt']['x'] = pos_apt[:, 0].reshape(shape)
+        array['pos_apt']['y'] = pos_apt[:, 1].reshape(shape)
+        array['rrel'] = rrel.reshape(shape)
+        array['reflectance'] = reflectance.reshape(shape)
+
+        if broadcast:
+            # evaluate the reflectance of the bounces for all wavelengths
+            theta, n1, n2, coating = bounces
+            for wavelength_id, wavelength in enumerate(all_wavelengths):
+                reflectance = np.where(invalid, np.nan, 1).astype(np.float32)
+                for b in range(2):
+                    bounce = step > b
+                    fresnel_reflectance = surface_reflectance(
+                        theta[bounce, b],
+                        np.float32(wavelength),
+                        n1[bounce, b],
+                        n2[bounce, b],
+                        coating[bounce, b],
+                        coating_min_ior,
+                    )
+                    reflectance[bounce] *= np.where(
+                        fresnel_reflectance > 0, fresnel_reflectance, 1
+                    )
+                array['reflectance'][:, wavelength_id] = reflectance.reshape(
+                    shape[0], shape[2]
+                )
+
+    @lru_cache(1)
+    def raytrace(
+        self,
+        lens_model: LensModel,
+        sensor_size: tuple[float, float],
+        glasses_path: str,
+        abbe_nr_adjustment: float,
+        coating: tuple[int, ...],
+        coating_min_ior: float,
+        grid_count: int,
+        grid_length: float,
+        light_position: tuple[float, float],
+        resolution: QtCore.QSize,
+        wavelength_count: int,
+        path_indexes: tuple[int, ...],
+        spectral_sampling: SpectralSampling = SpectralSampling.UNIFORM,
+        wavelength_sub_count: int = 1,
+    ) -> Buffer | None:
+        lens_elements = self.update_lens_elements(
+            lens_model,
+            sensor_size,
+            glasses_path,
+            abbe_nr_adjustment,
+            coating,
+        )
+        if len(lens_elements.array) <= 1:
+            return
+
+        paths = self.update_paths(lens_model, path_indexes)
+        wavelengths = self.update_wavelengths(
+            wavelength_count, spectral_sampling, wavelength_sub_count
+        )
+        direction = self.update_direction(
+            light_position, resolution, sensor_size, lens_model.focal_length
+        )
+
+        path_count = int(paths.array.size)
+        ray_count = int(grid_count**2)
+        rays_shape = (path_count, wavelengths.shape[0], ray_count)
+        rays = self.update_rays(rays_shape)
+        rays.args = (
+            lens_elements,
+            paths,
+            wavelengths,
+            lens_model.aperture_index,
+            coating_min_ior,
+            grid_count,
+            grid_length,
+            direction.tolist(),
+        )
+
+        with np.errstate(all='ignore'):
+            self.trace(
+                rays,
+                lens_elements.array,
+                np.int64(paths.array.tolist()).reshape(-1, 2),
+                wavelengths.array,
+                lens_model.aperture_index,
+                coating_min_ior,
+                grid_count,
+                grid_length,
+                direction,
+            )
+        return rays
+
+    def extrapolate(
+        self, previous: Buffer, current: Buffer, t: float, args: tuple
+    ) -> Buffer:
+        # ray structs only contain floats
+        array = np.zeros(current.array.shape, current.array.dtype)
+        p = previous.array.view(np.float32)
+        c = current.array.view(np.float32)
+        array.view(np.float32)[:] = c + (c - p) * np.float32(t)
+        return Buffer(self.context, array=array, args=args)
+
+
+class CPURasterizingTask(RasterizingTask):
+    # mirrors the prim_shader, vertex_shader and rasterizer kernels. Instead of
+    # binning, each quad is rasterized over the pixels of its bounding box.
+
+    def __init__(self) -> None:
+        super().__init__(None)
+
+    def build(self, *args, **kwargs) -> None:
+        self.dtypes['Ray'] = ray_dtype
+        self.dtypes['Vertex'] = vertex_dtype
+
+    @lru_cache(1)
+    def update_quads(self, grid_count: int) -> np.ndarray:
+        return np.array(quad_vertexes(grid_count), np.int64).reshape(-1, 4)
+
+    @lru_cache(1)
+    def update_neighbors(self, grid_count: int) -> np.ndarray:
+        # quad indexes neighboring each vertex, see quad_neighbors
+        ray_id = np.arange(grid_count**2)
+        x = ray_id % grid_count
+        y = ray_id // grid_count
+        top = (y - 1) * (grid_count - 1) + (x - 1)
+        bottom = y * (grid_count - 1) + (x - 1)
+        return np.stack((top, top + 1, bottom, bottom + 1), axis=-1)
+
+    @timer
+    def prim_shader(
+        self, rays: np.ndarray, grid_count: int, area_orig: float, min_area: float
+    ) -> tuple[np.ndarray, np.ndarray]:
+        # returns bounds (path, quad, 4) and intensities (path, quad, wavelength)
+        quads = self.update_quads(grid_count)
+        pos = np.stack((rays['pos']['x'], rays['pos']['y']), axis=-1)[:, :, quads]
+        rrel = rays['rrel'][:, :, quads]
+        reflectance = rays['reflectance'][:, :, quads]
+
+        valid = ~np.isnan(reflectance)
+        valid_rays = np.sum(valid, axis=-1)
+
+        # move valid positions to the front
+        order = np.argsort(~valid, axis=-1, kind='stable')
+        valid_pos = np.take_along_axis(pos, order[..., np.newaxis], axis=-2)
+
+        area0 = edge_function(
+            valid_pos[..., 0, :], valid_pos[..., 1, :], valid_pos[..., 2, :]
+        )
+        area1 = edge_function(
+            valid_pos[..., 0, :], valid_pos[..., 2, :], valid_pos[..., 3, :]
+        )
+        area = np.where(
+            valid_rays == 4, np.abs(area0 + area1) / 2, np.abs(area0)
+        ).astype(np.float32)
+
+        # simulate quad for 3 valid rays
+        triangle = valid_rays == 3
+        valid_pos[..., 3, :] = np.where(
+            triangle[..., np.newaxis], valid_pos[..., 2, :], valid_pos[..., 3, :]
+        )
+        rrel[..., 3] = np.where(triangle, rrel[..., 2], rrel[..., 3])
+        outside = np.all(rrel > 1, axis=-1)
+        degenerate = valid_rays < 3
+
+        # once a wavelength is culled, the following wavelengths are skipped
+        skipped = np.logical_or.accumulate(degenerate, axis=1)
+
+        area_actual = np.maximum(area, np.float32(min_area))
+        with np.errstate(divide='ignore'):
+            intensities = np.where(
+                area_actual > 0, np.float32(area_orig) / area_actual, 0
+            )
+        intensities = np.where(skipped, 0, intensities).astype(np.float32)
+
+        prim_min = np.where(
+            skipped[..., np.newaxis], np.inf, np.min(valid_pos, axis=-2)
+        )
+        prim_max = np.where(
+            skipped[..., np.newaxis], -np.inf, np.max(valid_pos, axis=-2)
+        )
+        bounds = np.concatenate(
+            (np.min(prim_min, axis=1), np.max(prim_max, axis=1)), -1
+        )
+
+        wavelength_count = rays.shape[1]
+        invalid_rrel = np.sum(outside & ~skipped, axis=1) == wavelength_count
+        culled = np.any(degenerate, axis=1) | invalid_rrel
+        bounds[culled] = np.nan
+
+        # swap wavelength and quad axis
+        intensities = np.moveaxis(intensities, 1, -1)
+        return np.float32(bounds), np.ascontiguousarray(intensities)
+
+    @timer
+    def vertex_shader(
+        self,
+        rays: np.ndarray,
+        intensities: np.ndarray,
+        grid_count: int,
+        screen_transform: float,
+        resolution: tuple[int, int],
+    ) -> np.ndarray:
+        # returns vertexes (path, ray, wavelength)
+        rays = np.moveaxis(rays, 1, -1)
+        vertexes = np.zeros(rays.shape, self.dtypes['Vertex'])
+
+        # averages the intensities of the quads neighboring a vertex
+        quad_count = intensities.shape[1]
+        neighbors = self.update_neighbors(grid_count)
+        inside = (neighbors >= 0) & (neighbors < quad_count)
+        values = intensities[:, np.clip(neighbors, 0, quad_count - 1)]
+        values = np.where(inside[..., np.newaxis] & (values > 0), values, 0)
+        neighbor_count = np.sum(values > 0, axis=2)
+        intensity = np.sum(values, axis=2) / np.maximum(neighbor_count, 1)
+
+        offset = np.float32(resolution) / 2
+        vertexes['pos']['x'] = (
+            rays['pos']['x'] * np.float32(screen_transform) + offset[0]
+        )
+        vertexes['pos']['y'] = (
+            rays['pos']['y'] * np.float32(screen_transform) + offset[1]
+        )
+        vertexes['uv'] = rays['pos_apt']
+        vertexes['rrel'] = rays['rrel']
+        vertexes['reflectance'] = rays['reflectance']
+        vertexes['intensity'] = intensity
+        return vertexes
+
+    def fragment_shader(
+        self,
+        weights: np.ndarray,
+        vertexes: dict[str, np.ndarray],
+        ghost: np.ndarray | None,
+        scale: float,
+    ) -> np.ndarray:
+        def interpolate(values: np.ndarray) -> np.ndarray:
+            if values.ndim > weights.ndim:
+                return np.einsum('nk,nkc->nc', weights, values)
+            return np.sum(weights * values, axis=-1)
+
+        # ghost texture
+        ghost_intensity = 1
+        if ghost is not None:
+            uv = interpolate(vertexes['uv'])
+            uv = (uv / np.float32(scale) + 1) / 2
+            ghost_intensity = sample_linear(ghost, uv[:, 0], uv[:, 1])
+
+        # relative distance from lens housing, rrel > 1 = ray left lens housing
+        rrel_intensity = smoothstep(1, 0.95, interpolate(vertexes['rrel']))
+
+        # energy preservation
+        area_intensity = np.fmax(interpolate(vertexes['intensity']), 0)
+
+        # anti reflective coating
+        coating_intensity = np.fmax(interpolate(vertexes['reflectance']), 0)
+
+        intensity = (
+            ghost_intensity * rrel_intensity * area_intensity * coating_intensity
+        )
+        return np.nan_to_num(intensity, nan=0, posinf=0, neginf=0)
+
+    @timer
+    def rasterizer(
+        self,
+        vertexes: np.ndarray,
+        bounds: np.ndarray,
+        ghost: np.ndarray | None,
+        light_spectrum: np.ndarray,
+        resolution: tuple[int, int],
+        grid_count: int,
+        wavelength_sub_count: int,
+        sub_steps: int,
+        intensity: float,
+        ghost_scale: float,
+    ) -> np.ndarray:
+        width, height = resolution
+        path_count, ray_count, wavelength_count = vertexes.shape
+        max_wavelength_count = max(wavelength_count - 1, 1)
+        total_samples = wavelength_count * sub_steps * wavelength_sub_count
+        sub_offsets = np.array(SUB_OFFSETS[sub_steps - 1 : 2 * sub_steps - 1])
+        samples = np.stack((np.arange(sub_steps), sub_offsets), axis=-1)
+
+        # flat vertex attributes, vertexes = (path, ray, wavelength)
+        flat = vertexes.ravel()
+        attributes = {
+            'pos': np.stack((flat['pos']['x'], flat['pos']['y']), axis=-1),
+            'uv': np.stack((flat['uv']['x'], flat['uv']['y']), axis=-1),
+            'rrel': flat['rrel'],
+            'reflectance': flat['reflectance'],
+            'intensity': flat['intensity'],
+        }
+
+        # visible primitives
+        quads = self.update_quads(grid_count)
+        path_id, quad_id = np.nonzero(~np.isnan(bounds[..., 0]))
+        vertex_index = (path_id[:, np.newaxis] * ray_count + quads[quad_id]) * (
+            wavelength_count
+        )
+
+        # one instance per primitive, wavelength and wavelength sub step
+        wavelength_sub_step = np.float32(1 / wavelength_sub_count)
+        wavelength_step = wavelength_sub_step / wavelength_count
+        instances = []
+        for wavelength_id in range(max_wavelength_count):
+            index0 = np.minimum(vertex_index + wavelength_id, flat.size - 1)
+            next_id = min(wavelength_id + 1, wavelength_count - 1)
+            index1 = np.minimum(vertex_index + next_id, flat.size - 1)
+            # invalid vertexes have a reflectance of nan which cancels the fragment
+            valid = ~np.any(
+                np.isnan(attributes['reflectance'][index0])
+                | np.isnan(attributes['reflectance'][index1]),
+                axis=-1,
+            )
+            index0, index1 = index0[valid], index1[valid]
+            wavelength_sub_pos = np.float32(0)
+            wavelength_pos = np.float32((wavelength_id + 0.5) / wavelength_count)
+            for _ in range(wavelength_sub_count):
+                if wavelength_count > 1:
+                    spectrum = self.sample_spectrum(light_spectrum, wavelength_pos)
+                else:
+                    spectrum = np.ones(3, np.float32)
+                instances.append((index0, index1, wavelength_sub_pos, spectrum))
+                wavelength_sub_pos += wavelength_sub_step
+                wavelength_pos += wavelength_step
+
+        rgb = np.zeros((height * width, 3), np.float32)
+        for index0, index1, blend, spectrum in instances:
+            v = {
+                key: value[index0] + (value[index1] - value[index0]) * blend
+                for key, value in attributes.items()
+            }
+            v_pos = np.trunc(v['pos'] * np.float32(sub_steps)).astype(np.int64)
+            self.rasterize_quads(
+                rgb,
+                v,
+                v_pos,
+                samples,
+                ghost,
+                ghost_scale,
+                resolution,
+                spectrum,
+                sub_steps,
+            )
+
+        rgb *= np.float32(intensity * 1e3) / total_samples
+        rgb = rgb.reshape(height, width, 3)
+        array = np.zeros((height, width, 4), np.float32)
+        array[:, :, :3] = rgb @ XYZ_TO_AP1.T
+        # only write pixels that received energy, y is flipped
+        array[~np.any(rgb > 0, axis=-1)] = 0
+        return np.ascontiguousarray(np.flip(array, 0))
+
+    def rasterize_quads(
+        self,
+        rgb: np.ndarray,
+        vertexes: dict[str, np.ndarray],
+        v_pos: np.ndarray,
+        samples: np.ndarray,
+        ghost: np.ndarray | None,
+        ghost_scale: float,
+        resolution: tuple[int, int],
+        spectrum: np.ndarray,
+        sub_steps: int,
+    ) -> None:
+        # rasterizes the quads over the pixels within their bounding box
+        width, height = resolution
+        bounds_min = np.maximum(np.min(v_pos, axis=1) // sub_steps, 0)
+        bounds_max = np.minimum(
+            np.max(v_pos, axis=1) // sub_steps, (width - 1, height - 1)
+        )
+        size = np.maximum(bounds_max - bounds_min + 1, 0)
+        equations, collinear = edge_equations(v_pos)
+        # dealing with 3 points in one line
+        size[collinear] = 0
+        pixel_count = size[:, 0] * size[:, 1]
+
+        # split into chunks of pixels
+        ends = np.cumsum(pixel_count)
+        start = 0
+        while start < len(pixel_count):
+            offset = ends[start] - pixel_count[start]
+            end = int(np.searchsorted(ends, offset + CHUNK_SIZE, side='right'))
+            end = max(end, start + 1)
+
+            counts = pixel_count[start:end]
+            quad = np.repeat(np.arange(start, end), counts)
+            local = np.arange(quad.size) - np.repeat(
+                ends[start:end] - counts - offset, counts
+            )
+            x = bounds_min[quad, 0] + local % size[quad, 0]
+            y = bounds_min[quad, 1] + local // size[quad, 0]
+            start = end
+
+            # offset sample position based on n-rook pattern
+            p = np.stack((x, y), axis=-1) * sub_steps
+            hits = np.zeros(quad.size, np.int64)
+            quad_equations = equations[quad]
+            for sample in samples:
+                hits += intersect_quad(p + sample, quad_equations)
+            mask = hits > 0
+            if not np.any(mask):
+                continue
+            quad, x, y, p, hits = quad[mask], x[mask], y[mask], p[mask], hits[mask]
+
+            p_center = p + sub_steps // 2
+            weights = compute_barycentric_quad(p_center, v_pos[quad])
+            v = {key: value[quad] for key, value in vertexes.items()}
+            fragment = self.fragment_shader(weights, v, ghost, ghost_scale) * hits
+
+            pixel = y * width + x
+            for c in range(3):
+                rgb[:, c] += np.bincount(
+                    pixel, weights=fragment * spectrum[c], minlength=rgb.shape[0]
+                ).astype(np.float32)
+
+    @staticmethod
+    def sample_spectrum(light_spectrum: np.ndarray, position: float) -> np.ndarray:
+        # linear sampling with normalized coordinates, clamped to the edge
+        spectrum = light_spectrum[0, :, :3]
+        count = len(spectrum)
+        u = position * count - 0.5
+        i0 = int(np.floor(u))
+        a = np.float32(u - i0)
+        v0 = spectrum[np.clip(i0, 0, count - 1)]
+        v1 = spectrum[np.clip(i0 + 1, 0, count - 1)]
+        return (1 - a) * v0 + a * v1
+
+    @lru_cache(1)
+    def raster(
+        self,
+        render: Render,
+        rays: Buffer,
+        ghost: Image | None,
+        sensor_size: tuple[float, float],
+        min_area: float,
+        intensity: float,
+        fstop: float,
+    ) -> Image:
+        rays_array = rays.array
+        wavelength_count = rays_array.shape[1]
+        resolution = render.resolution.width(), render.resolution.height()
+        screen_transform = self.update_screen_transform(render.resolution, sensor_size)
+
+        area_orig = self.update_area_orig(render.grid_count, render.grid_length)
+        rel_min_area = min_area * area_orig
+        with np.errstate(all='ignore'):
+            bounds, intensities = self.prim_shader(
+                rays_array, render.grid_count, area_orig, rel_min_area
+            )
+            vertexes = self.vertex_shader(
+                rays_array, intensities, render.grid_count, screen_transform, resolution
+            )
+
+            wavelength_sub_count = (
+                render.wavelength_sub_count if wavelength_count > 1 else 1
+            )
+            ghost_scale = 1 - fstop / 32
+            array = self.rasterizer(
+                vertexes,
+                bounds,
+                ghost.array if ghost is not None else None,
+                self.update_light_spectrum(
+                    render.spectral_sampling, wavelength_count, wavelength_sub_count
+                ).array,
+                resolution,
+                render.grid_count,
+                wavelength_sub_count,
+                render.anti_aliasing,
+                intensity,
+                ghost_scale,
+            )
+
+        args = (
+            ghost,
+            rays,
+            wavelength_sub_count,
+            render.anti_aliasing,
+            intensity,
+            ghost_scale,
+        )
+        return Image(self.context, array=array, args=args)
+
+    def rasterize(
+        self,
+        render: Render,
+        rays: Buffer,
+        ghost: Image | None,
+        sensor_size: tuple[float, float],
+        min_area: float,
+        intensity: float,
+        fstop: float,
+        layers: tuple[str, ...] = (),
+        path_layers: tuple[int, ...] = (),
+    ) -> Image:
+        if layers:
+            logger.warning('ghost layers are only supported on OpenCL devices')
+        options = unsupported_options(render)
+        if options:
+            names = ', '.join(options)
+            logger.warning(f'render options ignored by the NumPy device: {names}')
+        if rays is None:
+            w, h = render.resolution.width(), render.resolution.height()
+            return Image(self.context, array=np.zeros((h, w, 4), np.float32))
+        return self.raster(render, rays, ghost, sensor_size, min_area, intensity, fstop)
+
+
+class CPUPreprocessTask(PreprocessTask):
+    def __init__(self) -> None:
+        OpenCL.__init__(self, None)
+        self.raytracing_task = CPURaytracingTask()
+
+    def update_stats(
+        self,
+        rays: Buffer,
+        grid_count: int,
+        area_orig: float,
+        min_area: float,
+        aperture_radius: float,
+        frame: tuple[float, float],
+        transform: float,
+        resolution: QtCore.QSize,
+        bin_size: int,
+        subdivisions: float,
+    ) -> np.ndarray:
+        # mirrors the ghost_stats kernel, the rays are already on the host
+        quads = np.array(quad_vertexes(grid_count), np.int64).reshape(-1, 4)
+        pos = rays.array['pos'][:, :, quads]
+        pos_apt = rays.array['pos_apt'][:, :, quads]
+        pos = np.stack((pos['x'], pos['y']), axis=-1)
+        pos_apt = np.stack((pos_apt['x'], pos_apt['y']), axis=-1)
+        rrel = rays.array['rrel'][:, :, quads]
+        reflectance = rays.array['reflectance'][:, :, quads]
+
+        valid = ~np.isnan(reflectance)
+        valid_rays = np.sum(valid, axis=-1)
+        degenerate = valid_rays < 3
+
+        # move valid positions to the front
+        order = np.argsort(~valid, axis=-1, kind='stable')
+        valid_pos = np.take_along_axis(pos, order[..., np.newaxis], axis=-2)
+        area0 = edge_function(
+            valid_pos[..., 0, :], valid_pos[..., 1, :], valid_pos[..., 2, :]
+        )
+        area1 = edge_function(
+            valid_pos[..., 0, :], valid_pos[..., 2, :], valid_pos[..., 3, :]
+        )
+        area = np.where(valid_rays == 4, np.abs(area0 + area1) / 2, np.abs(area0))
+
+        # screen space bounds of the quads and the estimated bins that the
+        # primitives of the render grid inside them overlap
+        half_resolution = np.float32((resolution.width(), resolution.height())) / 2
+        mask = valid[..., np.newaxis]
+        quad_min = np.min(np.where(mask, pos, np.inf), axis=-2)
+        quad_max = np.max(np.where(mask, pos, -np.inf), axis=-2)
+        quad_min = quad_min * transform + half_resolution
+        quad_max = quad_max * transform + half_resolution
+        overlaps = np.all(quad_max >= 0, axis=-1)
+        overlaps &= np.all(quad_min < half_resolution * 2, axis=-1)
+        bin_size = max(bin_size, 1)
+        frame_max = half_resolution * 2 - 1
+        clipped_min = np.int32(np.clip(quad_min, 0, frame_max))
+        clipped_max = np.int32(np.clip(quad_max, 0, frame_max))
+        size = (clipped_max - clipped_min) / bin_size
+        bins = np.prod(size + subdivisions, axis=-1)
+        bins = np.where(overlaps & ~degenerate, bins, 0)
+
+        # an invalid corner of a triangle takes the average of the other corners
+        def fill(array: np.ndarray) -> np.ndarray:
+            mask = valid.reshape(valid.shape + (1,) * (array.ndim - 4))
+            count = np.maximum(valid_rays, 1)
+            count = count.reshape(count.shape + (1,) * (array.ndim - 3))
+            average = np.sum(np.where(mask, array, 0), axis=3, keepdims=True) / count
+            return np.where(mask, array, average)
+
+        pos, pos_apt, rrel, reflectance = map(fill, (pos, pos_apt, rrel, reflectance))
+        reflectance = np.where(degenerate[..., np.newaxis], 0, reflectance)
+
+        peak = np.mean(reflectance, axis=-1) * area_orig / np.maximum(area, min_area)
+        peak = np.where(degenerate, 0, peak)
+
+        # bilinear weights of the samples of a quad
+        samples = (np.arange(SUB_COUNT) + 0.5) / SUB_COUNT
+        u, v = (a.ravel() for a in np.meshgrid(samples, samples))
+        weights = np.stack(((1 - u) * (1 - v), u * (1 - v), u * v, (1 - u) * v), -1)
+
+        sample_pos = np.einsum('...cd,sc->...sd', pos, weights)
+        sample_uv = np.einsum('...cd,sc->...sd', pos_apt, weights)
+        sample_rrel = np.einsum('...c,sc->...s', rrel, weights)
+        coating = np.einsum('...c,sc->...s', reflectance, weights)
+
+        inside = np.all(np.abs(sample_pos) <= frame, axis=-1)
+        inside &= length(sample_uv) <= aperture_radius
+        transmission = np.where(inside, smoothstep(1, 0.95, sample_rrel) * coating, 0)
+        energy = np.mean(transmission, axis=-1) * area_orig
+
+        # screen space bounds of the valid rays
+        ray_valid = ~np.isnan(rays.array['reflectance'])
+        ray_pos = rays.array['pos']
+        ray_pos = np.stack((ray_pos['x'], ray_pos['y']), axis=-1)
+        mask = ray_valid[..., np.newaxis]
+        bounds_min = np.min(np.where(mask, ray_pos, np.inf), axis=(1, 2))
+        bounds_max = np.max(np.where(mask, ray_pos, -np.inf), axis=(1, 2))
+        bounds = np.concatenate((bounds_min, bounds_max), axis=-1)
+        bounds = bounds * transform + np.tile(half_resolution, 2)
+        valid_fraction = np.mean(ray_valid, axis=(1, 2))
+        bounds[valid_fraction == 0] = 0
+
+        stats = np.zeros(len(rays.array), ghost_stats_dtype)
+        stats['energy'] = np.mean(np.sum(energy, axis=-1), axis=-1)
+        stats['peak'] = np.max(peak, axis=(1, 2), initial=0)
+        for i, component in enumerate('xyzw'):
+            stats['bounds'][component] = bounds[:, i]
+        area = np.where(degenerate, 0, area)
+        stats['area'] = np.mean(np.sum(area, axis=-1), axis=-1) * transform**2
+        stats['valid'] = valid_fraction
+        stats['bins'] = np.mean(np.sum(bins, axis=-1), axis=-1)
+        return stats
@@ -56,49 +56,27 @@ class DiagramTask(OpenCL):
             scale = (resolution.width() - padding) / distance
         return scale
 
-    @lru_cache(1)
-    def update_intersection_slice(
-        self, intersections: Buffer, column_offset: int
-    ) -> Buffer:
-        column_count = intersections.array.shape[3]
-        column = int((column_count - 1) / 2) + column_offset
-
-        # shape = (path, wavelength, ray.row, ray.column, intersection)
-        array = np.ascontiguousarray(
-            intersections.array[:, :, :, column : column + 1, :]
-        )
-        intersection_slice = Buffer(
-            self.context, array=array, args=(intersections, column_offset)
-        )
-        return intersection_slice
-
     @timer
     @lru_cache(1)
     def intersections(
         self,
         diagram_image: Image,
         intersections: Buffer,
-        column_offset: int,
         scale: float,
     ) -> None:
         # rebuild kernel
         if self.rebuild:
             self.build()
 
-        intersection_slice = self.update_intersection_slice(
-            intersections, column_offset
-        )
-
-        # intersections count
-        ray_count = (
-            intersection_slice.array.shape[2] * intersection_slice.array.shape[3]
-        )
-        intersections_count = intersection_slice.array.shape[4]
+        # intersections are only traced for one column of rays
+        # shape = (path, wavelength, ray.row, intersection)
+        ray_count = intersections.array.shape[2]
+        intersections_count = intersections.array.shape[3]
         # logging.debug(f'{intersections_count:=}')
 
         # run program
         self.kernels['intersections'].set_arg(0, diagram_image.image)
-        self.kernels['intersections'].set_arg(1, intersection_slice.buffer)
+        self.kernels['intersections'].set_arg(1, intersections.buffer)
         self.kernels['intersections'].set_arg(2, np.int32(intersections_count))
         self.kernels['intersections'].set_arg(3, np.int32(ray_count))
         self.kernels['intersections'].set_arg(4, np.float32(scale))
@@ -192,7 +170,6 @@ class DiagramTask(OpenCL):
         abbe_nr_adjustment: float,
         coating: tuple[int, ...],
         intersections: Buffer,
-        column_offset: int,
     ) -> Image:
         diagram_image = self.update_image(resolution, flags=cl.mem_flags.READ_WRITE)
 
@@ -204,7 +181,6 @@ class DiagramTask(OpenCL):
             abbe_nr_adjustment,
             coating,
             intersections,
-            column_offset,
         )
 
         scale = self.update_scale(resolution, tuple(lens_model.lens_elements))
@@ -220,7 +196,7 @@ class DiagramTask(OpenCL):
         )
 
         if intersections is not None:
-            self.intersections(diagram_image, intersections, column_offset, scale)
+            self.intersections(diagram_image, intersections, scale)
 
         return diagram_image
 
@@ -237,6 +213,5 @@ class DiagramTask(OpenCL):
             abbe_nr_adjustment=lens.abbe_nr_adjustment,
             coating=lens.coating,
             intersections=intersections,
-            column_offset=project.diagram.column_offset,
         )
         return image
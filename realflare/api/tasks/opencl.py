@@ -15,6 +15,9 @@ LAMBDA_MIN = 390
 LAMBDA_MAX = 730
 LAMBDA_MID = (LAMBDA_MIN + LAMBDA_MAX) / 2
 
+# device name of the numpy backend
+CPU_DEVICE = 'NumPy'
+
 intersection_dtype = np.dtype(
     [
         ('pos', cl.cltypes.float3),
@@ -60,6 +63,35 @@ vertex_dtype = np.dtype(
     ]
 )
 
+# pos: fixed point screen space coordinates
+# uv, rrel, reflectance: half precision, the reflectance is multiplied by the
+# intensity of the vertex
+packed_vertex_dtype = np.dtype(
+    [
+        ('pos', cl.cltypes.int2),
+        ('uv', cl.cltypes.ushort2),
+        ('rrel', cl.cltypes.ushort),
+        ('reflectance', cl.cltypes.ushort),
+    ]
+)
+
+# energy: energy of a ghost that reaches the sensor
+# peak: highest intensity of a primitive of a ghost
+# bounds: screen space bounds of the valid rays (xmin, ymin, xmax, ymax)
+# area: screen space area covered by the primitives per wavelength
+# valid: fraction of the rays that made it through the lens system
+# bins: amount of bins overlapped by the primitives per wavelength
+ghost_stats_dtype = np.dtype(
+    [
+        ('energy', cl.cltypes.float),
+        ('peak', cl.cltypes.float),
+        ('bounds', cl.cltypes.float4),
+        ('area', cl.cltypes.float),
+        ('valid', cl.cltypes.float),
+        ('bins', cl.cltypes.float),
+    ]
+)
+
 
 class MemoryObject:
     # this objects helps to transfer data between host and devices
@@ -111,6 +143,11 @@ class Image(MemoryObject):
         super().__init__(context, array, args)
         self._image = image
 
+        # the region of the image that holds data, None is the full image
+        self.data_window: QtCore.QRect | None = None
+        # named rgb layers of the data window, written as exr layers
+        self.layers: dict[str, np.ndarray] = {}
+
     @property
     def array(self) -> np.ndarray:
         if self._array is None:
@@ -208,10 +245,15 @@ class Buffer(MemoryObject):
 
 
 def devices() -> dict[str, str]:
+    try:
+        platforms = cl.get_platforms()
+    except cl.Error:
+        platforms = []
     cl_devices = {
         platform.name: {device.name: device.name for device in platform.get_devices()}
-        for platform in cl.get_platforms()
+        for platform in platforms
     }
+    cl_devices[CPU_DEVICE] = {CPU_DEVICE: CPU_DEVICE}
     return cl_devices
 
 
@@ -233,9 +275,10 @@ def command_queue(device: str = '') -> cl.CommandQueue:
 
 
 class OpenCL:
-    def __init__(self, queue: cl.CommandQueue) -> None:
+    def __init__(self, queue: cl.CommandQueue | None) -> None:
+        # tasks that run on the host can be created without a queue
         self.queue = queue
-        self.context = queue.context
+        self.context = queue.context if queue is not None else None
         self.dtypes = {}
         self.program = None
         self.source = ''
@@ -1,4 +1,10 @@
+from __future__ import annotations
+
+import hashlib
+import heapq
+import json
 import logging
+import os
 from functools import lru_cache
 
 import cv2
@@ -6,36 +12,268 @@ import numpy as np
 import pyopencl as cl
 from PySide2 import QtCore
 
-from qt_extensions.typeutils import HashableDict
+from qt_extensions.typeutils import basic
+from realflare import __version__
 from realflare.api import lens as api_lens
-from realflare.api.data import Project, RealflareError, LensModel
+from realflare.api.data import (
+    GhostLayers,
+    LensModel,
+    Output,
+    Project,
+    RealflareError,
+)
 from realflare.api.path import File
-from realflare.api.tasks.opencl import OpenCL, Buffer
-from realflare.api.tasks.raytracing import RaytracingTask
+from realflare.api.tasks.opencl import OpenCL, Buffer, ray_dtype, ghost_stats_dtype
+from realflare.api.tasks.raytracing import RaytracingTask, screen_transform
 from realflare.storage import Storage
 from realflare.utils.timing import timer
 
 logger = logging.getLogger(__name__)
 storage = Storage()
 
+# the amount of samples per side of a quad used to estimate the energy of a ghost
+SUB_COUNT = 4
+# the amount of rays per side of the grid that the statistics are measured on,
+# independent of the grid_count of the render
+STATS_GRID_COUNT = 33
+# upper limit of the work-group that reduces the quads of a ghost, a power of two
+STATS_WORK_GROUP_SIZE = 64
+# increase to invalidate the preprocessing results stored on disk
+CACHE_VERSION = 4
+# the light positions used for per frame culling are snapped to a grid with this
+# amount of steps per unit, so that nearby frames share their estimate
+LIGHT_POSITION_STEPS = 16
+
+# the statistics of all ghosts of a project as returned by the engine
+# cost: bins times the amount of rendered wavelengths, this approximates the
+# amount of work of the rasterizer
+ghost_report_dtype = np.dtype(
+    [
+        ('path', np.int32),
+        ('energy', np.float32),
+        ('peak', np.float32),
+        ('bounds', np.float32, 4),
+        ('area', np.float32),
+        ('valid', np.float32),
+        ('cost', np.float32),
+        ('culled', np.bool_),
+    ]
+)
+
+
+def cull_ghosts(
+    energies: np.ndarray, cull_percentage: float, cull_energy: float
+) -> tuple[int, ...]:
+    # returns the indexes of the ghosts to render. The darkest cull_percentage of
+    # the ghosts are culled, and the darkest ghosts are culled for as long as
+    # their combined energy stays below cull_energy of the total energy.
+    order = np.argsort(-energies, kind='stable')
+    count = int(len(order) * (1 - cull_percentage))
+
+    total = np.sum(energies, dtype=np.float64)
+    if cull_energy > 0 and total > 0:
+        kept_energy = np.cumsum(energies[order], dtype=np.float64)
+        target = total * (1 - cull_energy)
+        count = min(count, int(np.searchsorted(kept_energy, target)) + 1)
+
+    return tuple(sorted(int(i) for i in order[:count]))
+
+
+def cache_key(lens_model: LensModel, glasses_path: str, parameters: tuple) -> str:
+    # content hash of the lens model, the glass catalog and the parameters of the
+    # preprocessing. the lens model is hashed by value to include unsaved changes.
+    sha = hashlib.sha256()
+    sha.update(
+        f'{__version__}/{CACHE_VERSION}/{SUB_COUNT}/{STATS_GRID_COUNT}'.encode()
+    )
+    sha.update(json.dumps(basic(lens_model), sort_keys=True).encode())
+
+    dir_path = storage.decode_path(glasses_path)
+    if os.path.isdir(dir_path):
+        for file_name in sorted(os.listdir(dir_path)):
+            file_path = os.path.join(dir_path, file_name)
+            if not os.path.isfile(file_path):
+                continue
+            sha.update(file_name.encode())
+            with open(file_path, 'rb') as f:
+                sha.update(f.read())
+
+    sha.update(repr(parameters).encode())
+    return sha.hexdigest()
+
+
+def read_cache(path: str, dtype: np.dtype) -> np.ndarray | None:
+    try:
+        array = np.load(path, allow_pickle=False)
+    except (OSError, ValueError) as e:
+        logger.debug(e)
+        return None
+    if array.dtype != dtype:
+        return None
+    return array
+
+
+def write_cache(path: str, array: np.ndarray) -> None:
+    # the file is written next to the cache and renamed, so that other processes
+    # never read a partial file
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(temp_path, 'wb') as f:
+            np.save(f, array, allow_pickle=False)
+        os.replace(temp_path, path)
+    except OSError as e:
+        logger.debug(e)
+        logger.warning(f'failed to write preprocessing cache: {path}')
+
+
+def parse_ghost_sets(text: str) -> tuple[tuple[int, ...], ...]:
+    # parses ghost sets separated by semicolons, where each set is a list of ghost
+    # indexes and ranges separated by commas. For example: 0-3, 7; 12
+    ghost_sets = []
+    for text_set in text.split(';'):
+        ghost_set = []
+        for item in text_set.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            try:
+                if '-' in item:
+                    start, end = item.split('-', 1)
+                    ghost_set.extend(range(int(start), int(end) + 1))
+                else:
+                    ghost_set.append(int(item))
+            except ValueError:
+                raise RealflareError(f'invalid ghost set: {text_set.strip()}') from None
+        if ghost_set:
+            ghost_sets.append(tuple(ghost_set))
+    return tuple(ghost_sets)
+
+
+def ghost_layers(
+    output: Output, path_indexes: tuple[int, ...], energies: np.ndarray
+) -> tuple[tuple[str, ...], tuple[int, ...]]:
+    # returns the names of the ghost layers and the layer of each rendered path,
+    # -1 for paths that are not part of a layer. energies are the energies of all
+    # ghosts and used to rank the ghosts.
+    if output.ghost_layers == GhostLayers.GHOST:
+        names = tuple(f'ghost_{index}' for index in path_indexes)
+        return names, tuple(range(len(path_indexes)))
+
+    if output.ghost_layers == GhostLayers.SET:
+        ghost_sets = parse_ghost_sets(output.ghost_layer_sets)
+        names = tuple(f'set_{i}' for i in range(len(ghost_sets)))
+        path_layers = [-1] * len(path_indexes)
+        for layer, ghost_set in enumerate(ghost_sets):
+            for path_id, index in enumerate(path_indexes):
+                if index in ghost_set and path_layers[path_id] < 0:
+                    path_layers[path_id] = layer
+        return names, tuple(path_layers)
+
+    if output.ghost_layers == GhostLayers.RANK:
+        # the brightest ghosts get their own layer, the last layer holds the rest
+        count = min(output.ghost_layer_count, len(path_indexes))
+        if count <= 0:
+            return (), ()
+        path_energies = np.float32(
+            [energies[i] if i < len(energies) else 0 for i in path_indexes]
+        )
+        order = np.argsort(-path_energies, kind='stable')
+        path_layers = [count - 1] * len(path_indexes)
+        for rank, path_id in enumerate(order[: count - 1]):
+            path_layers[path_id] = rank
+        names = tuple(f'rank_{rank}' for rank in range(count - 1)) + ('rank_rest',)
+        return names, tuple(path_layers)
+
+    return (), ()
+
+
+def group_size(work_group_size: int) -> int:
+    # returns the largest power of two that fits the work-group
+    size = 1
+    while size * 2 <= min(work_group_size, STATS_WORK_GROUP_SIZE):
+        size *= 2
+    return size
+
 
 class PreprocessTask(OpenCL):
+    group_size = 1
+
     def __init__(self, queue: cl.CommandQueue) -> None:
         super().__init__(queue)
         self.raytracing_task = RaytracingTask(queue)
-
-    def update_areas(self, rays: Buffer) -> HashableDict[int, float]:
-        # generate a dict of areas where key=path_index and area is the area
-        # of the top left quad
-        path_count, wavelength_count, ray_count = rays.array.shape
-        cl.enqueue_copy(self.queue, rays.array, rays.buffer)
-
-        areas = HashableDict()
-        for path in range(path_count):
-            ray = rays.array[path, 0, 0]
-            area = np.abs(ray['pos']['x']) * np.abs(ray['pos']['x'])
-            areas[path] = area
-        return areas
+        self.kernel = None
+        self.build()
+
+    def build(self, *args, **kwargs) -> None:
+        # the reduction in local memory is sized at compile time, the kernel is
+        # rebuilt with a smaller work-group until it fits the kernel limit
+        device = self.queue.device
+        self.group_size = group_size(device.max_work_group_size)
+        while True:
+            self.build_program()
+            work_group_size = self.kernel.get_work_group_info(
+                cl.kernel_work_group_info.WORK_GROUP_SIZE, device
+            )
+            size = group_size(work_group_size)
+            if size >= self.group_size:
+                return
+            logger.debug(f'stats work-group lowered to {size} by the kernel')
+            self.group_size = size
+
+    def build_program(self) -> None:
+        self.source = ''
+        self.register_dtype('Ray', ray_dtype)
+        self.register_dtype('GhostStats', ghost_stats_dtype)
+        self.source += f'#define PREPROCESS_SUB_COUNT {SUB_COUNT}\n'
+        self.source += f'#define PREPROCESS_GROUP_SIZE {self.group_size}\n'
+        self.source += self.read_source_file('primitives.cl')
+        self.source += self.read_source_file('preprocessing.cl')
+        super().build()
+        self.kernel = cl.Kernel(self.program, 'ghost_stats')
+
+    def update_stats(
+        self,
+        rays: Buffer,
+        grid_count: int,
+        area_orig: float,
+        min_area: float,
+        aperture_radius: float,
+        frame: tuple[float, float],
+        transform: float,
+        resolution: QtCore.QSize,
+        bin_size: int,
+        subdivisions: float,
+    ) -> np.ndarray:
+        # reduces the rays of each ghost to its statistics on the device so that
+        # only one struct per ghost is copied back to the host. each ghost is
+        # reduced by one work-group.
+        path_count, wavelength_count, ray_count = rays.shape
+
+        stats = np.zeros(path_count, self.dtypes['GhostStats'])
+        stats_cl = cl.Buffer(self.context, cl.mem_flags.WRITE_ONLY, stats.nbytes)
+
+        self.kernel.set_arg(0, stats_cl)
+        self.kernel.set_arg(1, rays.buffer)
+        self.kernel.set_arg(2, np.int32(grid_count))
+        self.kernel.set_arg(3, np.int32(wavelength_count))
+        self.kernel.set_arg(4, np.float32(area_orig))
+        self.kernel.set_arg(5, np.float32(min_area))
+        self.kernel.set_arg(6, np.float32(aperture_radius))
+        self.kernel.set_arg(7, cl.cltypes.make_float2(*frame))
+        self.kernel.set_arg(8, np.float32(transform))
+        self.kernel.set_arg(
+            9, cl.cltypes.make_int2(resolution.width(), resolution.height())
+        )
+        self.kernel.set_arg(10, np.int32(max(bin_size, 1)))
+        self.kernel.set_arg(11, np.float32(subdivisions))
+        global_work_size = (path_count * self.group_size,)
+        local_work_size = (self.group_size,)
+        cl.enqueue_nd_range_kernel(
+            self.queue, self.kernel, global_work_size, local_work_size
+        )
+        cl.enqueue_copy(self.queue, stats, stats_cl)
+        return stats
 
     @lru_cache(1)
     def preprocess(
@@ -46,15 +284,44 @@ class PreprocessTask(OpenCL):
         abbe_nr_adjustment: float,
         coating: tuple[int, ...],
         coating_min_ior: float,
+        min_area: float,
+        fstop: float,
+        resolution: QtCore.QSize,
+        grid_count: int,
         grid_length: float,
-        cull_percentage: float,
-    ) -> tuple[int, ...]:
+        bin_size: int,
+        light_position: tuple[float, float],
+    ) -> np.ndarray:
+        # returns the statistics of all ghosts. the results are stored on disk,
+        # keyed by the content of the lens model and the glasses
+        parameters = (
+            type(self).__name__,
+            tuple(sensor_size),
+            abbe_nr_adjustment,
+            tuple(coating),
+            coating_min_ior,
+            min_area,
+            fstop,
+            (resolution.width(), resolution.height()),
+            grid_count,
+            grid_length,
+            bin_size,
+            light_position,
+        )
+        key = cache_key(lens_model, glasses_path, parameters)
+        cache_path = os.path.join(storage.cache_path, 'preprocess', f'{key}.npy')
+        stats = read_cache(cache_path, ghost_stats_dtype)
+        if stats is not None:
+            logger.debug(f'preprocess: read {len(stats)} ghosts from {cache_path}')
+            return stats
+
         # args
-        grid_count = 3
-        grid_length = grid_length * 0.01
-        resolution = QtCore.QSize(100, 100)
-        light_position = (0, 0)
-        wavelength_count = 1
+        # coatings reflect differently across the spectrum
+        wavelength_count = 3
+        # the rays are traced on a coarse grid, the bins are scaled to the quads of
+        # the render grid
+        stats_grid_count = STATS_GRID_COUNT
+        subdivisions = (grid_count - 1) / (stats_grid_count - 1)
         path_indexes = tuple()
 
         rays = self.raytracing_task.raytrace(
@@ -64,7 +331,7 @@ class PreprocessTask(OpenCL):
             abbe_nr_adjustment=abbe_nr_adjustment,
             coating=coating,
             coating_min_ior=coating_min_ior,
-            grid_count=grid_count,
+            grid_count=stats_grid_count,
             grid_length=grid_length,
             light_position=light_position,
             resolution=resolution,
@@ -73,36 +340,184 @@ class PreprocessTask(OpenCL):
         )
 
         if rays is None:
-            return tuple()
+            return np.zeros(0, ghost_stats_dtype)
 
-        areas = self.update_areas(rays)
+        area_orig = (grid_length / (stats_grid_count - 1)) ** 2
 
-        # cull path_indexes up to cull_percentage
-        sorted_areas = sorted(areas.items(), key=lambda item: item[1])
-        index_to_keep = int(len(sorted_areas) * (1 - cull_percentage))
-        path_indexes = tuple(int(k) for k, v in sorted_areas[:index_to_keep])
+        # the ghost texture covers the aperture plane up to the ghost scale
+        aperture_radius = 1 - fstop / 32
 
-        return path_indexes
+        # half the size of the frame in sensor space
+        transform = screen_transform(resolution, sensor_size)
+        frame = (
+            resolution.width() / 2 / transform,
+            resolution.height() / 2 / transform,
+        )
 
-    @timer
-    def run(self, project: Project) -> tuple[int, ...]:
+        stats = self.update_stats(
+            rays,
+            stats_grid_count,
+            area_orig,
+            min_area * area_orig,
+            aperture_radius,
+            frame,
+            transform,
+            resolution,
+            bin_size,
+            subdivisions,
+        )
+        logger.debug(
+            f'preprocess: {len(stats)} ghosts, '
+            f'peak intensity {np.max(stats["peak"], initial=0):.2f}'
+        )
+        write_cache(cache_path, stats)
+        return stats
+
+    def stats(self, project: Project) -> np.ndarray:
         lens = project.flare.lens
         sensor_size = lens.sensor_size.width(), lens.sensor_size.height()
         lens_model = api_lens.model_from_path(lens.lens_model_path)
 
-        path_indexes = self.preprocess(
+        # the ghosts are ranked at the center of the frame unless they are culled
+        # per frame, image based flares have lights across the whole frame
+        light = project.flare.light
+        light_position = (0.0, 0.0)
+        if project.render.cull_per_frame and not light.image_file_enabled:
+            light_position = tuple(
+                round(value * LIGHT_POSITION_STEPS) / LIGHT_POSITION_STEPS
+                for value in (light.position.x(), light.position.y())
+            )
+
+        stats = self.preprocess(
             lens_model=lens_model,
             sensor_size=sensor_size,
             glasses_path=lens.glasses_path,
             abbe_nr_adjustment=lens.abbe_nr_adjustment,
             coating=lens.coating,
             coating_min_ior=lens.coating_min_ior,
+            min_area=lens.min_area,
+            fstop=lens.fstop,
+            resolution=project.render.resolution,
+            grid_count=project.render.grid_count,
             grid_length=project.render.grid_length,
-            cull_percentage=project.render.cull_percentage,
+            bin_size=project.render.bin_size,
+            light_position=light_position,
+        )
+        return stats
+
+    def report(self, project: Project) -> np.ndarray:
+        # returns the statistics of all ghosts and whether they are culled
+        stats = self.stats(project)
+        path_indexes = cull_ghosts(
+            stats['energy'],
+            project.render.cull_percentage,
+            project.render.cull_energy,
+        )
+
+        report = np.zeros(len(stats), ghost_report_dtype)
+        report['path'] = np.arange(len(stats))
+        for name in ('energy', 'peak', 'area', 'valid'):
+            report[name] = stats[name]
+        bounds = stats['bounds']
+        report['bounds'] = np.stack([bounds[c] for c in 'xyzw'], axis=-1)
+        report['cost'] = stats['bins'] * project.render.wavelength_count
+        report['culled'] = True
+        report['culled'][list(path_indexes)] = False
+        return report
+
+    @timer
+    def run(self, project: Project) -> tuple[int, ...]:
+        stats = self.stats(project)
+        path_indexes = cull_ghosts(
+            stats['energy'],
+            project.render.cull_percentage,
+            project.render.cull_energy,
         )
+        logger.debug(f'preprocess: kept {len(path_indexes)} of {len(stats)} ghosts')
         return path_indexes
 
 
+def fold_quadrants(array: np.ndarray) -> np.ndarray:
+    # returns the pixels of the upper left quadrant together with the pixels that
+    # are mirrored along the axes: [y, x], [h - y - 1, x], [h - y - 1, w - x - 1],
+    # [y, w - x - 1]. the flare of a light is flipped to get the mirrored flares.
+    height, width = array.shape[:2]
+    half_height, half_width = height // 2, width // 2
+    quadrants = (
+        array,
+        np.flip(array, 0),
+        np.flip(array, (0, 1)),
+        np.flip(array, 1),
+    )
+    return np.stack([q[:half_height, :half_width] for q in quadrants], axis=2)
+
+
+def ndc_positions(positions: np.ndarray, shape: tuple[int, int]) -> np.ndarray:
+    # converts (x, y) pixel positions of the folded quadrant to NDC space
+    half_height, half_width = shape
+    x = (positions[:, 0] + 0.5) / half_width - 1
+    y = 1 - (positions[:, 1] + 0.5) / half_height
+    return np.stack((x, y), axis=-1)
+
+
+def image_lights(folded: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # returns the position of every pixel with a value and the values of the
+    # four mirrored lights
+    y, x = np.nonzero(np.sum(folded, axis=(2, 3)))
+    positions = np.stack((x, y), axis=-1)
+    positions = ndc_positions(positions, folded.shape[:2])
+    return positions, folded[y, x]
+
+
+def cluster_lights(folded: np.ndarray, count: int) -> tuple[np.ndarray, np.ndarray]:
+    # merges the pixels into at most count lights with a quadtree. the node with the
+    # largest energy weighted spread is split until there are count nodes. each
+    # light sits at the energy weighted centroid of its node and its value is the
+    # sum of the values of the node, so that the energy of the image is preserved.
+    energy = np.sum(folded[..., :3], axis=(2, 3))
+    height, width = energy.shape
+
+    def node(y0: int, y1: int, x0: int, x1: int) -> tuple | None:
+        weights = energy[y0:y1, x0:x1]
+        total = np.sum(weights, dtype=np.float64)
+        if total <= 0:
+            return None
+        y, x = np.mgrid[y0:y1, x0:x1]
+        center = np.sum(weights * x) / total, np.sum(weights * y) / total
+        spread = np.sum(weights * ((x - center[0]) ** 2 + (y - center[1]) ** 2))
+        return -spread, (y0, y1, x0, x1), center
+
+    nodes = [n for n in (node(0, height, 0, width),) if n is not None]
+    while 0 < len(nodes) < count and nodes[0][0] < 0:
+        _, (y0, y1, x0, x1), _ = heapq.heappop(nodes)
+        y_mid, x_mid = (y0 + y1 + 1) // 2, (x0 + x1 + 1) // 2
+        if len(nodes) + 4 <= count:
+            children = (
+                (y0, y_mid, x0, x_mid),
+                (y0, y_mid, x_mid, x1),
+                (y_mid, y1, x0, x_mid),
+                (y_mid, y1, x_mid, x1),
+            )
+        elif y1 - y0 > x1 - x0:
+            # only two nodes are left, the node is split along its longer side
+            children = ((y0, y_mid, x0, x1), (y_mid, y1, x0, x1))
+        else:
+            children = ((y0, y1, x0, x_mid), (y0, y1, x_mid, x1))
+        for bounds in children:
+            if bounds[0] < bounds[1] and bounds[2] < bounds[3]:
+                child = node(*bounds)
+                if child is not None:
+                    heapq.heappush(nodes, child)
+
+    positions = np.zeros((len(nodes), 2), np.float32)
+    values = np.zeros((len(nodes),) + folded.shape[2:], np.float32)
+    for i, (_, (y0, y1, x0, x1), center) in enumerate(nodes):
+        positions[i] = center
+        values[i] = np.sum(folded[y0:y1, x0:x1], axis=(0, 1))
+    positions = ndc_positions(positions, folded.shape[:2])
+    return positions, values
+
+
 class ImageSamplingTask(OpenCL):
     def __init__(self, queue: cl.CommandQueue) -> None:
         super().__init__(queue)
@@ -126,6 +541,13 @@ class ImageSamplingTask(OpenCL):
 
         return array
 
+    @lru_cache(1)
+    def update_light_image(self, file: File, resolution: QtCore.QSize) -> np.ndarray:
+        # returns the image resized to the render resolution
+        array = self.load_file(file)
+        array = cv2.resize(array, (resolution.width(), resolution.height()))
+        return array
+
     @lru_cache(1)
     def update_sample_data(
         self, file: File, resolution: QtCore.QSize, samples: int
@@ -159,13 +581,25 @@ class ImageSamplingTask(OpenCL):
 
         return rgba
 
-    @timer
-    def run(self, project: Project) -> np.ndarray:
-        # file
-        file_path = storage.decode_path(project.flare.light.image_file)
-        file = File(file_path)
+    @lru_cache(1)
+    def update_clusters(
+        self, file: File, resolution: QtCore.QSize, count: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        array = self.load_file(file)
 
-        # resolution
+        # area interpolation keeps the energy of the image
+        array = cv2.resize(
+            array,
+            (resolution.width(), resolution.height()),
+            interpolation=cv2.INTER_AREA,
+        )
+        rgba = np.dstack((array, np.zeros(array.shape[:-1], np.float32)))
+
+        positions, values = cluster_lights(fold_quadrants(rgba), count)
+        logger.debug(f'image sampling: {len(positions)} clusters')
+        return positions, values
+
+    def sample_resolution(self, project: Project) -> QtCore.QSize:
         width = max(project.flare.light.image_sample_resolution, 1)
         if width % 2 != 0:
             width += 1
@@ -175,7 +609,26 @@ class ImageSamplingTask(OpenCL):
         height = width * ratio
         if height % 2 != 0:
             height += 1
-        sample_resolution = QtCore.QSize(width, height)
+        return QtCore.QSize(width, height)
+
+    def lights(self, project: Project) -> tuple[np.ndarray, np.ndarray]:
+        # returns the positions of the lights in the upper left quadrant and the
+        # values of the four mirrored lights, see fold_quadrants
+        light = project.flare.light
+        if light.image_clustering:
+            file = File(storage.decode_path(light.image_file))
+            resolution = self.sample_resolution(project)
+            return self.update_clusters(file, resolution, light.image_samples)
+        return image_lights(fold_quadrants(self.run(project)))
+
+    @timer
+    def run(self, project: Project) -> np.ndarray:
+        # file
+        file_path = storage.decode_path(project.flare.light.image_file)
+        file = File(file_path)
+
+        # resolution
+        sample_resolution = self.sample_resolution(project)
 
         # samples
         samples = project.flare.light.image_samples
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import dataclasses
 import logging
 from functools import lru_cache
 
@@ -8,16 +9,30 @@ import pyopencl as cl
 from PySide2 import QtCore
 
 from qt_extensions.typeutils import basic
-from realflare.api.data import Render, Project
+from realflare.api.data import (
+    Render,
+    Project,
+    Binning,
+    RealflareError,
+    RegionOfInterest,
+    SpectralSampling,
+    roi_box,
+)
 from realflare.api.tasks.opencl import (
     OpenCL,
     ray_dtype,
     vertex_dtype,
+    packed_vertex_dtype,
     LAMBDA_MIN,
     LAMBDA_MAX,
     Buffer,
     Image,
 )
+from realflare.api.tasks.raytracing import (
+    screen_transform,
+    spectral_pdf,
+    importance_wavelength,
+)
 from realflare.utils.ciexyz import CIEXYZ
 from realflare.utils.timing import timer
 
@@ -25,6 +40,33 @@ logger = logging.getLogger(__name__)
 
 BATCH_PRIMITIVE_COUNT = 255
 
+# sample offsets for y coordinate based on n-rook pattern.
+# https://learn.microsoft.com/en-us/windows/win32/api/d3d11/ne-d3d11-d3d11_standard_multisample_quality_levels
+SUB_OFFSETS = (0, 1, 0, 1, 2, 0, 3, 4, 1, 6, 2, 5, 0, 3, 7)
+
+# super bins of the hierarchical binner are SUPER_BIN_FACTOR² bins
+SUPER_BIN_FACTOR = 4
+
+# upper limit of the work-group size of the tile rasterizer
+TILE_WORK_GROUP_SIZE = 256
+
+# resolution scales of the levels for downsampled ghosts
+LEVEL_SCALES = (2, 4)
+
+# subpixel steps of the fixed point positions of packed vertexes
+FIXED_POINT_SCALE = 256
+
+# kernels that are built a second time to read packed vertexes
+PACKED_KERNELS = ('rasterizer', 'rasterizer_compact', 'rasterizer_tile', 'splatter')
+
+
+def tile_size(bin_size: int, work_group_size: int) -> int:
+    # returns the largest divisor of bin_size that fits a square work-group
+    size = int(np.sqrt(min(work_group_size, TILE_WORK_GROUP_SIZE)))
+    while bin_size % size:
+        size -= 1
+    return size
+
 
 def triangle_vertexes(n) -> list[tuple[int, int, int]]:
     # returns a list of tuples (vertex indexes per triangle)
@@ -58,8 +100,26 @@ def quad_vertexes(n: int) -> list[tuple[int, int, int, int]]:
     return indexes
 
 
+def spectrum_positions(
+    wavelength_count: int, wavelength_sub_count: int
+) -> np.ndarray:
+    # returns the positions at which the rasterizer reads the light spectrum
+    wavelength_ids = np.arange(max(wavelength_count - 1, 1))
+    sub_steps = np.arange(wavelength_sub_count) / wavelength_sub_count
+    positions = wavelength_ids[:, np.newaxis] + 0.5 + sub_steps[np.newaxis, :]
+    return positions.ravel() / wavelength_count
+
+
+def sample_spectrum(spectrum: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    # samples the xyz values of the spectrum (n, 4) like the linear image sampler
+    texels = positions * len(spectrum) - 0.5
+    indexes = np.arange(len(spectrum))
+    return np.stack([np.interp(texels, indexes, spectrum[:, i]) for i in range(3)])
+
+
 class RasterizingTask(OpenCL):
     bin_size = 32
+    tile_size = 1
 
     def __init__(self, queue) -> None:
         super().__init__(queue)
@@ -67,48 +127,96 @@ class RasterizingTask(OpenCL):
         self.build()
 
     def build(self, *args, **kwargs) -> None:
+        # the work-group of the tile rasterizer is limited by the kernel, which is
+        # only known after building it. the kernels are rebuilt with a smaller
+        # tile until the work-group fits.
+        device = self.queue.device
+        self.tile_size = tile_size(self.bin_size, device.max_work_group_size)
+        self.build_program()
+        self.fit_tile_size()
+
+    def build_packed(self) -> None:
+        # the rasterizer kernels for packed vertexes are only built when needed
+        self.build_packed_program()
+        self.fit_tile_size()
+
+    def fit_tile_size(self) -> None:
+        names = [name for name in self.kernels if name.startswith('rasterizer_tile')]
+        device = self.queue.device
+        while True:
+            work_group_size = min(
+                self.kernels[name].get_work_group_info(
+                    cl.kernel_work_group_info.WORK_GROUP_SIZE, device
+                )
+                for name in names
+            )
+            size = tile_size(self.bin_size, work_group_size)
+            if size >= self.tile_size:
+                return
+            logger.debug(f'tile size lowered to {size} by the kernel work-group size')
+            self.tile_size = size
+            packed = 'rasterizer_tile_packed' in self.kernels
+            self.build_program()
+            if packed:
+                self.build_packed_program()
+
+    def build_program(self) -> None:
         self.source = ''
         self.source += f'#define BATCH_PRIMITIVE_COUNT {BATCH_PRIMITIVE_COUNT}\n'
+        self.source += f'#define SUPER_BIN_FACTOR {SUPER_BIN_FACTOR}\n'
+        self.source += f'#define FIXED_POINT_SCALE {FIXED_POINT_SCALE}\n'
 
         self.register_dtype('Ray', ray_dtype)
         self.register_dtype('Vertex', vertex_dtype)
+        self.register_dtype('PackedVertex', packed_vertex_dtype)
 
-        # sample offsets for y coordinate based on n-rook pattern.
-        # https://learn.microsoft.com/en-us/windows/win32/api/d3d11/ne-d3d11-d3d11_standard_multisample_quality_levels
-        sub_offsets = []
-        sub_offsets.extend([0])
-        sub_offsets.extend([1, 0])
-        sub_offsets.extend([1, 2, 0, 3])
-        sub_offsets.extend([4, 1, 6, 2, 5, 0, 3, 7])
-        # append all values into an array
-        array_str = ', '.join(map(str, sub_offsets))
+        array_str = ', '.join(map(str, SUB_OFFSETS))
         self.source += (
-            f'__constant uchar sub_offsets[{len(sub_offsets)}] = {{{array_str}}};\n'
+            f'__constant uchar sub_offsets[{len(SUB_OFFSETS)}] = {{{array_str}}};\n'
         )
         self.source += f'__constant int BIN_SIZE = {self.bin_size};\n'
+
+        # each work-item of the tile rasterizer shades TILE_STEPS² pixels of a bin
+        size = self.tile_size
+        steps = self.bin_size // size
+        self.source += f'#define TILE_SIZE {size}\n'
+        self.source += f'#define TILE_STEPS {steps}\n'
+        self.source += f'#define TILE_PIXEL_COUNT {steps * steps}\n'
         self.source += f'__constant int LAMBDA_MIN = {LAMBDA_MIN};\n'
         self.source += f'__constant int LAMBDA_MAX = {LAMBDA_MAX};\n'
         self.source += self.read_source_file('color.cl')
+        self.source += self.read_source_file('primitives.cl')
         self.source += self.read_source_file('rasterizing.cl')
 
         super().build()
 
         self.kernels = {
             'prim_shader': cl.Kernel(self.program, 'prim_shader'),
+            'prim_shader_vertexes': cl.Kernel(self.program, 'prim_shader_vertexes'),
             'vertex_shader': cl.Kernel(self.program, 'vertex_shader'),
+            'vertex_intensities': cl.Kernel(self.program, 'vertex_intensities'),
+            'compact_primitives': cl.Kernel(self.program, 'compact_primitives'),
+            'morton_keys': cl.Kernel(self.program, 'morton_keys'),
+            'bitonic_sort': cl.Kernel(self.program, 'bitonic_sort'),
+            'gather_primitives': cl.Kernel(self.program, 'gather_primitives'),
             'binner': cl.Kernel(self.program, 'binner'),
+            'binner_compact': cl.Kernel(self.program, 'binner_compact'),
+            'binner_fine': cl.Kernel(self.program, 'binner_fine'),
             'rasterizer': cl.Kernel(self.program, 'rasterizer'),
+            'rasterizer_compact': cl.Kernel(self.program, 'rasterizer_compact'),
+            'rasterizer_tile': cl.Kernel(self.program, 'rasterizer_tile'),
+            'splatter': cl.Kernel(self.program, 'splatter'),
+            'splat_resolve': cl.Kernel(self.program, 'splat_resolve'),
+            'scale_vertexes': cl.Kernel(self.program, 'scale_vertexes'),
+            'upsample_level': cl.Kernel(self.program, 'upsample_level'),
+            'pack_vertexes': cl.Kernel(self.program, 'pack_vertexes'),
         }
 
-        # device = self.queue.get_info(cl.command_queue_info.DEVICE)
-        # kernel_work_group_size = self.kernels['rasterizer'].get_work_group_info(
-        #     cl.kernel_work_group_info.WORK_GROUP_SIZE, device
-        # )
-        # private_mem_size = self.kernels['rasterizer'].get_work_group_info(
-        #     cl.kernel_work_group_info.PRIVATE_MEM_SIZE, device
-        # )
-        # logger.debug(f'{private_mem_size:=}')
-        # logger.debug(f'{kernel_work_group_size:=}')
+    def build_packed_program(self) -> None:
+        program = cl.Program(self.context, self.source)
+        program.build(options=['-D', 'PACKED_VERTEXES'])
+        for name in PACKED_KERNELS:
+            self.kernels[f'{name}_packed'] = cl.Kernel(program, name)
 
     @lru_cache(1)
     def update_quads(self, grid_count: int) -> Buffer:
@@ -159,19 +267,46 @@ class RasterizingTask(OpenCL):
     def update_screen_transform(
         self, resolution: QtCore.QSize, sensor_size: tuple[float, float]
     ) -> float:
-        sensor_length = np.linalg.norm((sensor_size[0], sensor_size[1])) / 2
-        try:
-            screen_transform = resolution.width() / sensor_length
-        except ZeroDivisionError:
-            screen_transform = 0
-        return screen_transform
+        return screen_transform(resolution, sensor_size)
 
     @lru_cache(1)
-    def update_light_spectrum(self) -> Image:
+    def update_light_spectrum(
+        self,
+        spectral_sampling: SpectralSampling = SpectralSampling.UNIFORM,
+        wavelength_count: int = 1,
+        wavelength_sub_count: int = 1,
+    ) -> Image:
         # extract XYZ data for visible wavelengths only
         xyz = [[x, y, z, 0] for w, x, y, z in CIEXYZ if LAMBDA_MIN <= w < LAMBDA_MAX]
         array = np.array(xyz, np.float32)
 
+        if spectral_sampling == SpectralSampling.IMPORTANCE and wavelength_count > 1:
+            # the rasterizer reads the spectrum at the positions (i + 0.5) / n of the
+            # wavelengths and their sub steps, which only covers n - 1 of n intervals.
+            # warp the spectrum so that these positions are the centers of equal
+            # parts of the distribution and the colors are divided by the density
+            # of the wavelength. the traced wavelengths use the same distribution,
+            # see wavelength_array.
+            wavelengths, pdf = spectral_pdf()
+            position = (np.arange(len(array)) + 0.5) / len(array)
+            offset = 0.5 / wavelength_sub_count
+            step = (position * wavelength_count - 0.5 + offset) / (wavelength_count - 1)
+            wavelength = importance_wavelength(np.clip(step, 0, 1))
+            density = np.interp(wavelength, wavelengths, pdf)
+            weight = 1 / (density * (LAMBDA_MAX - LAMBDA_MIN))
+            uniform = array.copy()
+            cie = np.array(CIEXYZ, np.float64)
+            for i in range(3):
+                channel = np.interp(wavelength, cie[:, 0], cie[:, i + 1])
+                array[:, i] = channel * weight
+
+            # a white ghost has the same brightness as with uniform sampling of the
+            # same amount of wavelengths, so switching the mode keeps the exposure
+            positions = spectrum_positions(wavelength_count, wavelength_sub_count)
+            scale = np.sum(sample_spectrum(uniform, positions))
+            scale /= np.sum(sample_spectrum(array, positions))
+            array[:, :3] *= scale
+
         # pyopencl does not handle 1d images so convert to 2d array with 4 channels
         array = np.reshape(array, (1, -1, 4))
 
@@ -207,33 +342,204 @@ class RasterizingTask(OpenCL):
         buffer = Buffer(self.context, array=bin_queues, buffer=bin_queues_cl)
         return buffer
 
+    @lru_cache(1)
+    def update_bin_counts(self, bin_count: int, batch_count: int) -> Buffer:
+        # primitive count per bin and batch
+        bin_counts = np.zeros((bin_count, batch_count), np.int32)
+        flags = cl.mem_flags.READ_WRITE
+        bin_counts_cl = cl.Buffer(self.context, flags, size=bin_counts.nbytes)
+        buffer = Buffer(self.context, array=bin_counts, buffer=bin_counts_cl)
+        return buffer
+
+    @lru_cache(1)
+    def update_bin_primitives(self, primitive_count: int) -> Buffer:
+        # compacted primitive indexes of all bins
+        bin_primitives = np.zeros(max(primitive_count, 1), np.int32)
+        flags = cl.mem_flags.READ_WRITE
+        bin_primitives_cl = cl.Buffer(self.context, flags, size=bin_primitives.nbytes)
+        buffer = Buffer(self.context, array=bin_primitives, buffer=bin_primitives_cl)
+        return buffer
+
+    @lru_cache(1)
+    def update_layers(self, layer_count: int, size: QtCore.QSize) -> Buffer | None:
+        # rgb accumulation buffer for the ghost layers of the rendered window
+        if layer_count <= 0:
+            return None
+        shape = (layer_count, size.height(), size.width(), 3)
+        nbytes = int(np.prod(shape)) * 4
+        max_size = self.queue.device.max_mem_alloc_size
+        if nbytes > max_size:
+            message = (
+                f'{layer_count} ghost layers at {size.width()}x{size.height()} need '
+                f'{nbytes / 1024 ** 3:.2f} GB, the device only allows '
+                f'{max_size / 1024 ** 3:.2f} GB per buffer. Lower the strip height, '
+                f'the region of interest or the amount of layers.'
+            )
+            raise RealflareError(message)
+        array = np.zeros(shape, np.float32)
+        flags = cl.mem_flags.READ_WRITE
+        layers_cl = cl.Buffer(self.context, flags, size=array.nbytes)
+        buffer = Buffer(self.context, array=array, buffer=layers_cl)
+        return buffer
+
+    @lru_cache(1)
+    def update_path_layers(self, path_layers: tuple[int, ...]) -> Buffer:
+        # the layer of each path, -1 for paths without layer
+        array = np.int32(path_layers if path_layers else (-1,))
+        buffer = Buffer(self.context, array=array, args=path_layers)
+        return buffer
+
     @timer
     @lru_cache(1)
-    def prim_shader(self, bounds: Buffer, _intensities: Buffer) -> cl.Event:
+    def prim_shader(
+        self, bounds: Buffer, _intensities: Buffer, kernel: str = 'prim_shader'
+    ) -> cl.Event:
         # intensities used for lru_cache
 
         global_work_size = bounds.shape
         local_work_size = None
         prim_event = cl.enqueue_nd_range_kernel(
-            self.queue, self.kernels['prim_shader'], global_work_size, local_work_size
+            self.queue, self.kernels[kernel], global_work_size, local_work_size
         )
         prim_event.wait()
         return prim_event
 
     @timer
     @lru_cache(1)
-    def vertex_shader(self, vertexes: Buffer) -> cl.Event:
+    def vertex_shader(
+        self, vertexes: Buffer, kernel: str = 'vertex_shader'
+    ) -> cl.Event:
         global_work_size = vertexes.array.shape
         local_work_size = None
         vertex_event = cl.enqueue_nd_range_kernel(
             self.queue,
-            self.kernels['vertex_shader'],
+            self.kernels[kernel],
             global_work_size,
             local_work_size,
         )
         vertex_event.wait()
         return vertex_event
 
+    @timer
+    @lru_cache(1 + len(LEVEL_SCALES))
+    def compact_primitives(self, bounds: Buffer) -> tuple[Buffer, Buffer, int]:
+        # returns the ids and bounds of the primitives that are not degenerate or
+        # culled and their count. the bounds are padded to whole batches for the binner.
+        primitive_count = bounds.array.size
+        chunk_count = max(int(np.ceil(primitive_count / BATCH_PRIMITIVE_COUNT)), 1)
+        global_work_size = (chunk_count,)
+        local_work_size = None
+        kernel = self.kernels['compact_primitives']
+        flags = cl.mem_flags.READ_WRITE
+
+        # count pass
+        chunk_counts = np.zeros(chunk_count, np.int32)
+        chunk_counts_cl = cl.Buffer(self.context, flags, size=chunk_counts.nbytes)
+        kernel.set_arg(0, chunk_counts_cl)
+        kernel.set_arg(1, None)
+        kernel.set_arg(2, None)
+        kernel.set_arg(3, None)
+        kernel.set_arg(4, bounds.buffer)
+        kernel.set_arg(5, np.int32(primitive_count))
+        kernel.set_arg(6, np.int32(False))
+        cl.enqueue_nd_range_kernel(
+            self.queue, kernel, global_work_size, local_work_size
+        )
+        cl.enqueue_copy(self.queue, chunk_counts, chunk_counts_cl)
+
+        # prefix sum, the primitives keep their order
+        chunk_offsets = np.cumsum(chunk_counts, dtype=np.int32) - chunk_counts
+        compact_count = int(np.sum(chunk_counts))
+        chunk_offsets = Buffer(self.context, array=chunk_offsets)
+
+        # scatter pass
+        batch_count = max(int(np.ceil(compact_count / BATCH_PRIMITIVE_COUNT)), 1)
+        primitive_ids = np.zeros(max(compact_count, 1), np.int32)
+        primitive_ids_cl = cl.Buffer(self.context, flags, size=primitive_ids.nbytes)
+        primitive_ids = Buffer(
+            self.context, array=primitive_ids, buffer=primitive_ids_cl, args=bounds
+        )
+        compact_bounds = np.zeros(
+            batch_count * BATCH_PRIMITIVE_COUNT, cl.cltypes.float4
+        )
+        compact_bounds_cl = cl.Buffer(self.context, flags, size=compact_bounds.nbytes)
+        compact_bounds = Buffer(
+            self.context, array=compact_bounds, buffer=compact_bounds_cl, args=bounds
+        )
+        kernel.set_arg(1, primitive_ids.buffer)
+        kernel.set_arg(2, compact_bounds.buffer)
+        kernel.set_arg(3, chunk_offsets.buffer)
+        kernel.set_arg(6, np.int32(True))
+        scatter_event = cl.enqueue_nd_range_kernel(
+            self.queue, kernel, global_work_size, local_work_size
+        )
+        scatter_event.wait()
+        return primitive_ids, compact_bounds, compact_count
+
+    @timer
+    @lru_cache(1 + len(LEVEL_SCALES))
+    def sort_primitives(
+        self,
+        primitive_ids: Buffer,
+        compact_bounds: Buffer,
+        primitive_count: int,
+        screen_transform: float,
+        resolution: tuple[int, int],
+    ) -> tuple[Buffer, Buffer]:
+        # sorts the compacted primitives by the morton code of the center of their
+        # bounds, so that the primitives of a batch are close to each other on screen
+        if primitive_count < 2:
+            return primitive_ids, compact_bounds
+
+        # bitonic sort requires a power of two amount of keys
+        key_count = 1 << (primitive_count - 1).bit_length()
+        flags = cl.mem_flags.READ_WRITE
+        keys_cl = cl.Buffer(self.context, flags, size=key_count * 8)
+
+        kernel = self.kernels['morton_keys']
+        kernel.set_arg(0, keys_cl)
+        kernel.set_arg(1, compact_bounds.buffer)
+        kernel.set_arg(2, np.int32(primitive_count))
+        kernel.set_arg(3, np.float32(screen_transform))
+        kernel.set_arg(4, np.int32(resolution))
+        cl.enqueue_nd_range_kernel(self.queue, kernel, (key_count,), None)
+
+        kernel = self.kernels['bitonic_sort']
+        kernel.set_arg(0, keys_cl)
+        size = 2
+        while size <= key_count:
+            stride = size // 2
+            while stride > 0:
+                kernel.set_arg(1, np.int32(size))
+                kernel.set_arg(2, np.int32(stride))
+                cl.enqueue_nd_range_kernel(self.queue, kernel, (key_count,), None)
+                stride //= 2
+            size *= 2
+
+        args = (primitive_ids, screen_transform, resolution)
+        sorted_ids = np.zeros_like(primitive_ids.array)
+        sorted_ids_cl = cl.Buffer(self.context, flags, size=sorted_ids.nbytes)
+        sorted_ids = Buffer(
+            self.context, array=sorted_ids, buffer=sorted_ids_cl, args=args
+        )
+        sorted_bounds = np.zeros_like(compact_bounds.array)
+        sorted_bounds_cl = cl.Buffer(self.context, flags, size=sorted_bounds.nbytes)
+        sorted_bounds = Buffer(
+            self.context, array=sorted_bounds, buffer=sorted_bounds_cl, args=args
+        )
+
+        kernel = self.kernels['gather_primitives']
+        kernel.set_arg(0, sorted_ids.buffer)
+        kernel.set_arg(1, sorted_bounds.buffer)
+        kernel.set_arg(2, keys_cl)
+        kernel.set_arg(3, primitive_ids.buffer)
+        kernel.set_arg(4, compact_bounds.buffer)
+        gather_event = cl.enqueue_nd_range_kernel(
+            self.queue, kernel, (primitive_count,), None
+        )
+        gather_event.wait()
+        return sorted_ids, sorted_bounds
+
     @timer
     @lru_cache(1)
     def binner(self, _bin_queues: Buffer, batch_count: int) -> cl.Event:
@@ -256,34 +562,243 @@ class RasterizingTask(OpenCL):
 
     @timer
     @lru_cache(1)
-    def rasterizer(self, flare_image: Image) -> cl.Event:
-        h, w = flare_image.array.shape[:2]
+    def compact_binner(
+        self, bin_counts: Buffer, batch_count: int
+    ) -> tuple[Buffer, Buffer]:
+        # bin_counts used for lru_cache
+
+        device = self.queue.get_info(cl.command_queue_info.DEVICE)
+        work_group_size = device.get_info(cl.device_info.MAX_WORK_GROUP_SIZE)
+        global_work_size = (batch_count * work_group_size,)
+        local_work_size = (work_group_size,)
+        kernel = self.kernels['binner_compact']
+
+        # count pass
+        kernel.set_arg(0, bin_counts.buffer)
+        kernel.set_arg(1, None)
+        kernel.set_arg(2, None)
+        kernel.set_arg(9, np.int32(False))
+        cl.enqueue_nd_range_kernel(
+            self.queue, kernel, global_work_size, local_work_size
+        )
+        cl.enqueue_copy(self.queue, bin_counts.array, bin_counts.buffer)
+
+        # prefix sum, the primitives of a bin are stored in batch order
+        counts = bin_counts.array.ravel()
+        batch_offsets = np.cumsum(counts, dtype=np.int32) - counts
+        primitive_count = int(np.sum(counts))
+        bin_offsets = np.append(batch_offsets[::batch_count], primitive_count)
+        bin_offsets = Buffer(self.context, array=np.int32(bin_offsets))
+        batch_offsets = Buffer(self.context, array=batch_offsets)
+
+        # scatter pass
+        bin_primitives = self.update_bin_primitives(primitive_count)
+        kernel.set_arg(1, bin_primitives.buffer)
+        kernel.set_arg(2, batch_offsets.buffer)
+        kernel.set_arg(9, np.int32(True))
+        scatter_event = cl.enqueue_nd_range_kernel(
+            self.queue, kernel, global_work_size, local_work_size
+        )
+        scatter_event.wait()
+        return bin_primitives, bin_offsets
+
+    @lru_cache(10)
+    def update_local_primitive_count(self, wavelength_count: int) -> int:
+        # amount of primitives whose vertexes fit into half of the local memory
+        local_mem_size = self.queue.device.local_mem_size
+        primitive_size = 4 * wavelength_count * self.dtypes['Vertex'].itemsize
+        return int(np.clip(local_mem_size // 2 // primitive_size, 1, 64))
+
+    @timer
+    @lru_cache(1)
+    def fine_binner(
+        self, _super_counts: Buffer, bin_dims: tuple[int, int]
+    ) -> tuple[Buffer, Buffer]:
+        # super_counts used for lru_cache
+
+        global_work_size = tuple(map(int, bin_dims))
+        local_work_size = None
+        kernel = self.kernels['binner_fine']
+
+        # count pass
+        bin_counts = np.zeros(global_work_size[0] * global_work_size[1], np.int32)
+        flags = cl.mem_flags.READ_WRITE
+        bin_counts_cl = cl.Buffer(self.context, flags, size=bin_counts.nbytes)
+        kernel.set_arg(0, bin_counts_cl)
+        kernel.set_arg(1, None)
+        kernel.set_arg(2, None)
+        kernel.set_arg(9, np.int32(False))
+        cl.enqueue_nd_range_kernel(
+            self.queue, kernel, global_work_size, local_work_size
+        )
+        cl.enqueue_copy(self.queue, bin_counts, bin_counts_cl)
+
+        # prefix sum
+        bin_offsets = np.int32(np.append(0, np.cumsum(bin_counts)))
+        primitive_count = int(bin_offsets[-1])
+        bin_offsets = Buffer(self.context, array=bin_offsets)
+
+        # scatter pass
+        bin_primitives = np.zeros(max(primitive_count, 1), np.int32)
+        bin_primitives_cl = cl.Buffer(self.context, flags, size=bin_primitives.nbytes)
+        bin_primitives = Buffer(
+            self.context, array=bin_primitives, buffer=bin_primitives_cl
+        )
+        kernel.set_arg(1, bin_primitives.buffer)
+        kernel.set_arg(2, bin_offsets.buffer)
+        kernel.set_arg(9, np.int32(True))
+        scatter_event = cl.enqueue_nd_range_kernel(
+            self.queue, kernel, global_work_size, local_work_size
+        )
+        scatter_event.wait()
+        return bin_primitives, bin_offsets
+
+    @timer
+    @lru_cache(1)
+    def rasterizer(
+        self,
+        flare_image: Image,
+        kernel: str = 'rasterizer',
+        splat_paths: Buffer | None = None,
+        quad_count: int = 0,
+        levels: tuple[Image, ...] = (),
+        layers: Buffer | None = None,
+        read_back: bool = True,
+    ) -> cl.Event:
+        # the splats and levels are added to the image on the device, only the
+        # composited image is copied to the host. without read_back the image
+        # stays on the device.
+        w, h = flare_image.image.shape
 
         # clear image
         black = np.zeros((4,), np.float32)
         clear_event = cl.enqueue_fill_image(
             self.queue, flare_image.image, black, origin=(0, 0), region=(w, h)
         )
+        wait_for = [clear_event]
+        if layers is not None:
+            zero = np.zeros((1,), np.float32)
+            wait_for.append(
+                cl.enqueue_fill_buffer(
+                    self.queue, layers.buffer, zero, 0, layers.array.nbytes
+                )
+            )
 
         global_work_size = (w, h)
         local_work_size = None
+        if kernel.startswith('rasterizer_tile'):
+            # one work-group per bin
+            size = self.tile_size
+            x, y = self.update_bin_dims(self.bin_size, QtCore.QSize(w, h))
+            global_work_size = (int(x) * size, int(y) * size)
+            local_work_size = (size, size)
         event = cl.enqueue_nd_range_kernel(
             self.queue,
-            self.kernels['rasterizer'],
+            self.kernels[kernel],
             global_work_size,
             local_work_size,
-            wait_for=[clear_event],
+            wait_for=wait_for,
         )
-
+        if layers is not None:
+            cl.enqueue_copy(self.queue, layers.array, layers.buffer)
+
+        if splat_paths is None and not levels:
+            if read_back:
+                cl.enqueue_copy(
+                    self.queue,
+                    flare_image.array,
+                    flare_image.image,
+                    origin=(0, 0),
+                    region=(w, h),
+                )
+            return event
+
+        # the image is copied into a buffer that the splatter and the levels add to
+        composite = self.update_composite((w, h))
         cl.enqueue_copy(
             self.queue,
-            flare_image.array,
+            composite.buffer,
             flare_image.image,
+            offset=0,
             origin=(0, 0),
             region=(w, h),
         )
+        if splat_paths is not None:
+            # ghosts with small primitives are splatted on top
+            packed = kernel.endswith('_packed')
+            self.splatter(composite, splat_paths, quad_count, packed)
+
+        for level in levels:
+            # ghosts with large primitives are upsampled from their level
+            self.upsample(composite, level)
+
+        if read_back:
+            cl.enqueue_copy(self.queue, flare_image.array, composite.buffer)
+        else:
+            cl.enqueue_copy(
+                self.queue,
+                flare_image.image,
+                composite.buffer,
+                offset=0,
+                origin=(0, 0),
+                region=(w, h),
+            )
         return event
 
+    @lru_cache(1)
+    def update_composite(self, resolution: tuple[int, int]) -> Buffer:
+        # float4 pixels of the image in image order
+        w, h = resolution
+        array = np.zeros((h, w, 4), np.float32)
+        flags = cl.mem_flags.READ_WRITE
+        buffer_cl = cl.Buffer(self.context, flags, size=array.nbytes)
+        return Buffer(self.context, array=array, buffer=buffer_cl, args=resolution)
+
+    @lru_cache(1)
+    def update_accumulation(self, resolution: tuple[int, int]) -> Buffer:
+        # float4 energy of the splatted primitives in image order
+        w, h = resolution
+        array = np.zeros((h, w, 4), np.float32)
+        flags = cl.mem_flags.READ_WRITE
+        buffer_cl = cl.Buffer(self.context, flags, size=array.nbytes)
+        return Buffer(self.context, array=array, buffer=buffer_cl, args=resolution)
+
+    def splatter(
+        self,
+        composite: Buffer,
+        splat_paths: Buffer,
+        quad_count: int,
+        packed: bool = False,
+    ) -> None:
+        # splats the paths into an accumulation buffer and adds the resolved
+        # energy to composite
+        h, w = composite.array.shape[:2]
+        accumulation = self.update_accumulation((w, h))
+        zero = np.zeros((1,), np.float32)
+        cl.enqueue_fill_buffer(
+            self.queue, accumulation.buffer, zero, 0, accumulation.array.nbytes
+        )
+
+        kernel = self.kernels['splatter_packed' if packed else 'splatter']
+        kernel.set_arg(0, accumulation.buffer)
+        kernel.set_arg(4, splat_paths.buffer)
+        kernel.set_arg(11, np.int32((w, h)))
+        global_work_size = (splat_paths.array.size, quad_count)
+        cl.enqueue_nd_range_kernel(self.queue, kernel, global_work_size, None)
+
+        kernel = self.kernels['splat_resolve']
+        kernel.set_arg(0, composite.buffer)
+        kernel.set_arg(1, accumulation.buffer)
+        cl.enqueue_nd_range_kernel(self.queue, kernel, (w * h,), None)
+
+    def upsample(self, composite: Buffer, level: Image) -> None:
+        # adds the bilinearly upsampled level to composite
+        h, w = composite.array.shape[:2]
+        kernel = self.kernels['upsample_level']
+        kernel.set_arg(0, composite.buffer)
+        kernel.set_arg(1, level.image)
+        cl.enqueue_nd_range_kernel(self.queue, kernel, (w, h), None)
+
     @lru_cache(1)
     def update_image(
         self,
@@ -293,31 +808,13 @@ class RasterizingTask(OpenCL):
     ) -> Image:
         return super().update_image(resolution, channel_order, flags)
 
-    def rasterize(
+    def shade_rays(
         self,
         render: Render,
         rays: Buffer,
-        ghost: Image,
         sensor_size: tuple[float, float],
         min_area: float,
-        intensity: float,
-        fstop: float,
-    ) -> Image:
-        # rebuild kernel
-        bin_size_changed = render.bin_size != self.bin_size
-        if bin_size_changed:
-            self.bin_size = render.bin_size
-        if self.rebuild or bin_size_changed:
-            self.build()
-
-        # image
-        flare_image = self.update_image(
-            render.resolution, flags=cl.mem_flags.READ_WRITE
-        )
-
-        if rays is None:
-            return flare_image
-
+    ) -> tuple[Buffer, Buffer]:
         # prim shader
         path_count, wavelength_count, ray_count = rays.array.shape
         quad_count = (render.grid_count - 1) ** 2
@@ -363,34 +860,457 @@ class RasterizingTask(OpenCL):
         # cl.enqueue_copy(self.queue, vertexes.array, vertexes.buffer)
         # logger.debug(f'{vertexes[0, 120, 0]:=}')
 
-        # binner
-        bin_dims = self.update_bin_dims(render.bin_size, render.resolution)
+        return bounds, vertexes
+
+    def shade_vertexes(
+        self,
+        render: Render,
+        vertexes: Buffer,
+        sensor_size: tuple[float, float],
+        min_area: float,
+    ) -> tuple[Buffer, Buffer]:
+        # vertexes written by the fused raytracer only need bounds and intensities
+        path_count, ray_count, wavelength_count = vertexes.array.shape
+        quad_count = (render.grid_count - 1) ** 2
+        intensities_shape = (path_count, quad_count, wavelength_count)
+        bounds_shape = (path_count, quad_count)
+        resolution = render.resolution.width(), render.resolution.height()
+        screen_transform = self.update_screen_transform(render.resolution, sensor_size)
+
+        area_orig = self.update_area_orig(render.grid_count, render.grid_length)
+        rel_min_area = min_area * area_orig
+        bounds = self.update_bounds(bounds_shape)
+        bounds.args = (vertexes, rel_min_area)
+        intensities = self.update_intensities(intensities_shape)
+        intensities.args = (vertexes, area_orig, rel_min_area)
+
+        kernel = self.kernels['prim_shader_vertexes']
+        kernel.set_arg(0, bounds.buffer)
+        kernel.set_arg(1, intensities.buffer)
+        kernel.set_arg(2, vertexes.buffer)
+        kernel.set_arg(3, np.int32(render.grid_count))
+        kernel.set_arg(4, np.int32(ray_count))
+        kernel.set_arg(5, np.int32(wavelength_count))
+        kernel.set_arg(6, np.float32(area_orig))
+        kernel.set_arg(7, np.float32(rel_min_area))
+        kernel.set_arg(8, np.float32(screen_transform))
+        kernel.set_arg(9, np.int32(resolution))
+
+        self.prim_shader(bounds, intensities, 'prim_shader_vertexes')
+
+        # intensities are written into the vertexes in place
+        kernel = self.kernels['vertex_intensities']
+        kernel.set_arg(0, vertexes.buffer)
+        kernel.set_arg(1, intensities.buffer)
+        kernel.set_arg(2, np.int32(render.grid_count))
+
+        self.vertex_shader(vertexes, 'vertex_intensities')
+
+        return bounds, vertexes
+
+    def rasterize(
+        self,
+        render: Render,
+        rays: Buffer,
+        ghost: Image,
+        sensor_size: tuple[float, float],
+        min_area: float,
+        intensity: float,
+        fstop: float,
+        layers: tuple[str, ...] = (),
+        path_layers: tuple[int, ...] = (),
+    ) -> Image:
+        # rebuild kernel
+        bin_size_changed = render.bin_size != self.bin_size
+        if bin_size_changed:
+            self.bin_size = render.bin_size
+        if self.rebuild or bin_size_changed:
+            self.build()
+        if render.packed_vertexes and 'rasterizer_packed' not in self.kernels:
+            self.build_packed()
+
+        if rays is None:
+            image = self.update_image(render.resolution, flags=cl.mem_flags.READ_WRITE)
+            image.layers = {}
+            return image
+
+        if render.fused_raytracing:
+            bounds, vertexes = self.shade_vertexes(render, rays, sensor_size, min_area)
+        else:
+            bounds, vertexes = self.shade_rays(render, rays, sensor_size, min_area)
+        screen_transform = self.update_screen_transform(render.resolution, sensor_size)
+        window = self.update_window(render, bounds, screen_transform)
+
+        # the primitives of splatted and downsampled ghosts are removed from the
+        # bounds of the binner. with layers all ghosts are rasterized at full
+        # resolution, as only the rasterizer accumulates the layers.
+        splat_area = render.splat_area
+        downsample_area = render.downsample_area
+        if layers:
+            splat_area = downsample_area = 0
+        bounds, splat_paths = self.update_splat_paths(
+            bounds, screen_transform, splat_area
+        )
+        bounds, levels = self.update_levels(
+            bounds, screen_transform, downsample_area, render.resolution
+        )
+        levels = tuple(
+            self.rasterize_level(
+                scale,
+                render,
+                level_bounds,
+                vertexes,
+                ghost,
+                screen_transform,
+                intensity,
+                fstop,
+            )
+            for scale, level_bounds in levels
+        )
+        args = (
+            render,
+            bounds,
+            vertexes,
+            ghost,
+            screen_transform,
+            intensity,
+            fstop,
+            splat_paths,
+            levels,
+            self.update_path_layers(path_layers) if layers else None,
+        )
+
+        width, height = render.resolution.width(), render.resolution.height()
+        frame = QtCore.QRect(0, 0, width, height)
+        strip_height = render.strip_height
+        if window == frame and not 0 < strip_height < height:
+            flare_image = self.update_image(
+                render.resolution, flags=cl.mem_flags.READ_WRITE
+            )
+            layer_buffer = self.update_layers(len(layers), render.resolution)
+            self.rasterize_window(flare_image, (0, 0), *args, layer_buffer)
+            flare_image.data_window = window
+            flare_image.layers = {}
+            if layer_buffer is not None:
+                flare_image.layers = dict(zip(layers, layer_buffer.array))
+            return flare_image
+
+        # rasterize the window in horizontal strips, only one strip is stored on the
+        # device and copied into the frame on the host. the layers are only stored
+        # for the window.
+        x, y, w, h = window.getRect()
+        if not 0 < strip_height < h:
+            strip_height = h
+        array = np.zeros((height, width, 4), np.float32)
+        layer_arrays = np.zeros((len(layers), max(h, 0), max(w, 0), 3), np.float32)
+        if not window.isEmpty():
+            strip = QtCore.QSize(w, strip_height)
+            strip_image = self.update_image(strip, flags=cl.mem_flags.READ_WRITE)
+            layer_buffer = self.update_layers(len(layers), strip)
+            for row in range(y, y + h, strip_height):
+                # the image is flipped in y
+                origin = (x, height - row - strip_height)
+                self.rasterize_window(strip_image, origin, *args, layer_buffer)
+                rows = min(strip_height, y + h - row)
+                array[row : row + rows, x : x + w] = strip_image.array[:rows]
+                if layer_buffer is not None:
+                    window_row = row - y
+                    strip_layers = layer_buffer.array[:, :rows]
+                    layer_arrays[:, window_row : window_row + rows] = strip_layers
+
+        flare_image = Image(self.context, array=array)
+        flare_image.args = (
+            ghost,
+            vertexes,
+            render,
+            intensity,
+            fstop,
+            splat_paths,
+            levels,
+            path_layers,
+        )
+        flare_image.data_window = window
+        flare_image.layers = dict(zip(layers, layer_arrays))
+        return flare_image
+
+    def update_window(
+        self, render: Render, bounds: Buffer, screen_transform: float
+    ) -> QtCore.QRect:
+        # returns the region of interest in image coordinates
+        frame = QtCore.QRect(QtCore.QPoint(0, 0), render.resolution)
+        if render.roi == RegionOfInterest.BOX:
+            return roi_box(render)
+        if render.roi == RegionOfInterest.AUTO:
+            return self.update_bounds_window(
+                bounds, screen_transform, render.resolution
+            )
+        return frame
+
+    @lru_cache(1)
+    def update_bounds_window(
+        self, bounds: Buffer, screen_transform: float, resolution: QtCore.QSize
+    ) -> QtCore.QRect:
+        # returns the bounding box of all primitives in image coordinates
+        cl.enqueue_copy(self.queue, bounds.array, bounds.buffer)
+        array = bounds.array.view(np.float32).reshape(-1, 4)
+        array = array[~np.isnan(array[:, 0])]
+        if not array.size:
+            return QtCore.QRect()
+
+        # pad by one pixel, the binner truncates the bounds
+        width, height = resolution.width(), resolution.height()
+        center = np.float32((width, height)) / 2
+        x0, y0 = np.floor(np.min(array[:, :2], axis=0) * screen_transform + center)
+        x1, y1 = np.ceil(np.max(array[:, 2:], axis=0) * screen_transform + center)
+        x0, y0, x1, y1 = int(x0) - 1, int(y0) - 1, int(x1) + 1, int(y1) + 1
+
+        # screen space is flipped in y
+        window = QtCore.QRect(x0, height - 1 - y1, x1 - x0 + 1, y1 - y0 + 1)
+        frame = QtCore.QRect(0, 0, width, height)
+        return window.intersected(frame)
+
+    @lru_cache(1)
+    def update_path_areas(self, bounds: Buffer, screen_transform: float) -> np.ndarray:
+        # returns the average area in pixels of the primitive bounds per path,
+        # nan for paths without primitives
+        cl.enqueue_copy(self.queue, bounds.array, bounds.buffer)
+        array = bounds.array.view(np.float32).reshape(bounds.shape + (4,))
+        size = (array[..., 2:] - array[..., :2]) * screen_transform
+        areas = size[..., 0] * size[..., 1]
+        valid = ~np.isnan(areas)
+        area_count = np.sum(valid, axis=1)
+        mean_areas = np.sum(areas, axis=1, where=valid) / np.maximum(area_count, 1)
+        return np.where(area_count > 0, mean_areas, np.nan)
+
+    def mask_bounds(self, bounds: Buffer, mask: np.ndarray) -> Buffer:
+        # returns a copy of the bounds where the primitives of masked paths are culled
+        array = bounds.array.view(np.float32).reshape(bounds.shape + (4,)).copy()
+        array[mask] = np.nan
+        array = array.view(cl.cltypes.float4).reshape(bounds.shape)
+        return Buffer(self.context, array=array, args=(bounds, mask.tobytes()))
+
+    @lru_cache(1)
+    def update_splat_paths(
+        self, bounds: Buffer, screen_transform: float, splat_area: float
+    ) -> tuple[Buffer, Buffer | None]:
+        # returns the bounds of the rasterized primitives and the paths that are
+        # splatted. a path is splatted if its primitives cover less than splat_area
+        # pixels on average.
+        if splat_area <= 0:
+            return bounds, None
+
+        areas = self.update_path_areas(bounds, screen_transform)
+        splat = areas < splat_area
+        if not np.any(splat):
+            return bounds, None
+
+        splat_paths = np.int32(np.flatnonzero(splat))
+        splat_paths = Buffer(self.context, array=splat_paths, args=(bounds, splat_area))
+        return self.mask_bounds(bounds, splat), splat_paths
+
+    @lru_cache(1)
+    def update_levels(
+        self,
+        bounds: Buffer,
+        screen_transform: float,
+        downsample_area: float,
+        resolution: QtCore.QSize,
+    ) -> tuple[Buffer, tuple[tuple[int, Buffer], ...]]:
+        # returns the bounds of the primitives rasterized at full resolution and the
+        # scale and bounds per level. a path is rasterized at the lowest resolution
+        # where its primitives still cover downsample_area pixels on average.
+        if downsample_area <= 0:
+            return bounds, ()
+
+        areas = self.update_path_areas(bounds, screen_transform)
+        scales = np.ones(len(areas), np.int32)
+        for scale in LEVEL_SCALES:
+            # vertexes are only scaled exactly if the resolution is divisible
+            if resolution.width() % scale or resolution.height() % scale:
+                break
+            scales[areas / scale**2 >= downsample_area] = scale
+        if np.all(scales == 1):
+            return bounds, ()
+
+        levels = tuple(
+            (int(scale), self.mask_bounds(bounds, scales != scale))
+            for scale in np.unique(scales[scales > 1])
+        )
+        return self.mask_bounds(bounds, scales != 1), levels
+
+    def update_level_vertexes(self, vertexes: Buffer, scale: int) -> Buffer:
+        # screen space vertexes of a level that is scale times smaller
+        array = np.zeros(vertexes.shape, self.dtypes['Vertex'])
+        flags = cl.mem_flags.READ_WRITE
+        array_cl = cl.Buffer(self.context, flags, size=array.nbytes)
+        buffer = Buffer(self.context, array=array, buffer=array_cl)
+        buffer.args = (vertexes, scale)
+
+        kernel = self.kernels['scale_vertexes']
+        kernel.set_arg(0, buffer.buffer)
+        kernel.set_arg(1, vertexes.buffer)
+        kernel.set_arg(2, np.float32(scale))
+        cl.enqueue_nd_range_kernel(self.queue, kernel, (array.size,), None)
+        return buffer
+
+    @lru_cache(1 + len(LEVEL_SCALES))
+    def update_packed_vertexes(self, vertexes: Buffer) -> Buffer:
+        # vertexes with fixed point positions and half precision attributes
+        array = np.zeros(vertexes.shape, self.dtypes['PackedVertex'])
+        flags = cl.mem_flags.READ_WRITE
+        array_cl = cl.Buffer(self.context, flags, size=array.nbytes)
+        buffer = Buffer(self.context, array=array, buffer=array_cl, args=vertexes)
+
+        kernel = self.kernels['pack_vertexes']
+        kernel.set_arg(0, buffer.buffer)
+        kernel.set_arg(1, vertexes.buffer)
+        cl.enqueue_nd_range_kernel(self.queue, kernel, (array.size,), None)
+        return buffer
+
+    @timer
+    @lru_cache(len(LEVEL_SCALES))
+    def rasterize_level(
+        self,
+        scale: int,
+        render: Render,
+        bounds: Buffer,
+        vertexes: Buffer,
+        ghost: Image,
+        screen_transform: float,
+        intensity: float,
+        fstop: float,
+    ) -> Image:
+        # rasterizes the full frame at a resolution that is scale times smaller
+        width, height = render.resolution.width(), render.resolution.height()
+        resolution = QtCore.QSize(width // scale, height // scale)
+        level_render = dataclasses.replace(render, resolution=resolution)
+        level_vertexes = self.update_level_vertexes(vertexes, scale)
+        flags = cl.mem_flags.READ_WRITE
+        level_image = super().update_image(resolution, flags=flags)
+
+        self.rasterize_window(
+            level_image,
+            (0, 0),
+            level_render,
+            bounds,
+            level_vertexes,
+            ghost,
+            screen_transform / scale,
+            intensity,
+            fstop,
+            read_back=False,
+        )
+        # the level stays on the device until it is upsampled into the flare
+        args = (scale, render, bounds, vertexes, ghost, intensity, fstop)
+        return Image(self.context, image=level_image.image, args=args)
+
+    def rasterize_window(
+        self,
+        flare_image: Image,
+        origin: tuple[int, int],
+        render: Render,
+        bounds: Buffer,
+        vertexes: Buffer,
+        ghost: Image,
+        screen_transform: float,
+        intensity: float,
+        fstop: float,
+        splat_paths: Buffer | None = None,
+        levels: tuple[Image, ...] = (),
+        path_layers: Buffer | None = None,
+        layers: Buffer | None = None,
+        read_back: bool = True,
+    ) -> None:
+        # rasterizes the window of the image at origin into flare_image.
+        # with path_layers the paths are also accumulated into the layers buffer.
+        # without read_back the image is not copied to the host.
+        path_count, ray_count, wavelength_count = vertexes.array.shape
+        resolution = render.resolution.width(), render.resolution.height()
+        width, height = flare_image.image.shape
+        window = QtCore.QSize(width, height)
+
+        # binner, only the visible primitives are binned
+        primitive_ids, compact_bounds, primitive_count = self.compact_primitives(bounds)
+        if render.sort_primitives:
+            primitive_ids, compact_bounds = self.sort_primitives(
+                primitive_ids,
+                compact_bounds,
+                primitive_count,
+                screen_transform,
+                resolution,
+            )
+        batch_count = max(int(np.ceil(primitive_count / BATCH_PRIMITIVE_COUNT)), 1)
+        compact = render.binning in (Binning.COMPACT, Binning.TILE)
+        hierarchical = compact and render.hierarchical_binning
+
+        # the first level of the hierarchical binner bins into super bins
+        bin_size = render.bin_size
+        if hierarchical:
+            bin_size *= SUPER_BIN_FACTOR
+        bin_dims = self.update_bin_dims(bin_size, window)
         bin_count = int(bin_dims[0] * bin_dims[1])
-        primitive_count = bounds.array.size
-        batch_count = int(np.ceil(primitive_count / BATCH_PRIMITIVE_COUNT))
-        bin_queues = self.update_bin_queues(bin_count, batch_count)
-        bin_queues.args = (bin_dims, bounds)
         # logger.debug(f'{bin_count:=}')
         # logger.debug(f'{primitive_count:=}')
         # logger.debug(f'{batch_count:=}')
 
-        self.kernels['binner'].set_arg(0, bin_queues.buffer)
-        self.kernels['binner'].set_arg(1, np.int32(bin_dims))
-        self.kernels['binner'].set_arg(2, np.int32(bin_count))
-        self.kernels['binner'].set_arg(3, bounds.buffer)
-        self.kernels['binner'].set_arg(4, np.int32(primitive_count))
-        self.kernels['binner'].set_arg(5, np.float32(screen_transform))
-        self.kernels['binner'].set_arg(6, np.int32(resolution))
-
-        self.binner(bin_queues, batch_count)
+        if compact:
+            bin_queues = self.update_bin_counts(bin_count, batch_count)
+            kernel = self.kernels['binner_compact']
+            kernel.set_arg(10, np.int32(bin_size))
+            kernel.set_arg(11, np.int32(origin))
+            kernel.set_arg(12, primitive_ids.buffer)
+            arg_offset = 3
+        else:
+            bin_queues = self.update_bin_queues(bin_count, batch_count)
+            kernel = self.kernels['binner']
+            kernel.set_arg(0, bin_queues.buffer)
+            kernel.set_arg(7, np.int32(origin))
+            arg_offset = 1
+        # the bins depend on the order of the primitives, see sort_primitives
+        bin_queues.args = (bin_dims, bin_size, origin, bounds, primitive_ids)
+
+        kernel.set_arg(arg_offset + 0, np.int32(bin_dims))
+        kernel.set_arg(arg_offset + 1, np.int32(bin_count))
+        kernel.set_arg(arg_offset + 2, compact_bounds.buffer)
+        kernel.set_arg(arg_offset + 3, np.int32(primitive_count))
+        kernel.set_arg(arg_offset + 4, np.float32(screen_transform))
+        kernel.set_arg(arg_offset + 5, np.int32(resolution))
+
+        if compact:
+            bin_primitives, bin_offsets = self.compact_binner(bin_queues, batch_count)
+        else:
+            self.binner(bin_queues, batch_count)
+
+        if hierarchical:
+            # second level, bin the primitives of the super bins into the bins
+            super_dims = bin_dims
+            bin_dims = self.update_bin_dims(render.bin_size, window)
+
+            kernel = self.kernels['binner_fine']
+            kernel.set_arg(3, bin_primitives.buffer)
+            kernel.set_arg(4, bin_offsets.buffer)
+            kernel.set_arg(5, np.int32(super_dims[0]))
+            kernel.set_arg(6, bounds.buffer)
+            kernel.set_arg(7, np.float32(screen_transform))
+            kernel.set_arg(8, np.int32(resolution))
+            kernel.set_arg(10, np.int32(origin))
+
+            bin_primitives, bin_offsets = self.fine_binner(bin_queues, bin_dims)
 
         # rasterizer
-        light_spectrum = self.update_light_spectrum()
         sub_steps = render.anti_aliasing
         wavelength_sub_count = (
             render.wavelength_sub_count if wavelength_count > 1 else 1
         )
+        light_spectrum = self.update_light_spectrum(
+            render.spectral_sampling, wavelength_count, wavelength_sub_count
+        )
         ghost_scale = 1 - fstop / 32
+        suffix = '_packed' if render.packed_vertexes else ''
+        if render.packed_vertexes:
+            vertex_buffer = self.update_packed_vertexes(vertexes).buffer
+        else:
+            vertex_buffer = vertexes.buffer
         flare_image.args = (
             ghost,
             vertexes,
@@ -399,32 +1319,93 @@ class RasterizingTask(OpenCL):
             sub_steps,
             intensity,
             ghost_scale,
+            origin,
+            render.analytic_coverage,
+            splat_paths,
+            levels,
+            path_layers,
         )
 
-        self.kernels['rasterizer'].set_arg(0, flare_image.image)
-        self.kernels['rasterizer'].set_arg(1, ghost.image)
-        self.kernels['rasterizer'].set_arg(2, light_spectrum.image)
-        self.kernels['rasterizer'].set_arg(3, vertexes.buffer)
-        self.kernels['rasterizer'].set_arg(4, bin_queues.buffer)
-        self.kernels['rasterizer'].set_arg(5, np.int32(batch_count))
-        self.kernels['rasterizer'].set_arg(6, np.int32(path_count))
-        self.kernels['rasterizer'].set_arg(7, np.int32(wavelength_count))
-        self.kernels['rasterizer'].set_arg(8, np.int32(wavelength_sub_count))
-        self.kernels['rasterizer'].set_arg(9, np.int32(render.grid_count))
-        self.kernels['rasterizer'].set_arg(10, np.int32(sub_steps))
-        self.kernels['rasterizer'].set_arg(11, np.float32(intensity * 1e3))
-        self.kernels['rasterizer'].set_arg(12, np.float32(ghost_scale))
-
-        self.rasterizer(flare_image)
+        if render.binning == Binning.TILE:
+            local_primitive_count = self.update_local_primitive_count(wavelength_count)
+            local_size = local_primitive_count * 4 * wavelength_count
+            local_size *= self.dtypes['Vertex'].itemsize
+            kernel = self.kernels[f'rasterizer_tile{suffix}']
+            kernel.set_arg(4, bin_primitives.buffer)
+            kernel.set_arg(5, bin_offsets.buffer)
+            kernel.set_arg(6, cl.LocalMemory(local_size))
+            kernel.set_arg(7, np.int32(local_primitive_count))
+            arg_offset = 8
+        elif compact:
+            kernel = self.kernels[f'rasterizer_compact{suffix}']
+            kernel.set_arg(4, bin_primitives.buffer)
+            kernel.set_arg(5, bin_offsets.buffer)
+            arg_offset = 6
+        else:
+            kernel = self.kernels[f'rasterizer{suffix}']
+            kernel.set_arg(4, bin_queues.buffer)
+            kernel.set_arg(5, primitive_ids.buffer)
+            kernel.set_arg(6, np.int32(batch_count))
+            kernel.set_arg(7, np.int32(primitive_count))
+            arg_offset = 8
+        kernel.set_arg(0, flare_image.image)
+        kernel.set_arg(1, ghost.image)
+        kernel.set_arg(2, light_spectrum.image)
+        kernel.set_arg(3, vertex_buffer)
+        kernel.set_arg(arg_offset + 0, np.int32(wavelength_count))
+        kernel.set_arg(arg_offset + 1, np.int32(wavelength_sub_count))
+        kernel.set_arg(arg_offset + 2, np.int32(render.grid_count))
+        kernel.set_arg(arg_offset + 3, np.int32(sub_steps))
+        kernel.set_arg(arg_offset + 4, np.float32(intensity * 1e3))
+        kernel.set_arg(arg_offset + 5, np.float32(ghost_scale))
+        kernel.set_arg(arg_offset + 6, np.int32(origin))
+        kernel.set_arg(arg_offset + 7, np.int32(render.analytic_coverage))
+        layer_count = len(layers.array) if layers is not None else 0
+        kernel.set_arg(arg_offset + 8, layers.buffer if layer_count else None)
+        kernel.set_arg(arg_offset + 9, path_layers.buffer if layer_count else None)
+        kernel.set_arg(arg_offset + 10, np.int32(layer_count))
+        kernel_name = f'{kernel.function_name}{suffix}'
 
-        # return image
-        return flare_image
+        quad_count = (render.grid_count - 1) ** 2
+        if splat_paths is not None:
+            kernel = self.kernels[f'splatter{suffix}']
+            kernel.set_arg(1, ghost.image)
+            kernel.set_arg(2, light_spectrum.image)
+            kernel.set_arg(3, vertex_buffer)
+            kernel.set_arg(5, np.int32(wavelength_count))
+            kernel.set_arg(6, np.int32(wavelength_sub_count))
+            kernel.set_arg(7, np.int32(render.grid_count))
+            kernel.set_arg(8, np.int32(sub_steps))
+            kernel.set_arg(9, np.float32(ghost_scale))
+            kernel.set_arg(10, np.int32(origin))
+
+            kernel = self.kernels['splat_resolve']
+            total_samples = wavelength_count * sub_steps * wavelength_sub_count
+            kernel.set_arg(2, np.int32(total_samples))
+            kernel.set_arg(3, np.float32(intensity * 1e3))
+
+        if levels:
+            kernel = self.kernels['upsample_level']
+            kernel.set_arg(2, np.int32(resolution))
+            kernel.set_arg(3, np.int32(origin))
+
+        self.rasterizer(
+            flare_image,
+            kernel_name,
+            splat_paths,
+            quad_count,
+            levels,
+            layers if layer_count else None,
+            read_back,
+        )
 
     def run(
         self,
         project: Project,
         rays: Buffer,
         ghost: Image,
+        layers: tuple[str, ...] = (),
+        path_layers: tuple[int, ...] = (),
     ) -> Image:
         sensor_size = tuple(basic(project.flare.lens.sensor_size))
         output = self.rasterize(
@@ -435,5 +1416,7 @@ class RasterizingTask(OpenCL):
             project.flare.lens.min_area,
             project.flare.light.intensity,
             project.flare.lens.fstop,
+            layers,
+            path_layers,
         )
         return output
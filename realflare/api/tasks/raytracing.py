@@ -8,10 +8,11 @@ import pyopencl as cl
 from PySide2 import QtCore
 
 from realflare.api import lens as api_lens
-from realflare.api.data import LensModel, Project
+from realflare.api.data import LensModel, Project, SpectralSampling
 from realflare.api.tasks.opencl import (
     OpenCL,
     ray_dtype,
+    vertex_dtype,
     lens_element_dtype,
     intersection_dtype,
     LAMBDA_MIN,
@@ -19,27 +20,109 @@ from realflare.api.tasks.opencl import (
     Buffer,
 )
 from realflare.storage import Storage
+from realflare.utils.ciexyz import CIEXYZ
 from realflare.utils.timing import timer
 
 logger = logging.getLogger(__name__)
 storage = Storage()
 
+# the maximum amount of motion steps the rays are extrapolated beyond the last keyframe
+MAX_EXTRAPOLATION = 1
 
-def wavelength_array(wavelength_count: int) -> list[int]:
+
+def wavelength_array(
+    wavelength_count: int,
+    spectral_sampling: SpectralSampling = SpectralSampling.UNIFORM,
+    wavelength_sub_count: int = 1,
+) -> list[int]:
     array = []
     for i in range(wavelength_count):
         step = (i + 0.5) / wavelength_count
-        wavelength = LAMBDA_MIN + step * (LAMBDA_MAX - LAMBDA_MIN)
+        if spectral_sampling == SpectralSampling.IMPORTANCE:
+            # the sub steps of the rasterizer are the centers of equal parts of the
+            # distribution, each wavelength is placed at the first sub step.
+            # see RasterizingTask.update_light_spectrum
+            if wavelength_count > 1:
+                step = (i + 0.5 / wavelength_sub_count) / (wavelength_count - 1)
+            wavelength = importance_wavelength(min(step, 1))
+        else:
+            wavelength = LAMBDA_MIN + step * (LAMBDA_MAX - LAMBDA_MIN)
         array.append(wavelength)
+
+    if (
+        spectral_sampling == SpectralSampling.IMPORTANCE
+        and wavelength_count > 1
+        and wavelength_sub_count > 1
+    ):
+        # the first sub step of the last wavelength lies outside the distribution.
+        # the last wavelength is extrapolated so that the last sub step between
+        # the last two wavelengths is at the center of the last part.
+        sub_count = wavelength_sub_count
+        step = (wavelength_count - 2 + (sub_count - 0.5) / sub_count)
+        step /= wavelength_count - 1
+        last = importance_wavelength(step)
+        array[-1] = array[-2] + (last - array[-2]) * sub_count / (sub_count - 1)
     return array
 
 
+def spectral_pdf() -> tuple[np.ndarray, np.ndarray]:
+    # returns the wavelengths and the probability density of the sum of the CIE
+    # color matching functions. the sum is used instead of Y alone so that blue
+    # wavelengths with a small luminance still get samples.
+    array = np.array(CIEXYZ, np.float64)
+    array = array[(array[:, 0] >= LAMBDA_MIN) & (array[:, 0] <= LAMBDA_MAX)]
+    wavelengths = array[:, 0]
+    pdf = np.sum(array[:, 1:], axis=1)
+    pdf /= np.trapz(pdf, wavelengths)
+    return wavelengths, pdf
+
+
+def importance_wavelength(position: np.ndarray | float) -> np.ndarray | float:
+    # maps positions in the range 0-1 to wavelengths distributed by spectral_pdf
+    wavelengths, pdf = spectral_pdf()
+    cdf = np.append(0, np.cumsum((pdf[1:] + pdf[:-1]) / 2 * np.diff(wavelengths)))
+    return np.interp(position, cdf / cdf[-1], wavelengths)
+
+
+def screen_transform(
+    resolution: QtCore.QSize, sensor_size: tuple[float, float]
+) -> float:
+    # scale factor from sensor space in mm to screen space in pixels
+    sensor_length = np.linalg.norm((sensor_size[0], sensor_size[1])) / 2
+    try:
+        transform = resolution.width() / sensor_length
+    except ZeroDivisionError:
+        transform = 0
+    return transform
+
+
+def dispersive(lens_elements: np.ndarray) -> bool:
+    # dispersion is disabled when no glasses are found, see lens.elements
+    return not np.isnan(lens_elements[0]['coefficients']['s0'])
+
+
+def trace_shape(
+    lens_elements: np.ndarray, path_count: int, wavelength_count: int, ray_count: int
+) -> tuple[int, int, int]:
+    # without dispersion the geometry is the same for all wavelengths, so only
+    # one wavelength is traced and the reflectance is evaluated per wavelength
+    if not dispersive(lens_elements):
+        wavelength_count = 1
+    return path_count, wavelength_count, ray_count
+
+
 class RaytracingTask(OpenCL):
     def __init__(self, queue: cl.CommandQueue) -> None:
         super().__init__(queue)
         self.kernel = None
         self.build()
 
+        # temporal reuse
+        self._history_key = None
+        self._history: list[tuple[tuple[float, float], Buffer]] = []
+        self._last_frame: tuple[tuple[float, float], Buffer | None] | None = None
+        self._reused_frames = 0
+
     def build(self, *args, **kwargs) -> None:
         self.source = ''
         self.register_dtype('Ray', ray_dtype)
@@ -123,13 +206,21 @@ class RaytracingTask(OpenCL):
         return buffer
 
     @lru_cache(1)
-    def update_wavelengths(self, wavelength_count: int) -> Buffer:
-        array = np.int32(wavelength_array(wavelength_count))
-        buffer = Buffer(self.context, array=array, args=wavelength_count)
+    def update_wavelengths(
+        self,
+        wavelength_count: int,
+        spectral_sampling: SpectralSampling = SpectralSampling.UNIFORM,
+        wavelength_sub_count: int = 1,
+    ) -> Buffer:
+        array = wavelength_array(
+            wavelength_count, spectral_sampling, wavelength_sub_count
+        )
+        array = np.int32(array)
+        args = (wavelength_count, spectral_sampling, wavelength_sub_count)
+        buffer = Buffer(self.context, array=array, args=args)
         return buffer
 
-    def trace(self, rays: Buffer) -> cl.Event:
-        global_work_size = rays.array.shape
+    def trace(self, global_work_size: tuple[int, ...]) -> cl.Event:
         local_work_size = None
         raytracing_event = cl.enqueue_nd_range_kernel(
             self.queue, self.kernel, global_work_size, local_work_size
@@ -152,7 +243,56 @@ class RaytracingTask(OpenCL):
         resolution: QtCore.QSize,
         wavelength_count: int,
         path_indexes: tuple[int, ...],
+        spectral_sampling: SpectralSampling = SpectralSampling.UNIFORM,
+        wavelength_sub_count: int = 1,
     ) -> Buffer | None:
+        return self.trace_grid(
+            lens_model,
+            sensor_size,
+            glasses_path,
+            abbe_nr_adjustment,
+            coating,
+            coating_min_ior,
+            grid_count,
+            grid_length,
+            light_position,
+            resolution,
+            wavelength_count,
+            path_indexes,
+            spectral_sampling,
+            wavelength_sub_count,
+        )
+
+    def update_output(
+        self,
+        path_count: int,
+        wavelength_count: int,
+        ray_count: int,
+        resolution: QtCore.QSize,
+        sensor_size: tuple[float, float],
+    ) -> Buffer:
+        # returns the buffer that the kernel writes to. subclasses with a different
+        # output set the kernel arguments that follow the common arguments.
+        return self.update_rays((path_count, wavelength_count, ray_count))
+
+    def trace_grid(
+        self,
+        lens_model: LensModel,
+        sensor_size: tuple[float, float],
+        glasses_path: str,
+        abbe_nr_adjustment: float,
+        coating: tuple[int, ...],
+        coating_min_ior: float,
+        grid_count: int,
+        grid_length: float,
+        light_position: tuple[float, float],
+        resolution: QtCore.QSize,
+        wavelength_count: int,
+        path_indexes: tuple[int, ...],
+        spectral_sampling: SpectralSampling = SpectralSampling.UNIFORM,
+        wavelength_sub_count: int = 1,
+    ) -> Buffer | None:
+        # traces the grid of rays of all paths into the output of the kernel
         # lens elements
         lens_elements = self.update_lens_elements(
             lens_model,
@@ -168,7 +308,9 @@ class RaytracingTask(OpenCL):
             self.build()
 
         paths = self.update_paths(lens_model, path_indexes)
-        wavelengths = self.update_wavelengths(wavelength_count)
+        wavelengths = self.update_wavelengths(
+            wavelength_count, spectral_sampling, wavelength_sub_count
+        )
 
         # direction
         direction = self.update_direction(
@@ -178,13 +320,14 @@ class RaytracingTask(OpenCL):
         # args
         lens_elements_count = len(lens_elements.array)
 
-        # rays
+        # output
         path_count = int(paths.array.size)
         ray_count = int(grid_count**2)
         wavelength_count = wavelengths.shape[0]
-        rays_shape = (path_count, wavelength_count, ray_count)
-        rays = self.update_rays(rays_shape)
-        rays.args = (
+        output = self.update_output(
+            path_count, wavelength_count, ray_count, resolution, sensor_size
+        )
+        output.args = (
             lens_elements,
             paths,
             wavelengths,
@@ -193,24 +336,29 @@ class RaytracingTask(OpenCL):
             grid_count,
             grid_length,
             direction.tolist(),
+            output.args,
         )
 
         lens_elements.clear_buffer()
         paths.clear_buffer()
         wavelengths.clear_buffer()
 
-        self.kernel.set_arg(0, rays.buffer)
+        self.kernel.set_arg(0, output.buffer)
         self.kernel.set_arg(1, lens_elements.buffer)
         self.kernel.set_arg(2, np.int32(lens_elements_count))
         self.kernel.set_arg(3, paths.buffer)
         self.kernel.set_arg(4, wavelengths.buffer)
-        self.kernel.set_arg(5, np.int32(lens_model.aperture_index))
-        self.kernel.set_arg(6, np.float32(coating_min_ior))
-        self.kernel.set_arg(7, np.int32(grid_count))
-        self.kernel.set_arg(8, np.float32(grid_length))
-        self.kernel.set_arg(9, direction)
-
-        self.trace(rays)
+        self.kernel.set_arg(5, np.int32(wavelength_count))
+        self.kernel.set_arg(6, np.int32(lens_model.aperture_index))
+        self.kernel.set_arg(7, np.float32(coating_min_ior))
+        self.kernel.set_arg(8, np.int32(grid_count))
+        self.kernel.set_arg(9, np.float32(grid_length))
+        self.kernel.set_arg(10, direction)
+
+        # the kernel is enqueued in (path, wavelength, ray) order
+        self.trace(
+            trace_shape(lens_elements.array, path_count, wavelength_count, ray_count)
+        )
 
         # copy device buffer to host
         # cl.enqueue_copy(self.queue, rays, rays_cl)
@@ -218,7 +366,95 @@ class RaytracingTask(OpenCL):
         # for ray in rays[0, 0]:
         #     logging.debug(ray)
 
-        return rays
+        return output
+
+    def extrapolate(
+        self, previous: Buffer, current: Buffer, t: float, args: tuple
+    ) -> Buffer:
+        # linearly extrapolates all values of two traced buffers of the same shape.
+        # ray and vertex structs only contain floats so the buffers can be
+        # treated as flat float arrays.
+        array = np.zeros(current.array.shape, current.array.dtype)
+        buffer_cl = cl.Buffer(self.context, cl.mem_flags.READ_WRITE, array.nbytes)
+        buffer = Buffer(self.context, array=array, buffer=buffer_cl, args=args)
+
+        kernel = cl.Kernel(self.program, 'extrapolate')
+        kernel.set_arg(0, buffer.buffer)
+        kernel.set_arg(1, previous.buffer)
+        kernel.set_arg(2, current.buffer)
+        kernel.set_arg(3, np.float32(t))
+
+        global_work_size = (array.nbytes // 4,)
+        local_work_size = None
+        event = cl.enqueue_nd_range_kernel(
+            self.queue, kernel, global_work_size, local_work_size
+        )
+        event.wait()
+        return buffer
+
+    def temporal_raytrace(
+        self,
+        tolerance: float,
+        keyframe_interval: int,
+        **kwargs,
+    ) -> Buffer | None:
+        # reuses the previously traced buffers if the estimated error is less than
+        # tolerance (in pixels). With two traced frames the result is linearly
+        # extrapolated along the motion of the light.
+
+        light_position = kwargs['light_position']
+        resolution = kwargs['resolution']
+
+        # all arguments except the light position need to match the history
+        key = tuple(v for k, v in kwargs.items() if k != 'light_position')
+        if key != self._history_key:
+            self._history_key = key
+            self._history = []
+            self._last_frame = None
+            self._reused_frames = 0
+
+        # the same frame can be requested more than once, for example when
+        # writing split files
+        if self._last_frame is not None and self._last_frame[0] == light_position:
+            return self._last_frame[1]
+
+        if self._history and self._reused_frames < keyframe_interval - 1:
+            position, current = self._history[-1]
+            offset = np.subtract(light_position, position)
+            scale = np.array((resolution.width(), resolution.height())) / 2
+
+            # without extrapolation the error is the full offset of the light,
+            # with extrapolation only the offset perpendicular to the motion remains.
+            # the rays are not linear in the light position, so t is limited to one
+            # step of the motion beyond the last keyframe and the distance along the
+            # motion beyond that step is added to the error.
+            error = offset
+            t = 0
+            if len(self._history) > 1:
+                previous_position, previous = self._history[-2]
+                motion = np.subtract(position, previous_position)
+                length = np.dot(motion, motion)
+                if length > 0:
+                    t = float(np.dot(offset, motion) / length)
+                    t = float(np.clip(t, -1, MAX_EXTRAPOLATION))
+                    error = offset - motion * t
+
+            if np.linalg.norm(error * scale) <= tolerance:
+                buffer = current
+                if t:
+                    args = (previous, current, light_position)
+                    buffer = self.extrapolate(previous, current, t, args)
+                self._reused_frames += 1
+                self._last_frame = (light_position, buffer)
+                return buffer
+
+        # keyframe
+        buffer = self.raytrace(**kwargs)
+        self._reused_frames = 0
+        if buffer is not None:
+            self._history = [*self._history[-1:], (light_position, buffer)]
+        self._last_frame = (light_position, buffer)
+        return buffer
 
     @timer
     def run(self, project: Project, path_indexes: tuple[int, ...]) -> Buffer | None:
@@ -230,7 +466,13 @@ class RaytracingTask(OpenCL):
 
         lens_model = api_lens.model_from_path(lens.lens_model_path)
 
-        buffer = self.raytrace(
+        # only importance sampled wavelengths depend on the sub steps
+        spectral_sampling = project.render.spectral_sampling
+        wavelength_sub_count = 1
+        if spectral_sampling == SpectralSampling.IMPORTANCE:
+            wavelength_sub_count = project.render.wavelength_sub_count
+
+        kwargs = dict(
             lens_model=lens_model,
             sensor_size=sensor_size,
             glasses_path=lens.glasses_path,
@@ -243,7 +485,18 @@ class RaytracingTask(OpenCL):
             resolution=project.render.resolution,
             wavelength_count=project.render.wavelength_count,
             path_indexes=path_indexes,
+            spectral_sampling=spectral_sampling,
+            wavelength_sub_count=wavelength_sub_count,
         )
+
+        if project.render.temporal_tolerance_enabled:
+            buffer = self.temporal_raytrace(
+                project.render.temporal_tolerance,
+                project.render.temporal_keyframe_interval,
+                **kwargs,
+            )
+        else:
+            buffer = self.raytrace(**kwargs)
         return buffer
 
 
@@ -280,6 +533,7 @@ class IntersectionsTask(RaytracingTask):
         resolution: QtCore.QSize,
         wavelength_count: int,
         path_indexes: tuple[int, ...],
+        column_offset: int = 0,
     ) -> Buffer | None:
         # lens elements
         lens_elements = self.update_lens_elements(
@@ -306,9 +560,13 @@ class IntersectionsTask(RaytracingTask):
         # args
         lens_elements_count = len(lens_elements.array)
 
+        # only one column of rays is traced, starting from the center
+        column = int((grid_count - 1) / 2) + column_offset
+        column = int(np.clip(column, 0, grid_count - 1))
+
         # rays
         path_count = int(paths.array.size)
-        ray_count = int(grid_count**2)
+        ray_count = int(grid_count)
         wavelength_count = wavelengths.shape[0]
         rays_shape = (path_count, wavelength_count, ray_count)
         rays = self.update_rays(rays_shape)
@@ -321,6 +579,7 @@ class IntersectionsTask(RaytracingTask):
             grid_count,
             grid_length,
             direction.tolist(),
+            column,
         )
 
         # intersections
@@ -338,20 +597,19 @@ class IntersectionsTask(RaytracingTask):
         self.kernel.set_arg(2, np.int32(lens_elements_count))
         self.kernel.set_arg(3, paths.buffer)
         self.kernel.set_arg(4, wavelengths.buffer)
-        self.kernel.set_arg(5, np.int32(lens_model.aperture_index))
-        self.kernel.set_arg(6, np.float32(coating_min_ior))
-        self.kernel.set_arg(7, np.int32(grid_count))
-        self.kernel.set_arg(8, np.float32(grid_length))
-        self.kernel.set_arg(9, direction)
-        self.kernel.set_arg(10, intersections.buffer)
-        self.kernel.set_arg(11, np.int32(intersections_count))
-
-        self.trace(rays)
-
-        cl.enqueue_copy(self.queue, intersections.array, intersections.buffer)
-        intersections._array = np.reshape(
-            intersections.array, (1, wavelength_count, grid_count, grid_count, -1)
-        )
+        self.kernel.set_arg(5, np.int32(wavelength_count))
+        self.kernel.set_arg(6, np.int32(lens_model.aperture_index))
+        self.kernel.set_arg(7, np.float32(coating_min_ior))
+        self.kernel.set_arg(8, np.int32(grid_count))
+        self.kernel.set_arg(9, np.float32(grid_length))
+        self.kernel.set_arg(10, direction)
+        self.kernel.set_arg(11, intersections.buffer)
+        self.kernel.set_arg(12, np.int32(intersections_count))
+        self.kernel.set_arg(13, np.int32(column))
+
+        self.trace(rays_shape)
+
+        # the intersections stay on the device, shape = (path, wavelength, ray.row)
         return intersections
 
     @timer
@@ -376,5 +634,90 @@ class IntersectionsTask(RaytracingTask):
             resolution=project.diagram.resolution,
             wavelength_count=1,
             path_indexes=path_indexes,
+            column_offset=project.diagram.column_offset,
         )
         return buffer
+
+
+class VertexesTask(RaytracingTask):
+    # traces rays and writes screen space vertexes directly, skipping the rays buffer
+
+    def __init__(self, queue: cl.CommandQueue) -> None:
+        super().__init__(queue)
+        self.kernel = None
+        self.build()
+
+    def build(self, *args, **kwargs) -> None:
+        self.source = ''
+        self.register_dtype('Ray', ray_dtype)
+        self.register_dtype('Vertex', vertex_dtype)
+        self.register_dtype('LensElement', lens_element_dtype)
+        self.register_dtype('Intersection', intersection_dtype)
+        self.source += '#define EMIT_VERTEXES\n'
+        self.source += f'__constant int LAMBDA_MIN = {LAMBDA_MIN};\n'
+        self.source += f'__constant int LAMBDA_MAX = {LAMBDA_MAX};\n'
+        self.source += self.read_source_file('raytracing.cl')
+        OpenCL.build(self, *args, **kwargs)
+        self.kernel = cl.Kernel(self.program, 'raytrace')
+
+    def update_vertexes(self, vertexes_shape: tuple[int, ...]) -> Buffer:
+        dtype = self.dtypes['Vertex']
+        vertexes = np.zeros(vertexes_shape, dtype)
+        vertexes_cl = cl.Buffer(self.context, cl.mem_flags.READ_WRITE, vertexes.nbytes)
+        buffer = Buffer(self.context, array=vertexes, buffer=vertexes_cl)
+        return buffer
+
+    def update_output(
+        self,
+        path_count: int,
+        wavelength_count: int,
+        ray_count: int,
+        resolution: QtCore.QSize,
+        sensor_size: tuple[float, float],
+    ) -> Buffer:
+        # the vertexes are stored per ray with all wavelengths next to each other
+        transform = screen_transform(resolution, sensor_size)
+        vertexes = self.update_vertexes((path_count, ray_count, wavelength_count))
+        vertexes.args = (transform, resolution)
+
+        self.kernel.set_arg(11, np.float32(transform))
+        self.kernel.set_arg(
+            12, cl.cltypes.make_int2(resolution.width(), resolution.height())
+        )
+        return vertexes
+
+    @lru_cache(1)
+    def raytrace(
+        self,
+        lens_model: LensModel,
+        sensor_size: tuple[float, float],
+        glasses_path: str,
+        abbe_nr_adjustment: float,
+        coating: tuple[int, ...],
+        coating_min_ior: float,
+        grid_count: int,
+        grid_length: float,
+        light_position: tuple[float, float],
+        resolution: QtCore.QSize,
+        wavelength_count: int,
+        path_indexes: tuple[int, ...],
+        spectral_sampling: SpectralSampling = SpectralSampling.UNIFORM,
+        wavelength_sub_count: int = 1,
+    ) -> Buffer | None:
+        # cached apart from the rays of the raytracing task
+        return self.trace_grid(
+            lens_model,
+            sensor_size,
+            glasses_path,
+            abbe_nr_adjustment,
+            coating,
+            coating_min_ior,
+            grid_count,
+            grid_length,
+            light_position,
+            resolution,
+            wavelength_count,
+            path_indexes,
+            spectral_sampling,
+            wavelength_sub_count,
+        )
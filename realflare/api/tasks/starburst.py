@@ -5,7 +5,7 @@ import numpy as np
 import pyopencl as cl
 from PySide2 import QtCore
 
-from realflare.api.data import Flare, Project
+from realflare.api.data import Flare, Project, RegionOfInterest, roi_box
 from realflare.api.tasks.opencl import OpenCL, LAMBDA_MID, LAMBDA_MIN, LAMBDA_MAX, Image
 from realflare.utils.ciexyz import CIEXYZ
 from realflare.utils.timing import timer
@@ -13,6 +13,32 @@ from realflare.utils.timing import timer
 logger = logging.getLogger(__name__)
 
 
+def footprint(
+    config: Flare.Starburst,
+    resolution: QtCore.QSize,
+    offset: tuple[float, float],
+    scale: tuple[float, float],
+) -> QtCore.QRect:
+    # returns the region in image coordinates where the starburst samples the
+    # fourier spectrum, see starburst.cl
+    width, height = resolution.width(), resolution.height()
+    scale = (scale[0], scale[1] * width / height)
+    offset = (offset[0], -offset[1])
+
+    # the spectrum is sampled in a unit square that is scaled by the wavelength
+    # relative to LAMBDA_MID, rotated and offset by the blur
+    radius = np.sqrt(2) * LAMBDA_MAX / LAMBDA_MID + config.blur / 100
+    scale = np.maximum(np.float32(scale), np.finfo(np.float32).tiny)
+    ndc_min = np.float32(offset) - radius * scale
+    ndc_max = np.float32(offset) + radius * scale
+
+    dims = np.float32((width - 1, height - 1))
+    x0, y0 = np.floor((ndc_min + 1) / 2 * dims)
+    x1, y1 = np.ceil((ndc_max + 1) / 2 * dims)
+    window = QtCore.QRect(int(x0), int(y0), int(x1 - x0) + 1, int(y1 - y0) + 1)
+    return window.intersected(QtCore.QRect(0, 0, width, height))
+
+
 class StarburstTask(OpenCL):
     def __init__(self, queue: cl.CommandQueue) -> None:
         super().__init__(queue)
@@ -89,10 +115,18 @@ class StarburstTask(OpenCL):
         aperture: Image,
         offset: tuple[float, float],
         scale: tuple[float, float],
+        window: QtCore.QRect,
     ) -> Image:
         if self.rebuild:
             self.build()
 
+        frame = QtCore.QRect(QtCore.QPoint(0, 0), resolution)
+        if window.isEmpty():
+            array = np.zeros((resolution.height(), resolution.width(), 4), np.float32)
+            starburst = Image(self.context, array=array, args=(resolution, window))
+            starburst.data_window = window
+            return starburst
+
         # args
         if config.vignetting_enabled:
             vignetting = (config.vignetting.x(), config.vignetting.y())
@@ -110,10 +144,11 @@ class StarburstTask(OpenCL):
 
         light_spectrum = self.update_light_spectrum()
 
-        # create output buffer
-        starburst = self.update_image(resolution, flags=cl.mem_flags.READ_WRITE)
+        # create output buffer, only the window is rendered
+        starburst = self.update_image(window.size(), flags=cl.mem_flags.READ_WRITE)
         starburst.args = (
             resolution,
+            window,
             fourier_spectrum,
             samples,
             blur,
@@ -139,8 +174,10 @@ class StarburstTask(OpenCL):
         self.kernel.set_arg(8, np.float32(intensity))
         self.kernel.set_arg(9, np.float32(offset))
         self.kernel.set_arg(10, np.float32(scale))
+        self.kernel.set_arg(11, np.int32(window.topLeft().toTuple()))
+        self.kernel.set_arg(12, np.int32(resolution.toTuple()))
 
-        w, h = resolution.width(), resolution.height()
+        w, h = window.width(), window.height()
         global_work_size = (w, h)
         local_work_size = None
         cl.enqueue_nd_range_kernel(
@@ -149,20 +186,43 @@ class StarburstTask(OpenCL):
         cl.enqueue_copy(
             self.queue, starburst.array, starburst.image, origin=(0, 0), region=(w, h)
         )
+        starburst.data_window = window
+
+        if window != frame:
+            # copy the window into the frame
+            array = np.zeros((resolution.height(), resolution.width(), 4), np.float32)
+            array[
+                window.top() : window.bottom() + 1, window.left() : window.right() + 1
+            ] = starburst.array
+            args = starburst.args
+            starburst = Image(self.context, array=array, args=args)
+            starburst.data_window = window
 
         return starburst
 
     @timer
     def run(self, project: Project, aperture: Image) -> Image:
         flare = project.flare
+        render = project.render
         position = flare.light.position.x(), flare.light.position.y()
         scale = flare.starburst.scale.width(), flare.starburst.scale.height()
+
+        # region of interest
+        frame = QtCore.QRect(QtCore.QPoint(0, 0), render.resolution)
+        if render.roi == RegionOfInterest.AUTO:
+            window = footprint(flare.starburst, render.resolution, position, scale)
+        elif render.roi == RegionOfInterest.BOX:
+            window = roi_box(render)
+        else:
+            window = frame
+
         image = self.starburst(
             flare.starburst,
-            project.render.resolution,
-            project.render.starburst.samples,
+            render.resolution,
+            render.starburst.samples,
             aperture,
             position,
             scale,
+            window,
         )
         return image
@@ -0,0 +1,302 @@
+from __future__ import annotations
+
+import argparse
+import copy
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import pyopencl as cl
+from PySide2 import QtCore
+
+from realflare.api.data import Project, RenderElement, RenderImage, RealflareError
+from realflare.api.engine import Engine
+from realflare.storage import Storage
+from qt_extensions.typeutils import cast
+
+
+logger = logging.getLogger(__name__)
+storage = Storage()
+
+# the values that are measured for each setting, only values up to the value of
+# the project are rendered. the project with culling disabled is the reference.
+CANDIDATES = {
+    'grid_count': (9, 17, 33, 65, 129, 257),
+    'wavelength_count': (1, 3, 5, 9, 16),
+    'anti_aliasing': (1, 2, 4, 8),
+    'cull_percentage': (0.9, 0.75, 0.5, 0.25, 0),
+}
+# the amount of ghosts listed in the report
+GHOST_COUNT = 20
+
+
+def candidates(project: Project) -> dict[str, tuple]:
+    # returns the values per setting sorted from cheapest to most expensive
+    values = {}
+    for name, options in CANDIDATES.items():
+        if name == 'cull_percentage':
+            values[name] = options
+            continue
+        current = getattr(project.render, name)
+        options = sorted({value for value in options if value < current} | {current})
+        values[name] = tuple(options)
+    return values
+
+
+def reference_settings(project: Project) -> dict:
+    settings = {name: getattr(project.render, name) for name in CANDIDATES}
+    settings['cull_percentage'] = 0
+    return settings
+
+
+class Analyzer:
+    def __init__(self, project: Project) -> None:
+        self.project = project
+        self.project.output.write = False
+        self.project.render.cull_energy = 0
+        self.project.render.temporal_tolerance_enabled = False
+
+        self.engine = Engine()
+        self.engine.image_rendered.connect(self._image_rendered)
+        self._image = None
+        self._results = {}
+        self.reference = None
+
+    def _image_rendered(self, image: RenderImage) -> None:
+        self._image = image.image.array.copy()
+
+    def render(self, settings: dict) -> tuple[np.ndarray, float]:
+        project = copy.deepcopy(self.project)
+        for name, value in settings.items():
+            setattr(project.render, name, value)
+
+        # clears the emit cache so that every render emits its image and the task
+        # caches so that every render runs all stages, independent of the
+        # settings that were rendered before
+        self.engine.set_elements([RenderElement.FLARE])
+        if self.engine.renderers:
+            self.engine.clear_task_caches()
+        self._image = None
+        start = time.perf_counter()
+        if not self.engine.render(project) or self._image is None:
+            raise RealflareError('an error occurred while rendering')
+        duration = time.perf_counter() - start
+        return self._image, duration
+
+    def measure(self, settings: dict) -> dict:
+        # returns the render time and the error compared to the reference, every
+        # combination of settings is only rendered once
+        key = tuple(sorted(settings.items()))
+        if key in self._results:
+            return self._results[key]
+
+        image, duration = self.render(settings)
+        diff = np.abs(image[..., :3] - self.reference[..., :3])
+        total = max(float(np.sum(np.abs(self.reference[..., :3]))), 1e-9)
+        result = {
+            'settings': settings,
+            'time': duration,
+            'error': float(np.sum(diff)) / total,
+        }
+        logger.info(
+            f'analyze: {settings}: {duration:.3f}s, error {result["error"]:.4f}'
+        )
+        self._results[key] = result
+        return result
+
+    def ghosts(self) -> list[dict]:
+        # returns the most expensive ghosts with their share of the energy and the
+        # estimated cost. the cost is not measured, it is estimated from the bins
+        # covered by the primitives of the ghost times the wavelengths.
+        project = copy.deepcopy(self.project)
+        project.render.cull_percentage = 0
+        report = self.engine.ghost_stats(project)
+
+        energy = max(float(np.sum(report['energy'])), 1e-9)
+        cost = max(float(np.sum(report['cost'])), 1e-9)
+        order = np.argsort(-report['cost'], kind='stable')[:GHOST_COUNT]
+        ghosts = []
+        for row in report[order]:
+            ghosts.append(
+                {
+                    'path': int(row['path']),
+                    'energy': float(row['energy']) / energy,
+                    'estimated_cost': float(row['cost']) / cost,
+                    'area': float(row['area']),
+                    'valid': float(row['valid']),
+                }
+            )
+        return ghosts
+
+    def run(self, error_threshold: float, time_budget: float) -> dict:
+        reference = reference_settings(self.project)
+        values = candidates(self.project)
+
+        # the first render includes building the kernels and is discarded
+        self.render(reference)
+
+        self.reference, reference_time = self.render(reference)
+        self._results[tuple(sorted(reference.items()))] = {
+            'settings': reference,
+            'time': reference_time,
+            'error': 0.0,
+        }
+
+        # each setting is lowered on its own while the others stay at the reference
+        sweeps = {}
+        for name, options in values.items():
+            sweeps[name] = [self.measure(dict(reference, **{name: v})) for v in options]
+
+        # the error threshold is split between the settings, the cheapest value
+        # of each setting that stays below its share is chosen
+        settings = dict(reference)
+        if error_threshold > 0:
+            share = error_threshold / len(values)
+            for name, results in sweeps.items():
+                for result in results:
+                    if result['error'] <= share:
+                        settings[name] = result['settings'][name]
+                        break
+        result = self.measure(settings)
+
+        # lower the setting that saves the most time per error until the time
+        # budget is met
+        while time_budget > 0 and result['time'] > time_budget:
+            best = None
+            for name, options in values.items():
+                index = options.index(settings[name])
+                if index == 0:
+                    continue
+                sweep = {r['settings'][name]: r for r in sweeps[name]}
+                current, lower = sweep[options[index]], sweep[options[index - 1]]
+                saved = current['time'] - lower['time']
+                cost = max(lower['error'] - current['error'], 1e-9)
+                if saved > 0 and (best is None or saved / cost > best[0]):
+                    best = (saved / cost, name, options[index - 1])
+            if best is None:
+                break
+            settings = dict(settings, **{best[1]: best[2]})
+            result = self.measure(settings)
+
+        recommendation = dict(result)
+        recommendation['meets_error'] = (
+            error_threshold <= 0 or result['error'] <= error_threshold
+        )
+        recommendation['meets_budget'] = (
+            time_budget <= 0 or result['time'] <= time_budget
+        )
+
+        return {
+            'resolution': [
+                self.project.render.resolution.width(),
+                self.project.render.resolution.height(),
+            ],
+            'error_threshold': error_threshold,
+            'time_budget': time_budget,
+            'reference': {'settings': reference, 'time': reference_time},
+            'sweeps': sweeps,
+            'recommendation': recommendation,
+            'ghosts': self.ghosts(),
+        }
+
+
+def markdown(report: dict) -> str:
+    lines = ['# Realflare Analysis', '']
+    width, height = report['resolution']
+    lines.append(f'Resolution: {width}x{height}')
+    lines.append(f'Reference time: {report["reference"]["time"]:.3f}s')
+    lines.append('')
+
+    recommendation = report['recommendation']
+    lines += ['## Recommendation', '', '| Setting | Value |', '| --- | --- |']
+    for name, value in recommendation['settings'].items():
+        lines.append(f'| {name} | {value} |')
+    lines.append('')
+    lines.append(
+        f'Time: {recommendation["time"]:.3f}s, error: {recommendation["error"]:.4f}'
+    )
+    if not recommendation['meets_error']:
+        lines.append(f'The error threshold of {report["error_threshold"]} is not met.')
+    if not recommendation['meets_budget']:
+        lines.append(f'The time budget of {report["time_budget"]}s is not met.')
+    lines.append('')
+
+    lines += ['## Settings', '']
+    for name, results in report['sweeps'].items():
+        lines += [f'### {name}', '', '| Value | Time | Error |', '| --- | --- | --- |']
+        for result in results:
+            value = result['settings'][name]
+            lines.append(f'| {value} | {result["time"]:.3f}s | {result["error"]:.4f} |')
+        lines.append('')
+
+    lines += [
+        '## Ghosts',
+        '',
+        '| Path | Energy | Estimated Cost | Area | Valid |',
+        '| --- | --- | --- | --- | --- |',
+    ]
+    for ghost in report['ghosts']:
+        lines.append(
+            f'| {ghost["path"]} | {ghost["energy"]:.2%} '
+            f'| {ghost["estimated_cost"]:.2%} '
+            f'| {ghost["area"]:.0f} | {ghost["valid"]:.2f} |'
+        )
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def analyze(
+    project_path: str,
+    report_path: str = '',
+    device: str = '',
+    error_threshold: float = 0.01,
+    time_budget: float = 0,
+) -> dict:
+    # renders the project with lower settings and writes a report with the time
+    # and error of each setting and the settings that meet the error threshold
+    # and the time budget
+    if not project_path or not os.path.isfile(project_path):
+        raise RealflareError(f'project path not valid: {project_path}')
+    try:
+        data = storage.read_data(project_path)
+    except ValueError as e:
+        logger.debug(e)
+        raise RealflareError(f'project is not valid: {project_path}') from None
+
+    project = cast(Project, data)
+    if device:
+        project.render.device = device
+
+    try:
+        analyzer = Analyzer(project)
+    except (cl.Error, ValueError) as e:
+        raise RealflareError('failed to start engine') from e
+
+    report = analyzer.run(error_threshold, time_budget)
+
+    if not report_path:
+        report_path = f'{os.path.splitext(project_path)[0]}_analysis'
+    report_path = os.path.splitext(report_path)[0]
+    with open(f'{report_path}.json', 'w') as f:
+        json.dump(report, f, indent=2)
+    with open(f'{report_path}.md', 'w') as f:
+        f.write(markdown(report))
+    logger.info(f'analyze: report written to {report_path}.json')
+    return report
+
+
+def exec_(args: argparse.Namespace) -> None:
+    logging.basicConfig(level=args.log)
+
+    # start application
+    QtCore.QCoreApplication()
+
+    analyze(
+        args.project,
+        args.report,
+        args.device,
+        args.error_threshold,
+        args.time_budget,
+    )
@@ -47,6 +47,7 @@ def render(
     output_path: str = '',
     colorspace: str = '',
     element: str = '',
+    device: str = '',
     frame_start: int = 1,
     frame_end: int = 1,
 ) -> None:
@@ -69,6 +70,8 @@ def render(
         project.output.colorspace = colorspace
     if element and element in RenderElement.__members__:
         project.output.element = RenderElement[element]
+    if device:
+        project.render.device = device
 
     # animation
     animation = None
@@ -114,6 +117,7 @@ def exec_(args: argparse.Namespace) -> None:
         args.output,
         args.colorspace,
         args.element,
+        args.device,
         args.frame_start,
         args.frame_end,
     )
@@ -338,7 +338,7 @@ class MainWindow(DockWindow):
 
         # text
         package_version = version('realflare')
-        if self.engine:
+        if self.engine and self.engine.queue:
             cl_version = self.engine.queue.device.platform.version
         else:
             cl_version = 'No CL Device'
@@ -404,6 +404,7 @@ class MainWindow(DockWindow):
     def restart(self):
         clear_cache()
         self.engine.queue = None
+        self.engine.renderers = {}
         self.refresh()
 
     def request_render(
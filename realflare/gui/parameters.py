@@ -23,7 +23,16 @@ from qt_extensions.parameters import (
 )
 from qt_extensions.typeutils import cast, basic
 from realflare.api import lens, glass
-from realflare.api.data import AntiAliasing, RenderElement, Project, RealflareError
+from realflare.api.data import (
+    AntiAliasing,
+    Binning,
+    GhostLayers,
+    RenderElement,
+    Project,
+    RealflareError,
+    RegionOfInterest,
+    SpectralSampling,
+)
 from realflare.api.tasks import opencl
 from realflare.storage import Storage
 from realflare.utils import ocio
@@ -100,6 +109,28 @@ class ProjectEditor(ParameterEditor):
         )
         form.add_parameter(parm)
 
+        parm = EnumParameter('ghost_layers')
+        parm.set_enum(GhostLayers)
+        parm.set_tooltip(
+            'Write ghosts into separate layers of the exr file in the same render. '
+            'Ghost: one layer per ghost. Set: one layer per ghost set. Rank: one '
+            'layer for each of the brightest ghosts and one for the rest.'
+        )
+        form.add_parameter(parm)
+
+        parm = StringParameter('ghost_layer_sets')
+        parm.set_tooltip(
+            'Ghost sets separated by semicolons, each a list of ghost indexes and '
+            'ranges.\nFor example: 0-3, 7; 12'
+        )
+        form.add_parameter(parm)
+
+        parm = IntParameter('ghost_layer_count')
+        parm.set_slider_visible(False)
+        parm.set_line_min(1)
+        parm.set_tooltip('Amount of layers when ranking the ghosts by intensity.')
+        form.add_parameter(parm)
+
     def _init_flare_group(self) -> None:
         self.tabs['lens_flare'].create_hierarchy = False
 
@@ -148,6 +179,36 @@ class ProjectEditor(ParameterEditor):
         parm.setEnabled(False)
         light_group.add_parameter(parm)
 
+        parm = BoolParameter('image_clustering')
+        parm.setEnabled(False)
+        parm.set_tooltip(
+            'Merge the pixels of the image into clusters instead of keeping the '
+            'brightest pixels. Each cluster is a light at its weighted center with '
+            'the combined color of its pixels. The samples set the amount of clusters.'
+        )
+        light_group.add_parameter(parm)
+
+        parm = BoolParameter('image_convolution')
+        parm.setEnabled(False)
+        parm.set_tooltip(
+            'Convolve the image with flares rendered at a grid of light positions '
+            'instead of rendering a flare for every sample. The render time depends '
+            'on the PSF count instead of the amount of samples.'
+        )
+        light_group.add_parameter(parm)
+
+        parm = IntParameter(name='image_psf_count')
+        parm.set_label('Image PSF Count')
+        parm.set_line_min(1)
+        parm.set_slider_min(1)
+        parm.set_slider_max(9)
+        parm.setEnabled(False)
+        parm.set_tooltip(
+            'The amount of light positions per side of the grid that flares are '
+            'rendered at for the image convolution.'
+        )
+        light_group.add_parameter(parm)
+
         parm = BoolParameter('show_image')
         parm.setEnabled(False)
         light_group.add_parameter(parm)
@@ -358,6 +419,98 @@ class ProjectEditor(ParameterEditor):
         )
         renderer_group.add_parameter(parm)
 
+        parm = EnumParameter('binning')
+        parm.set_enum(Binning)
+        parm.set_tooltip(
+            'Binning mode of the renderer. Bitmask stores one bit per primitive and '
+            'bin. Compact stores a list of the primitives overlapping each bin which '
+            'is faster for scenes with many small primitives. Tile uses the same lists '
+            'but renders each bin with one work-group that shares the primitives in '
+            'local memory.'
+        )
+        renderer_group.add_parameter(parm)
+
+        parm = BoolParameter('hierarchical_binning')
+        parm.set_tooltip(
+            'Bin primitives into super bins of 4x4 bins first and only test the '
+            'primitives of a super bin against its bins. This speeds up binning for '
+            'high resolutions and small bin sizes. Only used by Compact and Tile '
+            'binning.'
+        )
+        renderer_group.add_parameter(parm)
+
+        parm = BoolParameter('sort_primitives')
+        parm.set_tooltip(
+            'Sort the primitives by their position on screen before binning, so that '
+            'the primitives of a batch are close to each other. This lets the '
+            'Bitmask rasterizer skip more empty batches per bin.'
+        )
+        renderer_group.add_parameter(parm)
+
+        parm = FloatParameter('splat_area')
+        parm.set_slider_visible(False)
+        parm.set_line_min(0)
+        parm.set_tooltip(
+            'Ghosts whose primitives cover less than this area in pixels on average '
+            'are splatted instead of rasterized. Each primitive adds its energy to '
+            'the pixels around its center which is much faster for dense grids of '
+            'small primitives. A value of 0 rasterizes all ghosts.'
+        )
+        renderer_group.add_parameter(parm)
+
+        parm = FloatParameter('downsample_area')
+        parm.set_slider_visible(False)
+        parm.set_line_min(0)
+        parm.set_tooltip(
+            'Ghosts whose primitives cover more than this area in pixels on average '
+            'are rasterized at half or a quarter of the resolution and upsampled. '
+            'Large soft ghosts have little detail and render up to 16 times faster. '
+            'A value of 0 rasterizes all ghosts at full resolution.'
+        )
+        renderer_group.add_parameter(parm)
+
+        parm = BoolParameter('packed_vertexes')
+        parm.set_tooltip(
+            'Store the vertexes for the rasterizer with fixed point positions and '
+            'half precision attributes. This halves the memory the rasterizer reads '
+            'per primitive at the cost of a small error in the image, which helps '
+            'on GPUs that are limited by memory bandwidth.'
+        )
+        renderer_group.add_parameter(parm)
+
+        parm = IntParameter('strip_height')
+        parm.set_slider_visible(False)
+        parm.set_line_min(0)
+        parm.set_tooltip(
+            'Rasterize the flare in horizontal strips of this height. Only one strip '
+            'is stored on the device which limits the memory usage for large '
+            'resolutions. A value of 0 renders the full frame at once.'
+        )
+        renderer_group.add_parameter(parm)
+
+        parm = EnumParameter('roi')
+        parm.set_label('Region of Interest')
+        parm.set_enum(RegionOfInterest)
+        parm.set_tooltip(
+            'Region of the frame that is rendered. Auto only renders the area covered '
+            'by the flare, Box renders the area defined by the position and size. '
+            'Pixels outside of the region are black and EXR files only store the '
+            'region as the data window.'
+        )
+        renderer_group.add_parameter(parm)
+
+        parm = PointParameter('roi_position')
+        parm.set_label('ROI Position')
+        parm.set_tooltip('Position of the top left corner of the box in pixels.')
+        renderer_group.add_parameter(parm)
+
+        parm = SizeParameter('roi_size')
+        parm.set_label('ROI Size')
+        parm.set_tooltip(
+            'Size of the box in pixels. An empty box renders the full frame.'
+        )
+        renderer_group.add_parameter(parm)
+
         parm = EnumParameter('anti_aliasing')
         parm.set_label('Anti Aliasing')
         parm.set_enum(AntiAliasing)
@@ -365,6 +518,14 @@ class ProjectEditor(ParameterEditor):
         parm.set_tooltip('Super sampling multiplier for anti-aliasing.')
         renderer_group.add_parameter(parm)
 
+        parm = BoolParameter('analytic_coverage')
+        parm.set_tooltip(
+            'Weight the fragments by the exact area of the primitive inside the pixel '
+            'instead of counting the anti-aliasing samples. Gives smooth edges '
+            'without super sampling.'
+        )
+        renderer_group.add_parameter(parm)
+
         # rays
         box = self.tabs['render'].add_group('rays')
         box.set_box_style(ParameterBox.BUTTON)
@@ -393,6 +554,15 @@ class ProjectEditor(ParameterEditor):
         )
         rays_group.add_parameter(parm)
 
+        parm = EnumParameter('spectral_sampling')
+        parm.set_enum(SpectralSampling)
+        parm.set_tooltip(
+            'Distribution of the wavelengths. Uniform spaces the wavelengths evenly. '
+            'Importance places more wavelengths where the eye is most sensitive and '
+            'weights them accordingly.'
+        )
+        rays_group.add_parameter(parm)
+
         parm = IntParameter('grid_subdivisions')
         parm.set_slider_max(256)
         parm.set_tooltip(
@@ -423,6 +593,53 @@ class ProjectEditor(ParameterEditor):
         )
         rays_group.add_parameter(parm)
 
+        parm = FloatParameter('cull_energy')
+        parm.set_slider_max(0.1)
+        parm.set_line_min(0)
+        parm.set_line_max(1)
+        parm.set_tooltip(
+            'The fraction of the total flare energy that can be culled. '
+            'The darkest ghosts are culled as long as their combined energy stays '
+            'below this fraction. 0.01 culls the ghosts that make up 1% of the energy.'
+        )
+        rays_group.add_parameter(parm)
+
+        parm = BoolParameter('cull_per_frame')
+        parm.set_tooltip(
+            'Estimate the energy of the ghosts at the light position of the current '
+            'frame instead of the center of the frame. Animated lights only render '
+            'the ghosts that are visible at their current position.'
+        )
+        rays_group.add_parameter(parm)
+
+        parm = BoolParameter('fused_raytracing')
+        parm.set_tooltip(
+            'Trace rays directly into screen space vertices without storing the rays. '
+            'This lowers memory usage for high grid subdivisions and wavelengths.'
+        )
+        rays_group.add_parameter(parm)
+
+        parm = FloatParameter('temporal_tolerance')
+        parm.set_slider_max(4)
+        parm.set_line_min(0)
+        parm.set_tooltip(
+            'Reuse the rays of previous frames when the light moves less than this '
+            'amount of pixels. The rays are extrapolated along the motion of the light. '
+            'This speeds up animations with slow moving lights.'
+        )
+        rays_group.add_parameter(parm, checkable=True)
+
+        parm = IntParameter('temporal_keyframe_interval')
+        parm.set_label('Keyframe Interval')
+        parm.set_line_min(1)
+        parm.set_slider_min(1)
+        parm.set_slider_max(32)
+        parm.set_tooltip(
+            'The maximum amount of frames before the rays are fully traced again when '
+            'reusing rays.'
+        )
+        rays_group.add_parameter(parm)
+
         parm = IntParameter('debug_ghost')
         parm.set_slider_max(100)
         rays_group.add_parameter(parm, checkable=True)
@@ -792,6 +1009,9 @@ class ProjectEditor(ParameterEditor):
         widgets['flare']['light']['position'].setEnabled(not enabled)
         widgets['flare']['light']['image_sample_resolution'].setEnabled(enabled)
         widgets['flare']['light']['image_samples'].setEnabled(enabled)
+        widgets['flare']['light']['image_clustering'].setEnabled(enabled)
+        widgets['flare']['light']['image_convolution'].setEnabled(enabled)
+        widgets['flare']['light']['image_psf_count'].setEnabled(enabled)
         widgets['flare']['light']['show_image'].setEnabled(enabled)
 
     def _starburst_aperture_file_enabled(self, enabled: bool) -> None:
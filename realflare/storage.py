@@ -75,6 +75,9 @@ class Storage(JSONStorage, metaclass=Singleton):
         self._state_path = os.path.join(self._path, 'state.json')
         self._state = None
 
+        # cache
+        self.cache_path = os.path.join(self._path, 'cache')
+
         # path variables
         self.path_vars = {
             '$RES': os.path.join(self._path, 'resources'),
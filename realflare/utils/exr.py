@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import struct
+
+import numpy as np
+
+# minimal writer for uncompressed scanline OpenEXR files with a data window
+# https://openexr.com/en/latest/OpenEXRFileLayout.html
+
+MAGIC = 20000630
+VERSION = 2
+
+# pixel types
+UINT = 0
+HALF = 1
+FLOAT = 2
+
+CHANNELS = 'RGBA'
+
+
+def attribute(name: str, type_name: str, data: bytes) -> bytes:
+    header = name.encode() + b'\0' + type_name.encode() + b'\0'
+    return header + struct.pack('<i', len(data)) + data
+
+
+def box2i(x_min: int, y_min: int, x_max: int, y_max: int) -> bytes:
+    return struct.pack('<4i', x_min, y_min, x_max, y_max)
+
+
+def channel_list(names: list[str], pixel_type: int) -> bytes:
+    data = b''
+    for name in names:
+        # pixel type, linear, reserved, x sampling, y sampling
+        data += name.encode() + b'\0'
+        data += struct.pack('<iB3xii', pixel_type, 0, 1, 1)
+    return data + b'\0'
+
+
+def write(
+    filename: str,
+    array: np.ndarray,
+    width: int,
+    height: int,
+    x: int = 0,
+    y: int = 0,
+    layers: dict[str, np.ndarray] | None = None,
+) -> None:
+    # writes array as the data window at (x, y) of an image with the display
+    # window (width, height). array is (height, width, channels) with RGBA order.
+    # layers are arrays of the same size stored as the channels layer.R, layer.G, ...
+    # an empty data window is not valid in OpenEXR, it falls back to a single
+    # black pixel in the top left corner
+    layers = layers or {}
+    data_height, data_width = array.shape[:2]
+    if not data_width or not data_height:
+        array = np.zeros((1, 1) + array.shape[2:], np.float32)
+        layers = {
+            layer: np.zeros((1, 1) + layer_array.shape[2:], np.float32)
+            for layer, layer_array in layers.items()
+        }
+        data_height, data_width = 1, 1
+        x, y = 0, 0
+
+    channels = CHANNELS[: array.shape[2]] if array.ndim == 3 else 'Y'
+    array = np.float32(array).reshape(data_height, data_width, -1)
+    planes = {name: array[..., i] for i, name in enumerate(channels)}
+    for layer, layer_array in layers.items():
+        layer_array = np.float32(layer_array).reshape(data_height, data_width, -1)
+        for i, name in enumerate(CHANNELS[: layer_array.shape[2]]):
+            planes[f'{layer}.{name}'] = layer_array[..., i]
+
+    # channels are stored in alphabetical order
+    names = sorted(planes)
+
+    data_window = box2i(x, y, x + data_width - 1, y + data_height - 1)
+
+    header = struct.pack('<ii', MAGIC, VERSION)
+    header += attribute('channels', 'chlist', channel_list(names, FLOAT))
+    header += attribute('compression', 'compression', bytes([0]))
+    header += attribute('dataWindow', 'box2i', data_window)
+    header += attribute('displayWindow', 'box2i', box2i(0, 0, width - 1, height - 1))
+    header += attribute('lineOrder', 'lineOrder', bytes([0]))
+    header += attribute('pixelAspectRatio', 'float', struct.pack('<f', 1))
+    header += attribute('screenWindowCenter', 'v2f', struct.pack('<2f', 0, 0))
+    header += attribute('screenWindowWidth', 'float', struct.pack('<f', 1))
+    header += b'\0'
+
+    # one scanline per chunk without compression
+    line_size = data_width * len(names) * 4
+    chunk_size = 8 + line_size
+    offset = len(header) + data_height * 8
+    offsets = np.arange(data_height, dtype='<u8') * chunk_size + offset
+
+    with open(filename, 'wb') as f:
+        f.write(header)
+        f.write(offsets.tobytes())
+        for row in range(data_height):
+            # channels of a scanline are stored one after another
+            line = np.stack([planes[name][row] for name in names]).astype('<f4')
+            f.write(struct.pack('<ii', y + row, line_size))
+            f.write(line.tobytes())